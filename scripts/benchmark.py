@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import argparse
+from client import TurkleClient
+import statistics
+import sys
+
+
+parser = argparse.ArgumentParser(
+    description="Measure the latency of accepting and submitting tasks",
+    epilog="Each task is accepted and submitted with placeholder answers, "
+           "so use a batch created for benchmarking",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument("-u", help="admin username", required=True)
+parser.add_argument("-p", help="admin password")
+parser.add_argument("--server", help="protocol://hostname:port", default="http://localhost:8000")
+parser.add_argument("--num", help="number of tasks to accept and submit", default=100, type=int)
+parser.add_argument("batch", help="id of the batch", type=int)
+args = parser.parse_args()
+
+client = TurkleClient(args.server, args.u, args.p)
+latencies = client.benchmark(args.batch, args.num)
+if not latencies or not latencies['accept']:
+    sys.exit(1)
+
+print("{:<8}{:>8}{:>12}{:>12}{:>12}".format('', 'tasks', 'mean (ms)', 'median (ms)', 'max (ms)'))
+for name in ('accept', 'submit'):
+    ms = [1000 * latency for latency in latencies[name]]
+    print("{:<8}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+        name, len(ms), statistics.mean(ms), statistics.median(ms), max(ms)))
@@ -4,6 +4,8 @@ import getpass
 import os
 import re
 import requests
+import time
+from urllib.parse import urljoin
 
 
 def exception_handler(func):
@@ -22,10 +24,16 @@ def exception_handler(func):
 
 class TurkleClient(object):
     LOGIN_URL = "/login/"
+    ACCEPT_NEXT_TASK_URL = "/turkle/batch/{}/accept_next_task/"
     ADD_USER_URL = "/admin/auth/user/add/"
     ADD_PROJECT_URL = "/admin/turkle/project/add/"
     ADD_BATCH_URL = "/admin/turkle/batch/add/"
     LIST_BATCH_URL = "/admin/turkle/batch/"
+    UPLOAD_CSV_URL = "/admin/turkle/batch/upload/"
+    # number of bytes of the CSV file sent per request
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    # number of times an interrupted CSV upload is resumed
+    UPLOAD_RETRIES = 5
 
     def __init__(self, server, admin, password=None):
         # prefix is for when the app is not run in the base of the web server
@@ -60,6 +68,34 @@ class TurkleClient(object):
                 return False
         return True
 
+    @exception_handler
+    def benchmark(self, batch_id, num):
+        # returns lists of the accept and submit latencies in seconds
+        with requests.Session() as session:
+            if not self.login(session):
+                return False
+            latencies = {'accept': [], 'submit': []}
+            accept_url = self.format_url(self.ACCEPT_NEXT_TASK_URL.format(batch_id))
+            for _ in range(num):
+                # accepting a task is a redirect to the task assignment page
+                start = time.perf_counter()
+                resp = session.get(accept_url, allow_redirects=False)
+                if '/assignment/' not in resp.headers.get('location', ''):
+                    print("Error: no tasks available in batch {}".format(batch_id))
+                    break
+                assignment_url = urljoin(self.server + '/', resp.headers['location'])
+                session.get(assignment_url)
+                accepted = time.perf_counter()
+                payload = {
+                    'benchmark': 'true',
+                    'csrfmiddlewaretoken': session.cookies['csrftoken'],
+                }
+                session.post(assignment_url, data=payload, allow_redirects=False)
+                submitted = time.perf_counter()
+                latencies['accept'].append(accepted - start)
+                latencies['submit'].append(submitted - accepted)
+        return latencies
+
     @exception_handler
     def download(self, directory):
         with requests.Session() as session:
@@ -124,26 +160,62 @@ class TurkleClient(object):
         soup = BeautifulSoup(resp.text, features='html.parser')
         project_options = [option['value'] for option in
                            soup.select('select[id=id_project] > option')]
+        # the csv file is uploaded in chunks so that large files can be uploaded
+        session.headers.update({'referer': url, 'X-CSRFToken': session.cookies['csrftoken']})
+        upload_url = self.upload_csv_chunks(session, options.csv_path)
+        if not upload_url:
+            print("Error: uploading the csv failed")
+            return None
         payload = {
             # we just upload a project so we assume that its last in list
             'project': project_options[-1],
             'name': options.batch_name,
             'assignments_per_task': options.num,
             'active': 1,
-            'csrfmiddlewaretoken': session.cookies['csrftoken'],
+            'filename': options.csv,
         }
         if options.login:
             payload['login_required'] = 1
-        files = {'csv_file': (options.csv, options.csv_data)}
-        session.headers.update({'referer': url})
-        resp = session.post(url, data=payload, files=files)
+        resp = session.post(upload_url + 'create/', data=payload)
+        if resp.status_code == requests.codes.bad_request:
+            session.delete(upload_url)
+            print("Error: the csv file is invalid. Try uploading using the admin UI.")
+            return None
         if resp.status_code != requests.codes.ok:
             print("Error: uploading the csv failed")
             return None
-        if b'correct the error' in resp.content:
-            print("Error: the csv file is invalid. Try uploading using the admin UI.")
+        return urljoin(self.server + '/', resp.json()['url'])
+
+    def upload_csv_chunks(self, session, path):
+        # returns the url of the upload or None if the upload failed
+        resp = session.post(self.format_url(self.UPLOAD_CSV_URL))
+        if resp.status_code != requests.codes.ok:
             return None
-        return resp.url
+        upload_url = self.format_url(self.UPLOAD_CSV_URL + resp.json()['upload_id'] + '/')
+        offset = 0
+        retries = 0
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fh:
+            while offset < size:
+                fh.seek(offset)
+                data = fh.read(self.UPLOAD_CHUNK_SIZE)
+                try:
+                    resp = session.post(upload_url, params={'offset': offset}, data=data,
+                                        headers={'content-type': 'application/octet-stream'})
+                    if resp.status_code in (requests.codes.ok, requests.codes.conflict):
+                        offset = resp.json()['offset']
+                        continue
+                except requests.exceptions.ConnectionError:
+                    pass
+                # resume from the number of bytes that the server received
+                retries += 1
+                if retries > self.UPLOAD_RETRIES:
+                    return None
+                resp = session.get(upload_url)
+                if resp.status_code != requests.codes.ok:
+                    return None
+                offset = resp.json()['offset']
+        return upload_url
 
     def review_batch(self, session, url):
         url = url.replace('review', 'publish')
@@ -179,7 +251,7 @@ class TurkleClient(object):
             options.batch_name = self.extract_name(options.csv)
         options.form = self.read_file(options.template)
         options.template = os.path.basename(options.template)
-        options.csv_data = self.read_file(options.csv)
+        options.csv_path = options.csv
         options.csv = os.path.basename(options.csv)
 
     @staticmethod
@@ -1,11 +1,10 @@
-from bisect import bisect_left
-from collections import defaultdict
+from contextlib import contextmanager
 import csv
-from datetime import datetime, timedelta, timezone
-from io import StringIO
-import json
+from datetime import timedelta
+from io import StringIO, TextIOWrapper
 import logging
-import statistics
+import os
+import uuid
 
 from admin_auto_filters.filters import AutocompleteFilter
 from admin_auto_filters.views import AutocompleteJsonView
@@ -15,27 +14,70 @@ from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.contrib.auth.admin import GroupAdmin, UserAdmin
 from django.contrib.auth.models import Group, User
 from django.contrib.admin.templatetags.admin_list import _boolean_icon
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import DurationField, ExpressionWrapper, F
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.core.files import File
+from django.db import models, transaction
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.forms import (FileField, FileInput, HiddenInput, IntegerField,
                           ModelForm, ModelMultipleChoiceField, TextInput, ValidationError, Widget)
-from django.http import HttpResponse, JsonResponse
+from django.http import (FileResponse, HttpResponse, HttpResponseNotAllowed, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect, render
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils.html import format_html, format_html_join
+from django.utils import timezone
 from guardian.admin import GuardedModelAdmin
 from guardian.shortcuts import assign_perm, get_groups_with_perms, remove_perm
 import humanfriendly
 
 import turkle
-from turkle.models import Batch, Project, TaskAssignment
-from turkle.utils import get_site_name, get_turkle_template_limit
+from turkle.models import Batch, Job, Project, Task, TaskAssignment, TaskAssignmentRollup
+from turkle.utils import (exclusive_file_lock, get_site_name, get_turkle_background_jobs,
+                          get_turkle_template_limit)
 
 logger = logging.getLogger(__name__)
 
 
+# Maximum number of Task IDs returned by BatchAdmin.review_batch_task_ids()
+REVIEW_TASK_IDS_LIMIT = 1000
+
+# Number of bytes copied at a time from a request to a chunked CSV upload
+CSV_UPLOAD_READ_SIZE = 65536
+
+
+@contextmanager
+def _uploaded_csv_text(uploaded_file):
+    """Read an uploaded CSV file as text, without copying the file into memory
+
+    The file is decoded incrementally as it is read, so large files
+    spooled to disk by Django are not loaded into memory all at once.
+
+    Args:
+        uploaded_file (UploadedFile): Uploaded UTF-8 CSV file
+
+    Returns:
+        Context manager that yields a text file handle suitable for csv.reader
+    """
+    uploaded_file.seek(0)
+    text_fh = TextIOWrapper(uploaded_file.file, encoding='utf-8', newline='')
+    try:
+        yield text_fh
+    finally:
+        # Detach so that closing the wrapper does not close the uploaded file
+        text_fh.detach()
+        uploaded_file.seek(0)
+
+
+def _csv_upload_path(user, upload_id):
+    """
+    Returns:
+        Absolute path of the file for a chunked CSV upload started by the User
+    """
+    return Job.file_path('{}{}-{}.csv'.format(Job.UPLOAD_FILE_PREFIX, user.id, upload_id))
+
+
 def _format_timespan(sec):
     return '{} ({:,}s)'.format(humanfriendly.format_timespan(sec, max_units=6), sec)
 
@@ -134,6 +176,7 @@ class CustomGroupAdmin(GroupAdmin):
                 obj.user_set.remove(user)
         else:
             obj.user_set.clear()
+        Batch.invalidate_access_permitted_cache()
 
     def total_members(self, obj):
         return obj.user_set.count()
@@ -164,6 +207,12 @@ class CustomUserAdmin(UserAdmin):
             return redirect(reverse('turkle_admin:auth_user_changelist'))
         return super().response_add(request, obj, post_url_continue)
 
+    def save_related(self, request, form, formsets, change):
+        # Group memberships are saved after the User, and the is_active
+        # and is_superuser flags affect which Batches a User can access
+        super().save_related(request, form, formsets, change)
+        Batch.invalidate_access_permitted_cache()
+
 
 class CustomButtonFileWidget(FileInput):
     # HTML file inputs have a button followed by text that either
@@ -286,35 +335,43 @@ class BatchForm(ModelForm):
 
         validation_errors = []
 
-        # django InMemoryUploadedFile returns bytes and we need strings
-        rows = csv.reader(StringIO(csv_file.read().decode('utf-8')))
-        header = next(rows)
-
-        csv_fields = set(header)
-        template_fields = set(project.fieldnames)
-        if csv_fields != template_fields:
-            template_but_not_csv = template_fields.difference(csv_fields)
-            if template_but_not_csv:
-                validation_errors.append(
-                    ValidationError(
-                        'The CSV file is missing fields that are in the HTML template. '
-                        'These missing fields are: %s' %
-                        ', '.join(template_but_not_csv)))
-
-        expected_fields = len(header)
-        for (i, row) in enumerate(rows):
-            if len(row) != expected_fields:
-                validation_errors.append(
-                    ValidationError(
-                        'The CSV file header has %d fields, but line %d has %d fields' %
-                        (expected_fields, i+2, len(row))))
+        # The file is read one row at a time, so that large files are not held in memory
+        with _uploaded_csv_text(csv_file) as csv_fh:
+            rows = csv.reader(csv_fh)
+            try:
+                header = next(rows, None)
+            except UnicodeDecodeError:
+                raise ValidationError('The CSV file is not UTF-8 encoded')
+            if not header:
+                raise ValidationError('The CSV file is empty')
+
+            csv_fields = set(header)
+            template_fields = set(project.fieldnames)
+            if csv_fields != template_fields:
+                template_but_not_csv = template_fields.difference(csv_fields)
+                if template_but_not_csv:
+                    validation_errors.append(
+                        ValidationError(
+                            'The CSV file is missing fields that are in the HTML template. '
+                            'These missing fields are: %s' %
+                            ', '.join(template_but_not_csv)))
+            # Reported as a warning by BatchAdmin.save_model()
+            self.csv_fields_not_in_template = csv_fields.difference(template_fields)
+
+            expected_fields = len(header)
+            try:
+                for (i, row) in enumerate(rows):
+                    if len(row) != expected_fields:
+                        validation_errors.append(
+                            ValidationError(
+                                'The CSV file header has %d fields, but line %d has %d fields' %
+                                (expected_fields, i+2, len(row))))
+            except UnicodeDecodeError:
+                validation_errors.append(ValidationError('The CSV file is not UTF-8 encoded'))
 
         if validation_errors:
             raise ValidationError(validation_errors)
 
-        # Rewind file, so it can be re-read
-        csv_file.seek(0)
-
     def clean_allotted_assignment_time(self):
         """Clean 'allotted_assignment_time' form field
 
@@ -335,6 +392,7 @@ class BatchForm(ModelForm):
 
 def activate_batches(modeladmin, request, queryset):
     queryset.update(active=True)
+    Batch.invalidate_access_permitted_cache()
 
 
 activate_batches.short_description = "Activate selected Batches"
@@ -342,6 +400,7 @@ activate_batches.short_description = "Activate selected Batches"
 
 def activate_projects(modeladmin, request, queryset):
     queryset.update(active=True)
+    Batch.invalidate_access_permitted_cache()
 
 
 activate_projects.short_description = "Activate selected Projects"
@@ -349,6 +408,7 @@ activate_projects.short_description = "Activate selected Projects"
 
 def deactivate_batches(modeladmin, request, queryset):
     queryset.update(active=False)
+    Batch.invalidate_access_permitted_cache()
 
 
 deactivate_batches.short_description = "Deactivate selected Batches"
@@ -356,6 +416,7 @@ deactivate_batches.short_description = "Deactivate selected Batches"
 
 def deactivate_projects(modeladmin, request, queryset):
     queryset.update(active=False)
+    Batch.invalidate_access_permitted_cache()
 
 
 deactivate_projects.short_description = "Deactivate selected Projects"
@@ -411,6 +472,7 @@ class BatchAdmin(admin.ModelAdmin):
         'stats', 'download_input', 'download_csv',
         )
     list_filter = ('active', BatchCreatorFilter, ProjectFilter)
+    list_select_related = ('project',)
     search_fields = ['name']
 
     # required by django-admin-autocomplete-filter 0.5
@@ -418,8 +480,8 @@ class BatchAdmin(admin.ModelAdmin):
         pass
 
     def assignments_completed(self, obj):
-        tfa = obj.total_finished_task_assignments()
-        ta = obj.assignments_per_task * obj.total_tasks()
+        tfa = obj.finished_assignment_count
+        ta = obj.assignments_per_task * obj.task_count
         h = format_html(
             '<progress value="{0}" max="{1}" title="Completed {0}/{1} Task Assignments">'
             '</progress> '.format(tfa, ta))
@@ -429,6 +491,7 @@ class BatchAdmin(admin.ModelAdmin):
             h += format_html('<img src="{}" />', static('admin/img/icon-unknown-alt.svg'))
         h += format_html(' {} / {}'.format(tfa, ta))
         return h
+    assignments_completed.admin_order_field = 'finished_assignment_count'
 
     def batch_stats(self, request, batch_id):
         try:
@@ -437,49 +500,27 @@ class BatchAdmin(admin.ModelAdmin):
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('turkle_admin:turkle_batch_changelist'))
 
-        tasks = batch.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to',  'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
-
-        user_ids = task_duration_by_user.keys()
+        batch_summary = TaskAssignmentRollup.summarize(batch.rollups.all())
+        user_summaries = TaskAssignmentRollup.summarize(batch.rollups.all(), group_by='user_id')
+
         stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            if user.id in task_duration_by_user:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = '{}s'.format(int(statistics.mean(
-                    task_duration_by_user[user.id])))
-                median_work_time = '{}s'.format(int(statistics.median(
-                    task_duration_by_user[user.id])))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
+        for user in User.objects.filter(id__in=user_summaries.keys()).order_by('username'):
+            summary = user_summaries[user.id]
             stats_users.append({
                 'username': user.username,
                 'full_name': user.get_full_name(),
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
+                'assignments_completed': summary.assignments_completed,
+                'mean_work_time': '{}s'.format(int(summary.mean_work_time())),
+                'median_work_time': '{}s'.format(int(summary.median_work_time())),
+                'last_finished_time': summary.last_finished_at,
             })
 
-        if tasks:
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
+        if batch_summary.assignments_completed:
+            first_finished_time = batch_summary.first_finished_at
+            last_finished_time = batch_summary.last_finished_at
+            total_work_time = _format_timespan(batch_summary.total_work_time)
+            mean_work_time = _format_timespan(int(batch_summary.mean_work_time()))
+            median_work_time = _format_timespan(int(batch_summary.median_work_time()))
         else:
             first_finished_time = 'N/A'
             last_finished_time = 'N/A'
@@ -501,7 +542,15 @@ class BatchAdmin(admin.ModelAdmin):
         try:
             batch = Batch.objects.get(id=batch_id)
             logger.info("User(%i) deleting Batch(%i) %s", request.user.id, batch.id, batch.name)
-            batch.delete()
+            if get_turkle_background_jobs():
+                # Hide the Batch from Workers until the Job deletes it
+                batch.active = False
+                batch.save()
+                Job.enqueue(Job.DELETE_BATCH, batch, request.user)
+                messages.info(request, 'Batch {} is being deleted in the background'.format(
+                    batch.name))
+            else:
+                batch.delete()
         except ObjectDoesNotExist:
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
 
@@ -519,6 +568,98 @@ class BatchAdmin(admin.ModelAdmin):
         }
         return super().changelist_view(request, extra_context=c)
 
+    def create_batch_from_csv_upload(self, request, upload_id):
+        """Create a Batch from a CSV file uploaded with csv_upload()
+
+        The POST data contains the same fields as the Batch add form,
+        except that the optional 'filename' field replaces 'csv_file'.
+
+        Returns:
+            JsonResponse with the 'batch_id' of the new Batch and the 'url'
+            of the page to visit next, or the form 'errors' with status 400
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        upload_path = _csv_upload_path(request.user, upload_id)
+        if not os.path.exists(upload_path):
+            return JsonResponse({'error': 'Cannot find upload {}'.format(upload_id)}, status=404)
+
+        filename = os.path.basename(request.POST.get('filename', '')) or \
+            '{}.csv'.format(upload_id)
+        # Locked, so that no chunk is added while the file is read
+        with open(upload_path, 'rb') as f, exclusive_file_lock(f):
+            form = self.get_form(request)(request.POST, {'csv_file': File(f, name=filename)})
+            if not form.is_valid():
+                return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+            with transaction.atomic():
+                obj = self.save_form(request, form, change=False)
+                self.save_model(request, obj, form, change=False)
+                self.save_related(request, form, formsets=[], change=False)
+                self.log_addition(request, obj,
+                                  self.construct_change_message(request, form, None, add=True))
+        os.remove(upload_path)
+        return JsonResponse({'batch_id': obj.id, 'url': self.response_add(request, obj).url})
+
+    def csv_upload(self, request, upload_id):
+        """Receive the next chunk of a CSV file that is uploaded in chunks
+
+        POST appends the request body to the file.  GET returns the number
+        of bytes received so far, so that an interrupted upload can be
+        resumed from that point.  DELETE discards the file.
+
+        Query parameters:
+            offset: (POST only) Position of the chunk in the CSV file, which
+                must match the number of bytes received so far
+
+        Returns:
+            JsonResponse with the 'offset' (number of bytes received so
+            far), with status 409 if the chunk was rejected because of its offset
+        """
+        if request.method not in ('GET', 'POST', 'DELETE'):
+            return HttpResponseNotAllowed(['GET', 'POST', 'DELETE'])
+        if request.method == 'POST':
+            try:
+                chunk_offset = int(request.GET['offset'])
+            except (KeyError, ValueError):
+                return JsonResponse({'error': 'Invalid parameter'}, status=400)
+
+        upload_path = _csv_upload_path(request.user, upload_id)
+        try:
+            # Opened without creating the file, in case it has been deleted
+            f = open(upload_path, 'r+b')
+        except FileNotFoundError:
+            return JsonResponse({'error': 'Cannot find upload {}'.format(upload_id)}, status=404)
+        with f:
+            # Locked, so that concurrent requests for the same upload (such
+            # as a chunk that is retried while the first attempt is still
+            # being received) cannot both pass the offset check
+            with exclusive_file_lock(f):
+                offset = f.seek(0, os.SEEK_END)
+                if request.method == 'GET':
+                    return JsonResponse({'offset': offset})
+                elif request.method == 'POST':
+                    if chunk_offset != offset:
+                        return JsonResponse(
+                            {'error': 'Expected offset {}'.format(offset), 'offset': offset},
+                            status=409)
+                    # The request body is read in pieces, so that the chunk
+                    # is not held in memory
+                    while True:
+                        data = request.read(CSV_UPLOAD_READ_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                    return JsonResponse({'offset': f.tell()})
+        # DELETE, once any chunk that is being received has been written
+        try:
+            os.remove(upload_path)
+        except FileNotFoundError:
+            # Deleted by a concurrent request
+            pass
+        return JsonResponse({})
+
     def download_csv(self, obj):
         download_url = reverse('turkle_admin:download_batch', kwargs={'batch_id': obj.id})
         return format_html('<a href="{}" class="button">CSV results</a>'.format(download_url))
@@ -558,6 +699,20 @@ class BatchAdmin(admin.ModelAdmin):
                 }),
             )
 
+    def get_queryset(self, request):
+        # The per-Batch counts used by the changelist are computed by the
+        # changelist query, using the Tasks' assignment counters.  See
+        # Task._assignment_count_subquery() for an explanation of this subquery syntax.
+        tasks = Task.objects.filter(batch=OuterRef('pk')).order_by().values('batch')
+        return super().get_queryset(request).annotate(
+            finished_assignment_count=Coalesce(Subquery(
+                tasks.annotate(total=Sum('assignments_completed')).values('total'),
+                output_field=models.IntegerField()), 0),
+            task_count=Coalesce(Subquery(
+                tasks.annotate(count=Count('pk')).values('count'),
+                output_field=models.IntegerField()), 0),
+        )
+
     def get_readonly_fields(self, request, obj=None):
         if not obj:
             return []
@@ -571,6 +726,9 @@ class BatchAdmin(admin.ModelAdmin):
                 self.admin_site.admin_view(self.cancel_batch), name='cancel_batch'),
             url(r'^(?P<batch_id>\d+)/review/$',
                 self.admin_site.admin_view(self.review_batch), name='review_batch'),
+            url(r'^(?P<batch_id>\d+)/review/task_ids/$',
+                self.admin_site.admin_view(self.review_batch_task_ids),
+                name='review_batch_task_ids'),
             url(r'^(?P<batch_id>\d+)/publish/$',
                 self.admin_site.admin_view(self.publish_batch), name='publish_batch'),
             url(r'^(?P<batch_id>\d+)/download/$',
@@ -580,6 +738,13 @@ class BatchAdmin(admin.ModelAdmin):
                 name='download_batch_input'),
             url(r'^(?P<batch_id>\d+)/stats/$',
                 self.admin_site.admin_view(self.batch_stats), name='batch_stats'),
+            url(r'^upload/$',
+                self.admin_site.admin_view(self.start_csv_upload), name='start_csv_upload'),
+            url(r'^upload/(?P<upload_id>[0-9a-f]{32})/$',
+                self.admin_site.admin_view(self.csv_upload), name='csv_upload'),
+            url(r'^upload/(?P<upload_id>[0-9a-f]{32})/create/$',
+                self.admin_site.admin_view(self.create_batch_from_csv_upload),
+                name='create_batch_from_csv_upload'),
             url(r'^update_csv_line_endings',
                 self.admin_site.admin_view(self.update_csv_line_endings),
                 name='update_csv_line_endings'),
@@ -599,13 +764,17 @@ class BatchAdmin(admin.ModelAdmin):
 
     def download_batch(self, request, batch_id):
         batch = Batch.objects.get(id=batch_id)
-        csv_output = StringIO()
         if request.session.get('csv_unix_line_endings', False):
-            batch.to_csv(csv_output, lineterminator='\n')
+            lineterminator = '\n'
         else:
-            batch.to_csv(csv_output)
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
+            lineterminator = '\r\n'
+        if get_turkle_background_jobs():
+            Job.enqueue(Job.EXPORT_RESULTS, batch, request.user, lineterminator=lineterminator)
+            messages.info(request, 'The results for Batch {} are being exported in the '
+                                   'background'.format(batch.name))
+            return redirect(_job_changelist_url(batch))
+        csv_lines = batch.to_csv_lines(lineterminator=lineterminator)
+        response = StreamingHttpResponse(csv_lines, content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(
             batch.csv_results_filename())
         return response
@@ -624,6 +793,9 @@ class BatchAdmin(admin.ModelAdmin):
         return response
 
     def response_add(self, request, obj, post_url_continue=None):
+        if get_turkle_background_jobs():
+            # The Batch cannot be reviewed until the Job has created its Tasks
+            return redirect(_job_changelist_url(obj))
         return redirect(reverse('turkle_admin:review_batch', kwargs={'batch_id': obj.id}))
 
     def response_change(self, request, obj):
@@ -640,16 +812,50 @@ class BatchAdmin(admin.ModelAdmin):
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('turkle_admin:turkle_batch_changelist'))
 
-        task_ids = list(batch.task_set.values_list('id', flat=True))
-        task_ids_as_json = json.dumps(task_ids)
+        task_ids = batch.task_set.values_list('id', flat=True)
+        first_task_id = task_ids.order_by('id').first()
+        if first_task_id is None:
+            messages.error(request, 'Batch {} does not have any Tasks'.format(batch.name))
+            return redirect(reverse('turkle_admin:turkle_batch_changelist'))
+        # The IDs of the other Tasks are fetched by the page from review_batch_task_ids()
         return render(request, 'admin/turkle/review_batch.html', {
             'batch_id': batch_id,
-            'first_task_id': task_ids[0],
-            'task_ids_as_json': task_ids_as_json,
+            'first_task_id': first_task_id,
+            'last_task_id': task_ids.order_by('-id').first(),
+            'total_tasks': task_ids.count(),
             'site_header': self.admin_site.site_header,
             'site_title': self.admin_site.site_title,
         })
 
+    def review_batch_task_ids(self, request, batch_id):
+        """Return a page of Task IDs for the Batch review page, as JSON
+
+        Pages are selected by Task ID instead of by offset, so that
+        reading a page takes the same time anywhere in the Batch.
+
+        Query parameters:
+            after: Return the IDs of the Tasks that follow this Task ID
+            before: Return the IDs of the Tasks that precede this Task ID
+            limit: Maximum number of Task IDs to return
+
+        Returns:
+            JsonResponse with a 'task_ids' list of Task IDs in ascending order
+        """
+        try:
+            limit = min(int(request.GET.get('limit', REVIEW_TASK_IDS_LIMIT)),
+                        REVIEW_TASK_IDS_LIMIT)
+            task_ids = Task.objects.filter(batch_id=batch_id).values_list('id', flat=True)
+            if 'before' in request.GET:
+                task_ids = list(task_ids.filter(id__lt=int(request.GET['before'])).
+                                order_by('-id')[:limit])
+                task_ids.reverse()
+            else:
+                task_ids = list(task_ids.filter(id__gt=int(request.GET.get('after', 0))).
+                                order_by('id')[:limit])
+        except ValueError:
+            return JsonResponse({'error': 'Invalid parameter'}, status=400)
+        return JsonResponse({'task_ids': task_ids})
+
     def save_model(self, request, obj, form, change):
         if obj._state.adding:
             if request.user.is_authenticated:
@@ -658,26 +864,32 @@ class BatchAdmin(admin.ModelAdmin):
             # When creating a new batch, set published flag as false until reviewed
             obj.published = False
 
-            # Only use CSV file when adding Batch, not when changing
-            obj.filename = request.FILES['csv_file']._name
-            csv_text = request.FILES['csv_file'].read()
+            # Only use CSV file when adding Batch, not when changing.
+            # The file has already been validated by BatchForm.clean().
+            csv_file = form.cleaned_data['csv_file']
+            obj.filename = csv_file.name
             super().save_model(request, obj, form, change)
             logger.info("User(%i) creating Batch(%i) %s", request.user.id, obj.id, obj.name)
 
-            csv_fh = StringIO(csv_text.decode('utf-8'))
-            csv_fields = set(next(csv.reader(csv_fh)))
-            csv_fh.seek(0)
-
-            template_fields = set(obj.project.fieldnames)
-            if csv_fields != template_fields:
-                csv_but_not_template = csv_fields.difference(template_fields)
-                if csv_but_not_template:
-                    messages.warning(
-                        request,
-                        'The CSV file contained fields that are not in the HTML template. '
-                        'These extra fields are: %s' %
-                        ', '.join(csv_but_not_template))
-            obj.create_tasks_from_csv(csv_fh)
+            csv_but_not_template = getattr(form, 'csv_fields_not_in_template', None)
+            if csv_but_not_template:
+                messages.warning(
+                    request,
+                    'The CSV file contained fields that are not in the HTML template. '
+                    'These extra fields are: %s' %
+                    ', '.join(csv_but_not_template))
+            if get_turkle_background_jobs():
+                job = Job.enqueue(Job.CREATE_TASKS, obj, request.user)
+                job.input_file = 'job-{}-input.csv'.format(job.id)
+                with open(Job.file_path(job.input_file), 'wb') as f:
+                    for chunk in csv_file.chunks():
+                        f.write(chunk)
+                job.save(update_fields=['input_file'])
+                messages.info(request, 'The Tasks for Batch {} are being created in the '
+                                       'background'.format(obj.name))
+            else:
+                with _uploaded_csv_text(csv_file) as csv_fh:
+                    obj.create_tasks_from_csv(csv_fh)
         else:
             super().save_model(request, obj, form, change)
             logger.info("User(%i) updating Batch(%i) %s", request.user.id, obj.id, obj.name)
@@ -695,6 +907,27 @@ class BatchAdmin(admin.ModelAdmin):
             else:
                 for group in get_groups_with_perms(obj):
                     remove_perm('can_work_on_batch', group, obj)
+            Batch.invalidate_access_permitted_cache()
+
+    def start_csv_upload(self, request):
+        """Start uploading a CSV file in chunks
+
+        Uploading a large CSV file in chunks with csv_upload() lets an
+        interrupted upload be resumed.  The chunks are written to a file
+        in the TURKLE_JOB_FILES_DIR directory, and the Batch is created
+        from that file by create_batch_from_csv_upload().
+
+        Returns:
+            JsonResponse with the 'upload_id' used by the other upload URLs
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        upload_id = uuid.uuid4().hex
+        open(_csv_upload_path(request.user, upload_id), 'wb').close()
+        logger.info("User(%i) starting CSV upload %s", request.user.id, upload_id)
+        return JsonResponse({'upload_id': upload_id, 'offset': 0})
 
     def stats(self, obj):
         stats_url = reverse('turkle_admin:batch_stats', kwargs={'batch_id': obj.id})
@@ -828,82 +1061,70 @@ class ProjectAdmin(GuardedModelAdmin):
             messages.error(request, 'Cannot find Project with ID {}'.format(project_id))
             return redirect(reverse('turkle_admin:turkle_project_changelist'))
 
-        tasks = project.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to', 'task__batch_id', 'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_batch = defaultdict(list)
-        task_updated_at_by_batch = defaultdict(list)
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_batch[t['task__batch_id']].append(duration)
-            task_updated_at_by_batch[t['task__batch_id']].append(t['updated_at'])
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
-
-        batch_ids = task_duration_by_batch.keys()
+        rollups = TaskAssignmentRollup.objects.filter(batch__project=project)
+        project_summary = TaskAssignmentRollup.summarize(rollups)
+        batch_summaries = TaskAssignmentRollup.summarize(rollups, group_by='batch_id')
+        user_summaries = TaskAssignmentRollup.summarize(rollups, group_by='user_id')
+
         stats_batches = []
-        for batch in Batch.objects.filter(id__in=batch_ids).order_by('name'):
-            if batch.id in task_duration_by_batch:
-                last_finished_time = task_updated_at_by_batch[batch.id][-1]
-                mean_work_time = '{}s'.format(int(statistics.mean(
-                    task_duration_by_batch[batch.id])))
-                median_work_time = '{}s'.format(int(statistics.median(
-                    task_duration_by_batch[batch.id])))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
+        for batch in Batch.objects.filter(id__in=batch_summaries.keys()).order_by('name'):
+            summary = batch_summaries[batch.id]
             stats_batches.append({
                 'batch_id': batch.id,
                 'name': batch.name,
-                'assignments_completed': len(task_duration_by_batch[batch.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
+                'assignments_completed': summary.assignments_completed,
+                'mean_work_time': '{}s'.format(int(summary.mean_work_time())),
+                'median_work_time': '{}s'.format(int(summary.median_work_time())),
+                'last_finished_time': summary.last_finished_at,
             })
 
-        user_ids = task_duration_by_user.keys()
         stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            if user.id in task_duration_by_user:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = '{}s'.format(int(statistics.mean(
-                    task_duration_by_user[user.id])))
-                median_work_time = '{}s'.format(int(statistics.median(
-                    task_duration_by_user[user.id])))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
+        for user in User.objects.filter(id__in=user_summaries.keys()).order_by('username'):
+            summary = user_summaries[user.id]
             stats_users.append({
                 'username': user.username,
                 'full_name': user.get_full_name(),
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
+                'assignments_completed': summary.assignments_completed,
+                'mean_work_time': '{}s'.format(int(summary.mean_work_time())),
+                'median_work_time': '{}s'.format(int(summary.median_work_time())),
+                'last_finished_time': summary.last_finished_at,
             })
 
-        if tasks:
-            now = datetime.now(timezone.utc)
-            tca_1_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=1))
-            tca_7_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=7))
-            tca_30_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=30))
-            tca_90_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=90))
-            tca_180_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=180))
-            tca_365_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=365))
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
+        if project_summary.assignments_completed:
+            # Rollups cover whole days, so the Task Assignments completed on
+            # the first day of each period are counted individually
+            now = timezone.now()
+            periods = (1, 7, 30, 90, 180, 365)
+            first_days = {days: timezone.localdate(now - timedelta(days=days))
+                          for days in periods}
+            completed_by_day = dict(
+                rollups.filter(day__gt=first_days[365]).
+                order_by().values_list('day').annotate(Sum('assignments_completed')))
+            completed_on_first_days = TaskAssignment.objects.\
+                filter(task__batch__project=project).\
+                filter(completed=True).\
+                filter(rollup_day__in=first_days.values()).\
+                aggregate(**{
+                    'days_{}'.format(days): Count('id', filter=Q(
+                        rollup_day=first_days[days],
+                        updated_at__gte=now - timedelta(days=days)))
+                    for days in periods})
+
+            def completed_since(days):
+                return completed_on_first_days['days_{}'.format(days)] + \
+                    sum(count for (day, count) in completed_by_day.items()
+                        if day > first_days[days])
+            tca_1_day = completed_since(1)
+            tca_7_day = completed_since(7)
+            tca_30_day = completed_since(30)
+            tca_90_day = completed_since(90)
+            tca_180_day = completed_since(180)
+            tca_365_day = completed_since(365)
+            first_finished_time = project_summary.first_finished_at
+            last_finished_time = project_summary.last_finished_at
+            total_work_time = _format_timespan(project_summary.total_work_time)
+            mean_work_time = _format_timespan(int(project_summary.mean_work_time()))
+            median_work_time = _format_timespan(int(project_summary.median_work_time()))
         else:
             tca_1_day = 'N/A'
             tca_7_day = 'N/A'
@@ -919,7 +1140,7 @@ class ProjectAdmin(GuardedModelAdmin):
 
         return render(request, 'admin/turkle/project_stats.html', {
             'project': project,
-            'project_total_completed_assignments': len(tasks),
+            'project_total_completed_assignments': project_summary.assignments_completed,
             'project_total_completed_assignments_1_day': tca_1_day,
             'project_total_completed_assignments_7_day': tca_7_day,
             'project_total_completed_assignments_30_day': tca_30_day,
@@ -970,6 +1191,7 @@ class ProjectAdmin(GuardedModelAdmin):
             else:
                 for group in get_groups_with_perms(obj):
                     remove_perm('can_work_on', group, obj)
+            Batch.invalidate_access_permitted_cache()
 
     def delete_model(self, request, obj):
         logger.info("User(%i) deleting Project(%i) %s", request.user.id, obj.id, obj.name)
@@ -981,8 +1203,69 @@ class ProjectAdmin(GuardedModelAdmin):
                            format(stats_url))
 
 
+class JobAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'job_type', 'batch_name', 'status', 'progress', 'message',
+        'created_by', 'created_at', 'finished_at', 'download_output',
+    )
+    list_filter = ('status', 'job_type')
+    readonly_fields = (
+        'job_type', 'batch', 'batch_name', 'status', 'progress', 'message',
+        'created_by', 'created_at', 'started_at', 'finished_at', 'download_output',
+    )
+    fields = readonly_fields
+
+    def download_job_output(self, request, job_id):
+        try:
+            job = Job.objects.get(id=job_id, status=Job.SUCCEEDED)
+            output = open(Job.file_path(job.output_file), 'rb')
+        except (ObjectDoesNotExist, OSError):
+            messages.error(request, 'Cannot find output file for Job with ID {}'.format(job_id))
+            return redirect(reverse('turkle_admin:turkle_job_changelist'))
+        # Strip the 'job-{id}-' prefix from the name of the output file
+        filename = job.output_file.split('-', 2)[2]
+        return FileResponse(output, as_attachment=True, filename=filename,
+                            content_type='text/csv')
+
+    def download_output(self, obj):
+        if obj.status != Job.SUCCEEDED or not obj.output_file:
+            return ''
+        download_url = reverse('turkle_admin:download_job_output', kwargs={'job_id': obj.id})
+        return format_html('<a href="{}" class="button">Download</a>'.format(download_url))
+    download_output.short_description = 'Output'
+
+    def get_urls(self):
+        urls = super().get_urls()
+        my_urls = [
+            url(r'^(?P<job_id>\d+)/download/$',
+                self.admin_site.admin_view(self.download_job_output),
+                name='download_job_output'),
+        ]
+        return my_urls + urls
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def delete_model(self, request, obj):
+        # Job.delete() removes the Job's input and output files
+        obj.delete()
+
+    def delete_queryset(self, request, queryset):
+        for job in queryset:
+            job.delete()
+
+
+def _job_changelist_url(batch):
+    return '{}?batch__id__exact={}'.format(
+        reverse('turkle_admin:turkle_job_changelist'), batch.id)
+
+
 admin_site = TurkleAdminSite(name='turkle_admin')
 admin_site.register(Group, CustomGroupAdmin)
 admin_site.register(User, CustomUserAdmin)
 admin_site.register(Batch, BatchAdmin)
+admin_site.register(Job, JobAdmin)
 admin_site.register(Project, ProjectAdmin)
@@ -1,7 +1,19 @@
 from django.apps import AppConfig
-from turkle.utils import get_site_name
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, pre_delete
+from turkle.utils import close_unusable_db_connections, configure_sqlite_connection, get_site_name
 
 
 class TurkleAppConfig(AppConfig):
     name = 'turkle'
     verbose_name = get_site_name()
+
+    def ready(self):
+        connection_created.connect(configure_sqlite_connection)
+        request_started.connect(close_unusable_db_connections)
+
+        from django.contrib.auth.models import User
+        from turkle.models import recount_tasks_of_deleted_user, remember_tasks_of_deleted_user
+        pre_delete.connect(remember_tasks_of_deleted_user, sender=User)
+        post_delete.connect(recount_tasks_of_deleted_user, sender=User)
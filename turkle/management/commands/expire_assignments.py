@@ -1,19 +1,54 @@
 from datetime import datetime
 import logging
+import time
 
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
-from turkle.models import TaskAssignment
+from turkle.models import EXPIRE_CHUNK_SIZE, TaskAssignment
 
 
 class Command(BaseCommand):
-    help = ()
+    help = 'Delete abandoned Task Assignments that have expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=EXPIRE_CHUNK_SIZE,
+                            help='Number of Task Assignments to delete per transaction')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Keep running, waking up when the next Task Assignment expires')
+        parser.add_argument('--max-sleep', type=float, default=300.0,
+                            help='In daemon mode, maximum number of seconds to wait '
+                            'before checking again for expired Task Assignments')
 
     def handle(self, *args, **options):
-        t0 = datetime.now()
-        (total_deleted, _) = TaskAssignment.expire_all_abandoned()
-        t = datetime.now()
-        dt = (t - t0).total_seconds()
         logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
-        logging.info('TURKLE: Expired {0} abandoned Task Assignments in {1:.3f} seconds'.
-                     format(total_deleted, dt))
+        while True:
+            t0 = datetime.now()
+            (total_deleted, _) = TaskAssignment.expire_all_abandoned(
+                chunk_size=options['chunk_size'])
+            t = datetime.now()
+            dt = (t - t0).total_seconds()
+            if total_deleted or not options['daemon']:
+                logging.info('TURKLE: Expired {0} abandoned Task Assignments in {1:.3f} seconds'.
+                             format(total_deleted, dt))
+            if not options['daemon']:
+                break
+            time.sleep(self.seconds_until_next_expiration(options['max_sleep']))
+
+    @staticmethod
+    def seconds_until_next_expiration(max_sleep):
+        """
+        Args:
+            max_sleep (float): Upper bound on the returned number of seconds.
+                Task Assignments created after this check are not known
+                to the daemon until it wakes up again.
+
+        Returns:
+            Number of seconds until the next uncompleted Task Assignment
+            expires, between 1 second and max_sleep
+        """
+        next_expiration = TaskAssignment.next_expiration()
+        if next_expiration is None:
+            return max_sleep
+        seconds = (next_expiration - timezone.now()).total_seconds() + 1
+        return min(max(seconds, 1.0), max_sleep)
@@ -0,0 +1,20 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from turkle.models import Job
+from turkle.utils import get_turkle_upload_expiration
+
+
+class Command(BaseCommand):
+    help = 'Delete CSV files uploaded in chunks that were never used to create a Batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=get_turkle_upload_expiration(),
+                            help='Delete uploads that have not received a chunk for this '
+                            'many hours (default: TURKLE_UPLOAD_EXPIRATION)')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        num_deleted = Job.delete_expired_uploads(options['hours'])
+        logging.info('TURKLE: Deleted {0} expired CSV uploads'.format(num_deleted))
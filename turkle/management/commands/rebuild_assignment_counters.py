@@ -0,0 +1,76 @@
+from datetime import datetime
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from turkle.models import Batch, BatchTaskCounts, Task
+
+
+class Command(BaseCommand):
+    help = 'Rebuild and verify the per-Task counts of completed and in-progress ' + \
+        'Task Assignments, the completed status of Tasks, and the per-Batch ' + \
+        'counts of available Tasks.  Exits with an error if any are incorrect.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report Tasks with incorrect counts, do not fix them')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Number of Tasks to update per query')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+
+        if not options['check']:
+            t0 = datetime.now()
+            total_updated = 0
+            chunk_size = options['chunk_size']
+            max_id = Task.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            for start_id in range(0, max_id + 1, chunk_size):
+                tasks = Task.objects.filter(id__gte=start_id, id__lt=start_id + chunk_size)
+                total_updated += Task.recount_assignments(tasks)
+                Task.recompute_completed(tasks)
+            dt = (datetime.now() - t0).total_seconds()
+            logging.info('TURKLE: Rebuilt assignment counters for {0} Tasks in {1:.3f} seconds'.
+                         format(total_updated, dt))
+
+            t0 = datetime.now()
+            total_updated = BatchTaskCounts.recount(Batch.objects.all())
+            dt = (datetime.now() - t0).total_seconds()
+            logging.info('TURKLE: Rebuilt available Task counts for {0} Batches '
+                         'in {1:.3f} seconds'.format(total_updated, dt))
+
+        errors = []
+
+        mismatched = Task.with_incorrect_assignment_counts()
+        total_mismatched = mismatched.count()
+        if total_mismatched:
+            for task_id in mismatched.values_list('id', flat=True)[:100]:
+                logging.warning('TURKLE: Task(%i) has incorrect assignment counters', task_id)
+            errors.append('{0} Tasks have incorrect assignment counters'.
+                          format(total_mismatched))
+        else:
+            logging.info('TURKLE: All assignment counters are correct')
+
+        mismatched = Task.with_incorrect_completed_status()
+        total_mismatched = mismatched.count()
+        if total_mismatched:
+            for task_id in mismatched.values_list('id', flat=True)[:100]:
+                logging.warning('TURKLE: Task(%i) has an incorrect completed status', task_id)
+            errors.append('{0} Tasks have an incorrect completed status'.
+                          format(total_mismatched))
+        else:
+            logging.info('TURKLE: All completed statuses are correct')
+
+        mismatched = BatchTaskCounts.with_incorrect_counts()
+        total_mismatched = mismatched.count()
+        if total_mismatched:
+            for batch_id in mismatched.values_list('batch_id', flat=True)[:100]:
+                logging.warning('TURKLE: Batch(%i) has an incorrect available Task count',
+                                batch_id)
+            errors.append('{0} Batches have incorrect available Task counts'.
+                          format(total_mismatched))
+        else:
+            logging.info('TURKLE: All available Task counts are correct')
+
+        if errors:
+            raise CommandError('; '.join(errors))
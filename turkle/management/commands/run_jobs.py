@@ -0,0 +1,30 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from turkle.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Run background Jobs for creating, exporting and deleting Batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit after running all pending Jobs')
+        parser.add_argument('--sleep', type=float, default=5.0,
+                            help='Seconds to wait before checking again for pending Jobs')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        logging.info('TURKLE: Waiting for background Jobs')
+        while True:
+            job = Job.claim_next()
+            if job:
+                job.run()
+                logging.info('TURKLE: Job({0}) {1} {2}: {3}'.
+                             format(job.id, job.job_type, job.status, job.message))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
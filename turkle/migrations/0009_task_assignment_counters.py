@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:27
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_task_assignments(apps, schema_editor):
+    Task = apps.get_model('turkle', 'Task')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    def count_subquery(completed):
+        return Coalesce(Subquery(
+            TaskAssignment.objects
+            .filter(task=OuterRef('pk'), completed=completed)
+            .order_by().values('task').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()), 0)
+
+    Task.objects.update(
+        assignments_completed=count_subquery(True),
+        assignments_in_progress=count_subquery(False),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0008_fix_multi_assignment_anonymous_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='assignments_completed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='assignments_in_progress',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_task_assignments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:31
+
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def count_available_tasks(apps, schema_editor):
+    Batch = apps.get_model('turkle', 'Batch')
+    BatchTaskCounts = apps.get_model('turkle', 'BatchTaskCounts')
+    Task = apps.get_model('turkle', 'Task')
+
+    BatchTaskCounts.objects.bulk_create(
+        [BatchTaskCounts(batch_id=batch_id)
+         for batch_id in Batch.objects.values_list('id', flat=True)],
+        batch_size=500)
+    BatchTaskCounts.objects.update(available_tasks=Coalesce(Subquery(
+        Task.objects
+        .filter(batch=OuterRef('batch_id'), completed=False)
+        .filter(assignments_in_progress__lt=(
+            F('batch__assignments_per_task') - F('assignments_completed')))
+        .order_by().values('batch').annotate(count=Count('pk')).values('count'),
+        output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0009_task_assignment_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchTaskCounts',
+            fields=[
+                ('available_tasks', models.IntegerField(default=0)),
+                ('batch', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='task_counts', serialize=False, to='turkle.Batch')),
+            ],
+            options={
+                'verbose_name': 'Batch Task Counts',
+                'verbose_name_plural': 'Batch Task Counts',
+            },
+        ),
+        migrations.RunPython(count_available_tasks, migrations.RunPython.noop),
+    ]
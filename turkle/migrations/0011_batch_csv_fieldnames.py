@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+def record_csv_fieldnames(apps, schema_editor):
+    Batch = apps.get_model('turkle', 'Batch')
+    BatchAnswerField = apps.get_model('turkle', 'BatchAnswerField')
+    Task = apps.get_model('turkle', 'Task')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    for batch in Batch.objects.all():
+        input_fieldnames = set()
+        for input_csv_fields in Task.objects.filter(batch=batch).\
+                values_list('input_csv_fields', flat=True).iterator():
+            input_fieldnames.update(input_csv_fields.keys())
+        batch.input_csv_fieldnames = sorted(input_fieldnames)
+        batch.save(update_fields=['input_csv_fieldnames'])
+
+        answer_fieldnames = set()
+        for answers in TaskAssignment.objects.filter(task__batch=batch).\
+                values_list('answers', flat=True).iterator():
+            # If the answers JSONField is empty, it evaluates as a string instead of a dict
+            if answers:
+                answer_fieldnames.update(answers.keys())
+        BatchAnswerField.objects.bulk_create(
+            [BatchAnswerField(batch=batch, name=name) for name in answer_fieldnames])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0010_batch_task_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='input_csv_fieldnames',
+            field=jsonfield.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='BatchAnswerField',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_fields', to='turkle.Batch')),
+            ],
+            options={
+                'verbose_name': 'Batch Answer Field',
+            },
+        ),
+        migrations.RunPython(record_csv_fieldnames, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0011_batch_csv_fieldnames'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_name', models.CharField(blank=True, max_length=1024)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('input_file', models.CharField(blank=True, max_length=1024)),
+                ('job_type', models.CharField(choices=[('create_tasks', 'Create Tasks from CSV file'), ('delete_batch', 'Delete Batch'), ('export_results', 'Export results CSV file')], max_length=32)),
+                ('message', models.TextField(blank=True)),
+                ('output_file', models.CharField(blank=True, max_length=1024)),
+                ('parameters', jsonfield.fields.JSONField(blank=True, default=dict)),
+                ('progress', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16)),
+                ('batch', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='turkle.Batch')),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_jobs', to=settings.AUTH_USER_MODEL, verbose_name='creator')),
+            ],
+            options={
+                'verbose_name': 'Job',
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0012_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskassignment',
+            index=models.Index(fields=['completed', 'expires_at'], name='turkle_task_complet_0ae238_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:54
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def compute_work_times(apps, schema_editor):
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    # Durations are computed in Python, because date arithmetic is not
+    # portable across SQLite, MySQL and PostgreSQL
+    last_id = 0
+    while True:
+        rows = list(TaskAssignment.objects.
+                    filter(completed=True, id__gt=last_id).
+                    order_by('id').
+                    values_list('id', 'created_at', 'updated_at')[:900])
+        if not rows:
+            break
+        ids_by_work_time = defaultdict(list)
+        for (ta_id, created_at, updated_at) in rows:
+            ids_by_work_time[int((updated_at - created_at).total_seconds())].append(ta_id)
+        for work_time, ta_ids in ids_by_work_time.items():
+            TaskAssignment.objects.filter(id__in=ta_ids).update(work_time_seconds=work_time)
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0013_taskassignment_expiration_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskassignment',
+            name='work_time_seconds',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(compute_work_times, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:57
+
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+# Copy of TaskAssignmentRollup.BUCKETS_PER_DOUBLING
+BUCKETS_PER_DOUBLING = 8
+
+
+def bucket_for_work_time(work_time_seconds):
+    if work_time_seconds < 1:
+        return 0
+    return 1 + int(math.log2(work_time_seconds) * BUCKETS_PER_DOUBLING)
+
+
+def build_rollups(apps, schema_editor):
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    TaskAssignmentRollup = apps.get_model('turkle', 'TaskAssignmentRollup')
+
+    rollups = {}
+    last_id = 0
+    while True:
+        rows = list(TaskAssignment.objects.
+                    filter(completed=True, id__gt=last_id).
+                    order_by('id').
+                    values_list('id', 'task__batch_id', 'assigned_to_id', 'updated_at',
+                                'work_time_seconds')[:2000])
+        if not rows:
+            break
+        for (ta_id, batch_id, user_id, updated_at, work_time) in rows:
+            work_time = work_time or 0
+            key = (batch_id, user_id, timezone.localdate(updated_at),
+                   bucket_for_work_time(work_time))
+            if key not in rollups:
+                rollups[key] = TaskAssignmentRollup(
+                    assignments_completed=0,
+                    batch_id=key[0],
+                    day=key[2],
+                    first_finished_at=updated_at,
+                    last_finished_at=updated_at,
+                    user_id=key[1],
+                    work_time_bucket=key[3],
+                    work_time_sum=0)
+            rollup = rollups[key]
+            rollup.assignments_completed += 1
+            rollup.work_time_sum += work_time
+            rollup.first_finished_at = min(rollup.first_finished_at, updated_at)
+            rollup.last_finished_at = max(rollup.last_finished_at, updated_at)
+        last_id = rows[-1][0]
+    TaskAssignmentRollup.objects.bulk_create(rollups.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0014_taskassignment_work_time_seconds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskAssignmentRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('assignments_completed', models.IntegerField(default=0)),
+                ('day', models.DateField()),
+                ('first_finished_at', models.DateTimeField()),
+                ('last_finished_at', models.DateTimeField()),
+                ('work_time_bucket', models.IntegerField()),
+                ('work_time_sum', models.BigIntegerField(default=0)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='turkle.Batch')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Task Assignment Rollup',
+                'unique_together': {('batch', 'user', 'day', 'work_time_bucket')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
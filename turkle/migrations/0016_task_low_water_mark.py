@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:19
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_low_water_marks(apps, schema_editor):
+    BatchTaskCounts = apps.get_model('turkle', 'BatchTaskCounts')
+    Task = apps.get_model('turkle', 'Task')
+
+    for counts in BatchTaskCounts.objects.select_related('batch').iterator():
+        tasks = Task.objects.filter(batch_id=counts.batch_id).order_by('id')
+        low_water_mark = tasks.\
+            filter(completed=False).\
+            filter(assignments_in_progress__lt=(
+                counts.batch.assignments_per_task - F('assignments_completed'))).\
+            values_list('id', flat=True).\
+            first()
+        if low_water_mark is None:
+            # No Tasks are available, so the mark is set past the last Task
+            last_task_id = tasks.reverse().values_list('id', flat=True).first()
+            low_water_mark = last_task_id + 1 if last_task_id else 0
+        BatchTaskCounts.objects.filter(batch_id=counts.batch_id).\
+            update(low_water_mark=low_water_mark)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0015_taskassignmentrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchtaskcounts',
+            name='low_water_mark',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['batch', 'completed', 'id'], name='turkle_task_batch_i_ddfe0d_idx'),
+        ),
+        migrations.RunPython(set_low_water_marks, migrations.RunPython.noop),
+    ]
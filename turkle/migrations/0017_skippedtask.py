@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0016_task_low_water_mark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SkippedTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.Batch')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.Task')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Skipped Task',
+                'unique_together': {('user', 'batch', 'task')},
+            },
+        ),
+    ]
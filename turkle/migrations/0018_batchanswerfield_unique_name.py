@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-17 08:01
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_answer_field_names(apps, schema_editor):
+    BatchAnswerField = apps.get_model('turkle', 'BatchAnswerField')
+
+    seen = set()
+    duplicate_ids = []
+    for answer_field in BatchAnswerField.objects.order_by('id').iterator():
+        name_hash = hashlib.sha1(answer_field.name.encode('utf-8')).hexdigest()
+        if (answer_field.batch_id, name_hash) in seen:
+            duplicate_ids.append(answer_field.id)
+        else:
+            seen.add((answer_field.batch_id, name_hash))
+            BatchAnswerField.objects.filter(id=answer_field.id).update(name_hash=name_hash)
+    BatchAnswerField.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0017_skippedtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchanswerfield',
+            name='name_hash',
+            field=models.CharField(default='', max_length=40),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_answer_field_names, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='batchanswerfield',
+            unique_together={('batch', 'name_hash')},
+        ),
+    ]
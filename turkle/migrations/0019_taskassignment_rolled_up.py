@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-17 08:10
+
+from django.db import migrations, models
+
+
+def mark_completed_assignments_rolled_up(apps, schema_editor):
+    # The rollups already include every completed TaskAssignment
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    TaskAssignment.objects.filter(completed=True).update(rolled_up=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0018_batchanswerfield_unique_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskassignment',
+            name='rolled_up',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_completed_assignments_rolled_up, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='taskassignment',
+            index=models.Index(fields=['completed', 'rolled_up'], name='turkle_task_complet_f667bb_idx'),
+        ),
+    ]
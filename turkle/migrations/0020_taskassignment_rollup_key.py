@@ -0,0 +1,100 @@
+# Generated by Django 2.2.28 on 2026-10-17 08:51
+
+from collections import defaultdict
+import math
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# Copy of TaskAssignmentRollup.BUCKETS_PER_DOUBLING
+BUCKETS_PER_DOUBLING = 8
+
+
+def bucket_for_work_time(work_time_seconds):
+    if work_time_seconds < 1:
+        return 0
+    return 1 + int(math.log2(work_time_seconds) * BUCKETS_PER_DOUBLING)
+
+
+def record_rollup_keys(apps, schema_editor):
+    # Completed TaskAssignments were added to the rollups for the day of
+    # their updated_at field - by migration 0015, or later when they were
+    # rolled up.  The ones that were not rolled up yet are added now.
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    TaskAssignmentRollup = apps.get_model('turkle', 'TaskAssignmentRollup')
+
+    pending_rollups = {}
+    last_id = 0
+    while True:
+        rows = list(TaskAssignment.objects.
+                    filter(completed=True, id__gt=last_id).
+                    order_by('id').
+                    values_list('id', 'task__batch_id', 'assigned_to_id', 'updated_at',
+                                'work_time_seconds', 'rolled_up')[:2000])
+        if not rows:
+            break
+        ids_by_key = defaultdict(list)
+        for (ta_id, batch_id, user_id, updated_at, work_time, rolled_up) in rows:
+            work_time = work_time or 0
+            day = timezone.localdate(updated_at)
+            bucket = bucket_for_work_time(work_time)
+            ids_by_key[(day, bucket)].append(ta_id)
+            if not rolled_up:
+                key = (batch_id, user_id, day, bucket)
+                if key not in pending_rollups:
+                    pending_rollups[key] = [0, 0, updated_at, updated_at]
+                rollup = pending_rollups[key]
+                rollup[0] += 1
+                rollup[1] += work_time
+                rollup[2] = min(rollup[2], updated_at)
+                rollup[3] = max(rollup[3], updated_at)
+        for (day, bucket), ta_ids in ids_by_key.items():
+            TaskAssignment.objects.filter(id__in=ta_ids).\
+                update(rollup_day=day, rollup_work_time_bucket=bucket)
+        last_id = rows[-1][0]
+
+    for (batch_id, user_id, day, bucket), rollup in pending_rollups.items():
+        existing = TaskAssignmentRollup.objects.filter(
+            batch_id=batch_id, user_id=user_id, day=day, work_time_bucket=bucket).first()
+        if existing is None:
+            existing = TaskAssignmentRollup(
+                batch_id=batch_id, user_id=user_id, day=day, work_time_bucket=bucket,
+                first_finished_at=rollup[2], last_finished_at=rollup[3])
+        existing.assignments_completed += rollup[0]
+        existing.work_time_sum += rollup[1]
+        existing.first_finished_at = min(existing.first_finished_at, rollup[2])
+        existing.last_finished_at = max(existing.last_finished_at, rollup[3])
+        existing.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0019_taskassignment_rolled_up'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskassignment',
+            name='rollup_day',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='taskassignment',
+            name='rollup_work_time_bucket',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(record_rollup_keys, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='taskassignment',
+            name='turkle_task_complet_f667bb_idx',
+        ),
+        migrations.RemoveField(
+            model_name='taskassignment',
+            name='rolled_up',
+        ),
+        migrations.AddIndex(
+            model_name='taskassignment',
+            index=models.Index(fields=['rollup_day'], name='turkle_task_rollup__4d951a_idx'),
+        ),
+    ]
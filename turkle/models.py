@@ -1,28 +1,77 @@
+from collections import Counter, defaultdict
 import csv
 import ctypes
 import datetime
+import hashlib
+import itertools
 import logging
+import math
 import os.path
 import re
-import statistics
 import sys
+import time
+import uuid
 
 from bs4 import BeautifulSoup
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery
-from django.db.models.functions import Coalesce
+from django.db import connection, models, transaction
+from django.db.models import (Avg, Case, Count, Exists, F, IntegerField, Max, Min, OuterRef, Q,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Greatest, Least
 from django.utils import timezone
-from guardian.core import ObjectPermissionChecker
 from guardian.models import GroupObjectPermission
-from guardian.shortcuts import assign_perm, get_group_perms, get_groups_with_perms
+from guardian.shortcuts import (assign_perm, get_group_perms, get_groups_with_perms,
+                                get_objects_for_user)
+from guardian.utils import get_anonymous_user
 from jsonfield import JSONField
 
-from .utils import get_turkle_template_limit
+from .utils import (exclusive_file_lock, get_turkle_job_files_dir,
+                    get_turkle_permission_cache_timeout, get_turkle_task_creation_chunk_size,
+                    get_turkle_template_limit)
 
 logger = logging.getLogger(__name__)
 
+ACCESS_PERMITTED_CACHE_VERSION_KEY = 'turkle.permitted_batch_ids.version'
+
+# Seconds that the answer field names recorded for a Batch are cached,
+# see BatchAnswerField.add_names()
+ANSWER_FIELD_NAMES_CACHE_TIMEOUT = 3600
+
+# Matches template variables such as '${foo}', capturing the variable name
+TEMPLATE_VARIABLE_RE = re.compile(r'\$\{([^${}]*)\}')
+
+# Matches a template variable nested inside an unclosed '${', such as the
+# '${bar}' in '${foo${bar}}'.  Replacing the inner variable can create
+# a new template variable.
+NESTED_TEMPLATE_VARIABLE_RE = re.compile(r'\$\{[^${}]*\$\{[^${}]*\}')
+
+# Characters that can form new template variables when inserted into a template
+TEMPLATE_SPECIAL_CHARACTERS_RE = re.compile(r'[${}]')
+
+# Compiled Project HTML templates, see Project.compiled_html_template_for()
+_compiled_html_templates = {}
+
+# Number of TaskAssignments read from the database at a time when exporting results
+RESULTS_CHUNK_SIZE = 2000
+
+# Maximum number of expired TaskAssignments deleted per transaction
+EXPIRE_CHUNK_SIZE = 500
+
+# Maximum number of Tasks recounted per query when a User is deleted
+RECOUNT_CHUNK_SIZE = 500
+
+
+class _EchoBuffer(object):
+    """File-like object that returns the value written instead of storing it
+
+    Used with csv.writer to generate CSV output one line at a time.
+    """
+    def write(self, value):
+        return value
+
+
 C_LONG_NUM_BITS = 8 * ctypes.sizeof(ctypes.c_long)
 C_LONG_MAX = 2 ** (C_LONG_NUM_BITS-1) - 1
 
@@ -43,25 +92,28 @@ class TaskAssignmentStatistics(object):
         Returns:
             Float for mean work time (in seconds) for completed Tasks in this Batch
         """
-        finished_assignments = self.finished_task_assignments()
-        if finished_assignments.count() > 0:
-            return statistics.mean(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
-        else:
-            return 0
+        return self.finished_task_assignments().\
+            aggregate(mean=Avg('work_time_seconds'))['mean'] or 0
 
     def median_work_time_in_seconds(self):
         """
         Returns:
             Integer for median work time (in seconds) for completed Tasks in this Batch
         """
-        if self.finished_task_assignments().count() > 0:
-            # np.median returns float but we convert back to int computed by work_time_in_seconds()
-            return int(statistics.median(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()]
-            ))
-        else:
+        finished_assignments = self.finished_task_assignments().\
+            filter(work_time_seconds__isnull=False)
+        count = finished_assignments.count()
+        if count == 0:
             return 0
+        # Only the one or two middle values are read from the database
+        work_times = finished_assignments.\
+            order_by('work_time_seconds').\
+            values_list('work_time_seconds', flat=True)
+        middle = (count - 1) // 2
+        if count % 2:
+            return work_times[middle]
+        lower, upper = work_times[middle:middle + 2]
+        return int((lower + upper) / 2)
 
     def total_work_time_in_seconds(self):
         """
@@ -69,19 +121,134 @@ class TaskAssignmentStatistics(object):
             Integer sum of work_time_in_seconds() for all completed
             TaskAssignments in this Batch
         """
-        return sum([ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
+        return self.finished_task_assignments().\
+            aggregate(total=Sum('work_time_seconds'))['total'] or 0
 
 
 class Task(models.Model):
     """Human Intelligence Task
     """
     class Meta:
+        indexes = [
+            models.Index(fields=['batch', 'completed', 'id']),
+        ]
         verbose_name = "Task"
 
+    # Live counts of this Task's TaskAssignments.  The counters are
+    # updated with UPDATE queries by TaskAssignment.save() and
+    # TaskAssignment.delete(), recounted when a User is deleted (see
+    # recount_tasks_of_deleted_user()), and are never written by Task.save().
+    ASSIGNMENT_COUNTER_FIELDS = ('assignments_completed', 'assignments_in_progress')
+
+    assignments_completed = models.IntegerField(default=0)
+    assignments_in_progress = models.IntegerField(default=0)
     batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
     completed = models.BooleanField(default=False)
     input_csv_fields = JSONField()
 
+    @classmethod
+    def recount_assignments(cls, task_queryset):
+        """Recompute the TaskAssignment counters from the TaskAssignment table
+
+        Args:
+            task_queryset (QuerySet): Tasks whose counters should be recomputed
+
+        Returns:
+            Number of Tasks updated
+        """
+        return task_queryset.update(
+            assignments_completed=cls._assignment_count_subquery(completed=True),
+            assignments_in_progress=cls._assignment_count_subquery(completed=False),
+        )
+
+    @classmethod
+    def recompute_completed(cls, task_queryset):
+        """Recompute the completed status of Tasks from their assignment counters
+
+        A Task is completed when it has assignments_per_task completed
+        TaskAssignments.
+
+        Args:
+            task_queryset (QuerySet): Tasks whose completed status should be recomputed
+
+        Returns:
+            Number of Tasks updated
+        """
+        return task_queryset.update(completed=Case(
+            When(assignments_completed__gte=cls._assignments_per_task_subquery(),
+                 then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField()))
+
+    @classmethod
+    def with_incorrect_completed_status(cls):
+        """
+        Returns:
+            QuerySet of all Tasks whose completed status does not match
+            their number of completed TaskAssignments
+        """
+        return cls.objects.\
+            annotate(assignments_per_task=cls._assignments_per_task_subquery()).\
+            filter(Q(completed=True, assignments_completed__lt=F('assignments_per_task')) |
+                   Q(completed=False, assignments_completed__gte=F('assignments_per_task')))
+
+    @classmethod
+    def with_incorrect_assignment_counts(cls):
+        """
+        Returns:
+            QuerySet of all Tasks whose TaskAssignment counters do not match
+            the contents of the TaskAssignment table
+        """
+        return cls.objects.\
+            annotate(actual_completed=cls._assignment_count_subquery(completed=True)).\
+            annotate(actual_in_progress=cls._assignment_count_subquery(completed=False)).\
+            exclude(assignments_completed=F('actual_completed'),
+                    assignments_in_progress=F('actual_in_progress'))
+
+    @staticmethod
+    def _assignments_per_task_subquery():
+        return Subquery(
+            Batch.objects.filter(id=OuterRef('batch_id')).values('assignments_per_task'))
+
+    @staticmethod
+    def _assignment_count_subquery(completed):
+        # Django does not easily support aggregations (such as Count) using subqueries:
+        #   https://code.djangoproject.com/ticket/28296
+        # The Django documentation states that:
+        #  "Aggregates may be used within a Subquery, but they require a specific
+        #   combination of filter(), values(), and annotate() to get the subquery
+        #   grouping correct."
+        #     https://docs.djangoproject.com/en/2.2/ref/models/expressions/#using-aggregates-within-a-subquery-expression
+        # The specific syntax we use here for count subqueries is adapted from:
+        #   https://github.com/martsberger/django-sql-utils
+        # where we are using the pattern:
+        #   subquery = Subquery(Child.objects.filter(parent_id=OuterRef('id')).order_by()
+        #                      .values('parent').annotate(count=Count('pk'))
+        #                      .values('count'), output_field=IntegerField())
+        #   Parent.objects.annotate(child_count=Coalesce(subquery, 0))
+        return Coalesce(Subquery(
+            TaskAssignment.objects
+            .filter(task=OuterRef('pk'), completed=completed)
+            .order_by().values('task').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()), 0)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                if isinstance(self.input_csv_fields, dict):
+                    self.batch.add_input_csv_fieldnames(self.input_csv_fields.keys())
+                if not self.completed:
+                    BatchTaskCounts.objects.filter(batch_id=self.batch_id).\
+                        update(available_tasks=F('available_tasks') + 1)
+        else:
+            if 'update_fields' not in kwargs:
+                kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name not in self.ASSIGNMENT_COUNTER_FIELDS
+                ]
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return 'Task id:{}'.format(self.id)
 
@@ -92,60 +259,328 @@ class Task(models.Model):
             String containing the HTML template for the Project associated with
             this Task, with all template variables replaced with the template
             variable values stored in this Task's input_csv_fields.
+            The result is the same as replacing each CSV field's template
+            variable in turn, but when no replacement can form a new
+            template variable, the values are inserted in a single pass.
         """
-        result = self.batch.project.html_template
-        for field in self.input_csv_fields.keys():
-            result = result.replace(
-                r'${' + field + r'}',
-                self.input_csv_fields[field]
-            )
-        return result
+        if Task.batch.is_cached(self) and Batch.project.is_cached(self.batch):
+            project = self.batch.project
+            compiled_template, single_pass = Project.compiled_html_template_for(
+                project.id, project.updated_at, project.html_template)
+        else:
+            project_id, updated_at = Project.objects.filter(batch=self.batch_id).\
+                values_list('id', 'updated_at').get()
+            compiled_template, single_pass = Project.compiled_html_template_for(
+                project_id, updated_at)
+
+        fields = self.input_csv_fields
+        if not single_pass or any(TEMPLATE_SPECIAL_CHARACTERS_RE.search(k) or
+                                  TEMPLATE_SPECIAL_CHARACTERS_RE.search(v)
+                                  for k, v in fields.items()):
+            # Substituted values can form new template variables, which are
+            # replaced by the CSV fields that come later in the row
+            result = ''.join(
+                segment if i % 2 == 0 else '${' + segment + '}'
+                for i, segment in enumerate(compiled_template))
+            for field in fields.keys():
+                result = result.replace(r'${' + field + r'}', fields[field])
+            return result
+
+        # Template variables without a matching CSV field are left unchanged
+        return ''.join(
+            segment if i % 2 == 0 else fields.get(segment, '${' + segment + '}')
+            for i, segment in enumerate(compiled_template)
+        )
 
 
 class TaskAssignment(models.Model):
     """Task Assignment
     """
     class Meta:
+        indexes = [
+            models.Index(fields=['completed', 'expires_at']),
+            models.Index(fields=['rollup_day']),
+        ]
         verbose_name = "Task Assignment"
 
+    # Fields that are only written when the TaskAssignment is completed,
+    # by a conditional UPDATE (see save())
+    COMPLETION_FIELDS = ('completed', 'rollup_day', 'rollup_work_time_bucket',
+                         'work_time_seconds')
+
     answers = JSONField(blank=True)
     assigned_to = models.ForeignKey(User, db_index=True, null=True, on_delete=models.CASCADE)
     completed = models.BooleanField(db_index=True, default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True)
+    # The day and work time bucket of the TaskAssignmentRollup that this
+    # TaskAssignment was added to when it was completed
+    rollup_day = models.DateField(null=True)
+    rollup_work_time_bucket = models.IntegerField(null=True)
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     updated_at = models.DateTimeField(auto_now=True)
+    # Seconds elapsed between Task assignment and submission, set when completed
+    work_time_seconds = models.IntegerField(null=True)
+
+    @classmethod
+    def expire_all_abandoned(cls, chunk_size=EXPIRE_CHUNK_SIZE):
+        """Delete all uncompleted TaskAssignments that have expired
+
+        TaskAssignments are deleted in chunks, each in its own short
+        transaction, so that Workers accepting and submitting Tasks are
+        not blocked while a large number of TaskAssignments are expired.
+        The counters of the affected Tasks and Batches are decremented
+        instead of being recounted.
+
+        Args:
+            chunk_size (int): Maximum number of TaskAssignments deleted
+                per transaction
+
+        Returns:
+            Tuple with the total number of TaskAssignments deleted and a
+            dict with the number deleted per model, like QuerySet.delete()
+        """
+        now = timezone.now()
+        expired = cls.objects.\
+            filter(completed=False).\
+            filter(expires_at__lt=now)
+        total_deleted = 0
+        while True:
+            with transaction.atomic():
+                # Locked, so that the TaskAssignments cannot be submitted
+                # between being selected and being deleted
+                rows = list(expired.order_by('expires_at').select_for_update().
+                            values_list('id', 'task_id')[:chunk_size])
+                if not rows:
+                    break
+                num_deleted, _ = cls.objects.\
+                    filter(id__in=[row[0] for row in rows]).\
+                    filter(completed=False).\
+                    delete()
+                # Tasks are updated in ID order, so that concurrent calls
+                # cannot deadlock
+                num_deleted_per_task = Counter(task_id for _, task_id in rows)
+                if num_deleted < len(rows):
+                    # Some of the TaskAssignments were submitted or deleted
+                    # after being selected, which can only happen on
+                    # backends that ignore FOR UPDATE, so it is not known
+                    # which Tasks lost a TaskAssignment
+                    task_ids = sorted(num_deleted_per_task)
+                    Task.recount_assignments(Task.objects.filter(id__in=task_ids))
+                    BatchTaskCounts.recount(Batch.objects.filter(
+                        id__in=Task.objects.filter(id__in=task_ids).values('batch_id')))
+                    num_deleted_per_task = {}
+                for task_id in sorted(num_deleted_per_task):
+                    num_task_deleted = num_deleted_per_task[task_id]
+                    Task.objects.filter(id=task_id).update(
+                        assignments_in_progress=F('assignments_in_progress') - num_task_deleted)
+                    BatchTaskCounts.update_for_task(task_id, -num_task_deleted)
+            total_deleted += num_deleted
+            if len(rows) < chunk_size:
+                break
+        return total_deleted, {cls._meta.label: total_deleted}
 
     @classmethod
-    def expire_all_abandoned(cls):
-        result = cls.objects.\
+    def reclaim_expired_for(cls, task_id):
+        """Delete the uncompleted TaskAssignments for a Task that have expired
+
+        The Task's assignment counters are updated.  Must be called inside
+        a transaction, after the Task's row has been locked.
+
+        Args:
+            task_id (int): ID of Task
+
+        Returns:
+            Number of TaskAssignments deleted
+        """
+        expired = cls.objects.\
+            filter(task_id=task_id).\
             filter(completed=False).\
-            filter(expires_at__lt=timezone.now()).\
-            delete()
-        logger.info('Expired %i task assignments', result[0])
+            filter(expires_at__lt=timezone.now())
+        num_deleted = 0
+        for task_assignment in expired:
+            task_assignment.delete()
+            num_deleted += 1
+        return num_deleted
+
+    @classmethod
+    def held_by(cls, user, now=None):
+        """Retrieve the TaskAssignments that keep their Tasks from being assigned to the user
+
+        When a Batch has more than one assignment per Task, each Task can
+        only be assigned to a user once.  A user's expired, uncompleted
+        TaskAssignment does not count, since the user can reclaim it like
+        any other expired TaskAssignment.
+
+        Args:
+            user (User):
+            now (datetime): Optional time at which TaskAssignments expire
+
+        Returns:
+            QuerySet of the user's TaskAssignments that are completed or
+            have not expired
+        """
+        if now is None:
+            now = timezone.now()
+        return cls.objects.\
+            filter(assigned_to_id=user.id).\
+            filter(Q(completed=True) | Q(expires_at__gte=now) | Q(expires_at__isnull=True))
+
+    @classmethod
+    def next_expiration(cls):
+        """
+        Returns:
+            The datetime when the next uncompleted TaskAssignment expires,
+            or None if there are no uncompleted TaskAssignments
+        """
+        return cls.objects.\
+            filter(completed=False).\
+            order_by('expires_at').\
+            values_list('expires_at', flat=True).\
+            first()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the saved value of 'completed', so that the Task's
+        # assignment counters can be updated when it changes
+        instance._completed_in_db = instance.completed
+        return instance
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            # This copy of the TaskAssignment may be stale - it may have
+            # been submitted or even deleted since it was loaded - so the
+            # counters and rollups are updated from the locked row
+            row = TaskAssignment.objects.\
+                select_for_update().\
+                filter(id=self.id).\
+                values_list(*self.COMPLETION_FIELDS).\
+                first()
+            if row is None:
+                return 0, {self._meta.label: 0}
+            for name, value in zip(self.COMPLETION_FIELDS, row):
+                setattr(self, name, value)
+            self._completed_in_db = self.completed
+            result = super().delete(*args, **kwargs)
+            if not result[0]:
+                return result
+            self._update_task_counters(-1 if self.completed else 0,
+                                       0 if self.completed else -1)
+            if self.completed:
+                TaskAssignmentRollup.remove_task_assignment(self)
         return result
 
     def save(self, *args, **kwargs):
-        self.expires_at = timezone.now() + \
-            datetime.timedelta(hours=self.task.batch.allotted_assignment_time)
+        if self._state.adding and self.expires_at is None:
+            allotted_assignment_time = Batch.objects.filter(task=self.task_id).\
+                values_list('allotted_assignment_time', flat=True).get()
+            self.expires_at = timezone.now() + \
+                datetime.timedelta(hours=allotted_assignment_time)
 
         if 'csrfmiddlewaretoken' in self.answers:
             del self.answers['csrfmiddlewaretoken']
-        super().save(*args, **kwargs)
 
-        # Mark Task as completed if all Assignments have been completed
-        if self.task.taskassignment_set.filter(completed=True).count() >= \
-           self.task.batch.assignments_per_task:
-            self.task.completed = True
-            self.task.save()
+        if self.completed and self.work_time_seconds is None:
+            if self.created_at is None:
+                # created_at and updated_at are both set to the current time
+                self.work_time_seconds = 0
+            else:
+                self.work_time_seconds = int((timezone.now() - self.created_at).total_seconds())
+
+        completed_in_db = getattr(self, '_completed_in_db', None)
+        completed_changing = completed_in_db is not None and completed_in_db != self.completed
+        if self.completed and (completed_in_db is None or completed_changing):
+            self.rollup_day = timezone.localdate()
+            self.rollup_work_time_bucket = TaskAssignmentRollup.bucket_for_work_time(
+                self.work_time_seconds or 0)
+        if not self._state.adding and self.pk is not None and \
+           kwargs.get('update_fields') is None:
+            # Another copy of this TaskAssignment may have been completed
+            # since this copy was loaded, so the COMPLETION_FIELDS are only
+            # written by a conditional UPDATE (see below)
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COMPLETION_FIELDS]
+            if completed_changing:
+                kwargs['update_fields'] += \
+                    self.COMPLETION_FIELDS if self.completed else ('completed',)
+
+        # No savepoint is needed, since nothing here catches database errors
+        with transaction.atomic(savepoint=False):
+            completed_changed = False
+            if completed_changing and 'completed' in (kwargs.get('update_fields') or ()):
+                # Only the copy of the TaskAssignment that changes the saved
+                # value of completed updates the Task's counters and the
+                # rollups.  When uncompleting, the rollup values must also be
+                # unchanged, since they are used to remove the TaskAssignment
+                # from the rollups.
+                if self.completed:
+                    expected_values = {'completed': False}
+                else:
+                    expected_values = {name: getattr(self, name)
+                                       for name in self.COMPLETION_FIELDS}
+                    expected_values['completed'] = True
+                completed_changed = self._update_if_unchanged(
+                    expected_values, kwargs['update_fields'])
+                if not completed_changed:
+                    # Another copy changed it first, so only the other fields are saved
+                    kwargs['update_fields'] = [
+                        name for name in kwargs['update_fields']
+                        if name not in self.COMPLETION_FIELDS]
+                    super().save(*args, **kwargs)
+                    self.refresh_from_db(fields=self.COMPLETION_FIELDS)
+            else:
+                super().save(*args, **kwargs)
+            self._completed_in_db = self.completed
+
+            if completed_in_db is None:
+                self._update_task_counters(1 if self.completed else 0,
+                                           0 if self.completed else 1)
+                if self.completed:
+                    # Mark Task as completed if all Assignments have been completed
+                    Task.objects.\
+                        filter(id=self.task_id, completed=False).\
+                        filter(assignments_completed__gte=Subquery(
+                            Batch.objects.filter(id=OuterRef('batch_id')).
+                            values('assignments_per_task'))).\
+                        update(completed=True)
+                    TaskAssignmentRollup.add_task_assignment(self)
+            elif completed_changed:
+                # Submitting also marks the Task as completed when needed
+                self._update_task_counters(1 if self.completed else -1,
+                                           -1 if self.completed else 1)
+                if self.completed:
+                    TaskAssignmentRollup.add_task_assignment(self)
+                else:
+                    TaskAssignmentRollup.remove_task_assignment(self)
+
+            # If the answers JSONField is empty, it evaluates as a string instead of a dict
+            if isinstance(self.answers, dict) and self.answers:
+                BatchAnswerField.add_names(self.task_batch_id(), self.answers.keys())
+
+    def task_batch_id(self):
+        """
+        Returns:
+            ID (int) of the Batch of this TaskAssignment's Task.  The ID is
+            read from the database only if the Task has not been loaded.
+        """
+        if TaskAssignment.task.is_cached(self):
+            return self.task.batch_id
+        if getattr(self, '_batch_id', None) is None:
+            self._batch_id = Task.objects.filter(id=self.task_id).\
+                values_list('batch_id', flat=True).get()
+        return self._batch_id
 
     def work_time_in_seconds(self):
         """Return number of seconds elapsed between Task assignment and submission
 
-        We compute the time elapsed in Python instead of in SQL
-        because "there are no native date/time fields in SQLite and
-        Django currently emulates these features using a text field,"
-        per the Django Docs:
+        The time elapsed is stored in the work_time_seconds field when
+        the TaskAssignment is completed, so that statistics can be
+        computed by the database.  We compute the time elapsed in Python
+        instead of in SQL because "there are no native date/time fields
+        in SQLite and Django currently emulates these features using a
+        text field," per the Django Docs:
           https://docs.djangoproject.com/en/2.1/ref/models/querysets/#aggregation-functions
 
         Returns:
@@ -155,12 +590,86 @@ class TaskAssignment(models.Model):
             ValueError if TaskAssignment is not completed
         """
         if self.completed:
+            if self.work_time_seconds is not None:
+                return self.work_time_seconds
             return int((self.updated_at - self.created_at).total_seconds())
         else:
             raise ValueError(
                 'Cannot compute work_time_in_seconds for incomplete TaskAssignment %d' %
                 self.id)
 
+    def _update_if_unchanged(self, expected_values, update_fields):
+        """Save the fields of this TaskAssignment if its row has the expected values
+
+        Args:
+            expected_values (dict): Maps field names to the values that the row must have
+            update_fields (list): Names of the fields to save
+
+        Returns:
+            True if the row was updated
+        """
+        values = {field.attname: field.pre_save(self, False)
+                  for field in self._meta.concrete_fields if field.name in update_fields}
+        return TaskAssignment.objects.\
+            filter(id=self.id, **expected_values).\
+            update(**values) > 0
+
+    def _update_task_counters(self, completed_delta, in_progress_delta):
+        """Apply changes to the assignment counters of this TaskAssignment's Task
+
+        If the change makes the Task unavailable (or available again),
+        the Batch's BatchTaskCounts are also updated.
+        """
+        total_delta = completed_delta + in_progress_delta
+        updates = {}
+        if completed_delta > 0 and total_delta == 0:
+            # When a TaskAssignment is submitted, the Task is completed if this is
+            # the last TaskAssignment the Task needs.  MySQL assigns columns from
+            # left to right, so 'completed' must be updated before
+            # 'assignments_completed' for both to use the previous count.
+            assignments_per_task = Subquery(
+                Batch.objects.filter(id=OuterRef('batch_id')).values('assignments_per_task'))
+            updates['completed'] = Case(
+                When(assignments_completed__gte=assignments_per_task - completed_delta,
+                     then=Value(True)),
+                default=F('completed'),
+                output_field=models.BooleanField())
+        updates['assignments_completed'] = F('assignments_completed') + completed_delta
+        updates['assignments_in_progress'] = F('assignments_in_progress') + in_progress_delta
+        Task.objects.filter(id=self.task_id).update(**updates)
+
+        # Submitting a TaskAssignment does not change the number of TaskAssignments
+        if total_delta:
+            BatchTaskCounts.update_for_task(self.task_id, total_delta)
+
+
+def remember_tasks_of_deleted_user(sender, instance, **kwargs):
+    """pre_delete receiver for User that records the Tasks assigned to the User
+
+    Deleting a User deletes the User's TaskAssignments without calling
+    TaskAssignment.delete(), so the Tasks' assignment counters and their
+    Batches' BatchTaskCounts are recomputed by recount_tasks_of_deleted_user().
+    """
+    assigned_tasks = TaskAssignment.objects.\
+        filter(assigned_to=instance).\
+        order_by().\
+        values_list('task_id', 'task__batch_id').\
+        distinct()
+    instance._turkle_assigned_task_ids = [task_id for task_id, _ in assigned_tasks]
+    instance._turkle_assigned_batch_ids = {batch_id for _, batch_id in assigned_tasks}
+
+
+def recount_tasks_of_deleted_user(sender, instance, **kwargs):
+    """post_delete receiver for User that recounts the Tasks assigned to the User
+    """
+    task_ids = getattr(instance, '_turkle_assigned_task_ids', [])
+    for start in range(0, len(task_ids), RECOUNT_CHUNK_SIZE):
+        Task.recount_assignments(
+            Task.objects.filter(id__in=task_ids[start:start + RECOUNT_CHUNK_SIZE]))
+    batch_ids = getattr(instance, '_turkle_assigned_batch_ids', set())
+    if batch_ids:
+        BatchTaskCounts.recount(Batch.objects.filter(id__in=batch_ids))
+
 
 class Batch(TaskAssignmentStatistics, models.Model):
     class Meta:
@@ -178,6 +687,8 @@ class Batch(TaskAssignmentStatistics, models.Model):
                                    on_delete=models.CASCADE, verbose_name='creator')
     custom_permissions = models.BooleanField(default=False)
     filename = models.CharField(max_length=1024)
+    # Names of the fields in the input_csv_fields of this Batch's Tasks
+    input_csv_fieldnames = JSONField(blank=True, default=list)
     login_required = models.BooleanField(db_index=True, default=True)
     name = models.CharField(max_length=1024)
     project = models.ForeignKey('Project', on_delete=models.CASCADE)
@@ -189,22 +700,72 @@ class Batch(TaskAssignmentStatistics, models.Model):
 
         Both the Batch and the Project associated the Batch must be active.
 
+        The permission rules are evaluated by the database, so the
+        returned QuerySet can be further filtered or combined with other
+        queries without loading any Batch objects.
+
         Args:
             user (User):
 
         Returns:
-            List of Batch objects this user can access
+            QuerySet of Batch objects this user can access
         """
         batches = cls.objects.filter(active=True).filter(published=True)\
             .filter(project__active=True)
         if not user.is_authenticated:
             batches = batches.filter(login_required=False)
+            # Permissions for anonymous users are assigned to Guardian's anonymous User
+            user = get_anonymous_user()
+
+        if not user.is_active:
+            return batches.none()
+        elif user.is_superuser:
+            return batches
+        else:
+            permitted_batches = get_objects_for_user(
+                user, 'turkle.can_work_on_batch', klass=cls,
+                accept_global_perms=False, with_superuser=False)
+            return batches.filter(
+                Q(custom_permissions=False) | Q(id__in=permitted_batches.values('id')))
 
-        # Can implement our own prefetch_perms() in future for efficiency
-        checker = TurklePermissionChecker(user)
-        checker.prefetch_perms(batches)
+    @classmethod
+    def access_permitted_ids_for(cls, user):
+        """Retrieve the IDs of the active Batches that the user has permission to access
+
+        The IDs are cached for each user until the permissions are
+        changed (see invalidate_access_permitted_cache()) or the
+        TURKLE_PERMISSION_CACHE_TIMEOUT expires.
 
-        return [b for b in batches if checker.has_perm('can_work_on_batch', b)]
+        Args:
+            user (User|AnonymousUser):
+
+        Returns:
+            Set of Batch IDs this user can access
+        """
+        cache_key = 'turkle.permitted_batch_ids.{}.{}'.format(
+            cls._access_permitted_cache_version(),
+            user.id if user.is_authenticated else 'anonymous')
+        batch_ids = cache.get(cache_key)
+        if batch_ids is None:
+            batch_ids = frozenset(cls.access_permitted_for(user).values_list('id', flat=True))
+            cache.set(cache_key, batch_ids, get_turkle_permission_cache_timeout())
+        return batch_ids
+
+    @staticmethod
+    def invalidate_access_permitted_cache():
+        """Discard the cached IDs of Batches that users have permission to access
+
+        Must be called after any change to Batch or Project access
+        permissions, group memberships or user flags that is not made
+        through Batch.save() or Project.save().
+        """
+        cache.set(ACCESS_PERMITTED_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+
+    @staticmethod
+    def _access_permitted_cache_version():
+        # A random version (instead of a counter) cannot be repeated if
+        # the version is evicted from the cache
+        return cache.get_or_set(ACCESS_PERMITTED_CACHE_VERSION_KEY, lambda: uuid.uuid4().hex, None)
 
     @classmethod
     def available_task_counts_for(cls, batch_query, user):
@@ -220,72 +781,64 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         available_task_counts = {}
 
-        if not user.is_authenticated:
-            # Batches an anonymous user does not have access to have an available task count of 0
-            for b_id in batch_query.filter(login_required=True).values_list('id', flat=True):
-                available_task_counts[b_id] = 0
-            batch_query = batch_query.exclude(login_required=True)
-
-        # Count number of tasks available for case where Batch.assignments_per_task == 1
-        # For this case, the number of available tasks is the same for all users with
-        # access to the batch.
-        oneway_batch_query = batch_query.filter(assignments_per_task=1)
-        unassigned_tasks = Task.objects.filter(completed=False).filter(taskassignment=None)
-
-        # Django does not easily support aggregations (such as Count) using subqueries:
-        #   https://code.djangoproject.com/ticket/28296
-        # The Django documentation states that:
-        #  "Aggregates may be used within a Subquery, but they require a specific
-        #   combination of filter(), values(), and annotate() to get the subquery
-        #   grouping correct."
-        #     https://docs.djangoproject.com/en/2.2/ref/models/expressions/#using-aggregates-within-a-subquery-expression
-        # The specific syntax we use here for count subqueries is adapted from:
-        #   https://github.com/martsberger/django-sql-utils
-        # where we are using the pattern:
-        #   subquery = Subquery(Child.objects.filter(parent_id=OuterRef('id')).order_by()
-        #                      .values('parent').annotate(count=Count('pk'))
-        #                      .values('count'), output_field=IntegerField())
-        #   Parent.objects.annotate(child_count=Coalesce(subquery, 0))
-        task_count_subquery = Subquery(
-            unassigned_tasks
-            .filter(batch=OuterRef('pk'))
-            .order_by().values('batch').annotate(count=Count('pk')).values('count'),
-            output_field=IntegerField())
-
-        oneway_batch_values = oneway_batch_query\
-            .annotate(available_task_count=Coalesce(task_count_subquery, 0))\
-            .values('available_task_count', 'id')
-        for obv in oneway_batch_values:
-            available_task_counts[obv['id']] = obv['available_task_count']
-
-        multiway_batch_query = batch_query.filter(assignments_per_task__gt=1)
-        if user.is_authenticated:
-            # Count number of tasks available for case where Batch.assignments_per_task > 1
-            ta_count_subquery = Subquery(
-                TaskAssignment.objects
-                .filter(task=OuterRef('pk'))
-                .order_by().values('task').annotate(count=Count('pk')).values('count'),
-                output_field=IntegerField())
-            unassigned_tasks = Task.objects.filter(completed=False)\
-                                           .annotate(ac=Coalesce(ta_count_subquery, 0))\
-                                           .filter(ac__lt=OuterRef('assignments_per_task'))\
-                                           .exclude(taskassignment__assigned_to=user)
-            task_count_subquery = Subquery(
-                unassigned_tasks
-                .filter(batch=OuterRef('pk'))
-                .order_by().values('batch').annotate(count=Count('pk')).values('count'),
-                output_field=IntegerField())
-            multiway_batch_values = multiway_batch_query\
-                .annotate(available_task_count=Coalesce(task_count_subquery, 0))\
-                .values('available_task_count', 'id')
-            for mbv in multiway_batch_values:
-                available_task_counts[mbv['id']] = mbv['available_task_count']
-        else:
-            # Only authenticated users should have access to multiple-assignment batches
-            # If the database somehow contains multiple-assignment Batches that are
-            # accessible to an anonymous user, we set the available task count to 0
-            for mbv in multiway_batch_query.values('id'):
-                available_task_counts[mbv['id']] = 0
+        # The number of Tasks with fewer than assignments_per_task TaskAssignments
+        # is maintained in the BatchTaskCounts table.  When assignments_per_task == 1,
+        # this is the number of Tasks available to every user with access to the Batch.
+        batch_values = batch_query.values('id', 'assignments_per_task', 'login_required',
+                                          'task_counts__available_tasks')
+        has_multiway_batches = False
+        counted_batch_ids = []
+        for bv in batch_values:
+            if not user.is_authenticated and bv['login_required']:
+                # Batches an anonymous user does not have access to have an
+                # available task count of 0
+                available_task_counts[bv['id']] = 0
+            elif not user.is_authenticated and bv['assignments_per_task'] > 1:
+                # Only authenticated users should have access to multiple-assignment
+                # batches.  If the database somehow contains multiple-assignment Batches
+                # that are accessible to an anonymous user, we set the available task
+                # count to 0
+                available_task_counts[bv['id']] = 0
+            else:
+                available_task_counts[bv['id']] = bv['task_counts__available_tasks'] or 0
+                counted_batch_ids.append(bv['id'])
+                if bv['assignments_per_task'] > 1:
+                    has_multiway_batches = True
+
+        if has_multiway_batches:
+            # When assignments_per_task > 1, Tasks that have already been
+            # assigned to the user are not available to the user.  These
+            # per-user exclusions are only counted for the Batches in batch_query.
+            assigned_task_counts = TaskAssignment.held_by(user).\
+                filter(task__batch_id__in=batch_query.filter(assignments_per_task__gt=1)
+                       .values('id')).\
+                filter(task__completed=False).\
+                filter(task__assignments_in_progress__lt=(
+                    F('task__batch__assignments_per_task') - F('task__assignments_completed'))).\
+                order_by().values('task__batch_id').\
+                annotate(count=Count('task_id', distinct=True))
+            for atc in assigned_task_counts:
+                available_task_counts[atc['task__batch_id']] -= atc['count']
+
+        if counted_batch_ids:
+            # Tasks whose only free slots are held by expired TaskAssignments are
+            # not included in BatchTaskCounts, but can be reclaimed by claim_next_task_for()
+            reclaimable_tasks = TaskAssignment.objects.\
+                filter(completed=False).\
+                filter(expires_at__lt=timezone.now()).\
+                filter(task__batch_id__in=counted_batch_ids).\
+                filter(task__completed=False).\
+                filter(task__assignments_in_progress__gte=(
+                    F('task__batch__assignments_per_task') - F('task__assignments_completed')))
+            if user.is_authenticated:
+                reclaimable_tasks = reclaimable_tasks.exclude(
+                    task__batch__assignments_per_task__gt=1,
+                    task_id__in=TaskAssignment.held_by(user).values('task_id'))
+            reclaimable_task_counts = reclaimable_tasks.\
+                order_by().values('task__batch_id').\
+                annotate(count=Count('task_id', distinct=True))
+            for rtc in reclaimable_task_counts:
+                available_task_counts[rtc['task__batch_id']] += rtc['count']
 
         return available_task_counts
 
@@ -300,6 +853,17 @@ class Batch(TaskAssignmentStatistics, models.Model):
             filter(assigned_to_id=user.id).\
             filter(task__batch=self)
 
+    def add_input_csv_fieldnames(self, fieldnames):
+        """Record the names of input CSV fields used by Tasks in this Batch
+
+        Args:
+            fieldnames (iterable): Names of input CSV fields
+        """
+        new_fieldnames = set(fieldnames).difference(self.input_csv_fieldnames)
+        if new_fieldnames:
+            self.input_csv_fieldnames = sorted(new_fieldnames.union(self.input_csv_fieldnames))
+            Batch.objects.filter(id=self.id).update(input_csv_fieldnames=self.input_csv_fieldnames)
+
     def available_for(self, user):
         """
         Returns:
@@ -316,7 +880,9 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """Retrieve a list of all Tasks in this batch available for the user.
 
         This list DOES NOT include Tasks in the batch that have been assigned
-        to the user but not yet completed.
+        to the user but not yet completed.  It DOES include Tasks that are
+        only unavailable because of expired TaskAssignments - including
+        the user's own - which are deleted when the Task is claimed.
 
         Args:
             user (User|AnonymousUser):
@@ -327,27 +893,88 @@ class Batch(TaskAssignmentStatistics, models.Model):
         if not user.is_authenticated and self.login_required:
             return Task.objects.none()
 
-        hs = self.task_set.filter(completed=False)
+        # Only include Tasks when # of (possibly incomplete) assignments < assignments_per_task,
+        # or when an expired assignment can be reclaimed
+        expired_assignments = TaskAssignment.objects.\
+            filter(completed=False).\
+            filter(expires_at__lt=timezone.now())
+        # The Tasks before the Batch's low-water mark are fully assigned, so
+        # the Tasks are read from the low-water mark onwards - or from the
+        # first Task with an expired assignment, if that comes first
+        low_water_mark = Subquery(
+            BatchTaskCounts.objects.filter(batch_id=self.id).values('low_water_mark'))
+        first_expired_task_id = Subquery(
+            expired_assignments.filter(task__batch_id=self.id).
+            order_by('task_id').values('task_id')[:1])
+        hs = self.task_set.filter(completed=False).\
+            filter(id__gte=Coalesce(Least(low_water_mark, first_expired_task_id),
+                                    low_water_mark, 0)).\
+            annotate(has_expired_assignment=Exists(
+                expired_assignments.filter(task=OuterRef('pk')))).\
+            filter(Q(assignments_in_progress__lt=(
+                self.assignments_per_task - F('assignments_completed'))) |
+                Q(has_expired_assignment=True))
 
         if self.assignments_per_task > 1:
-            # Exclude Tasks that have already been assigned to this user.
+            # Exclude Tasks that have already been assigned to this user,
+            # unless the user's TaskAssignment has expired.
             if user.is_authenticated:
                 # If the user is not authenticated, then user.id is None,
                 # and the query below would exclude all uncompleted Tasks.
-                hs = hs.exclude(taskassignment__assigned_to_id=user.id)
-
-            # Only include Tasks when # of (possibly incomplete) assignments < assignments_per_task
-            hs = hs.annotate(ac=models.Count('taskassignment')).\
-                filter(ac__lt=self.assignments_per_task)
-        elif self.assignments_per_task == 1:
-            # Only returns Tasks that have not been assigned to anyone (including this user)
-            hs = hs.filter(taskassignment=None)
+                hs = hs.exclude(id__in=TaskAssignment.held_by(user).values('task_id'))
 
         return hs
 
     def available_task_ids_for(self, user):
         return self.available_tasks_for(user).values_list('id', flat=True)
 
+    def claim_next_task_for(self, user, task_queryset=None):
+        """Assign the next available Task in this Batch to the user
+
+        Only the row for the Task being claimed is locked, so workers
+        claiming Tasks from the same Batch do not wait on each other.
+        On backends that support SKIP LOCKED, Tasks that are in the
+        process of being claimed by another worker are skipped.  On
+        other backends (such as SQLite), the Task is claimed with a
+        conditional UPDATE of the single Task row, which also acquires
+        SQLite's database write lock and re-checks the availability of
+        the Task.  In both cases, if another worker got to the Task
+        first, the next Task is tried.
+
+        Expired TaskAssignments for the claimed Task are deleted in the
+        same transaction, so abandoned Tasks can be claimed again without
+        waiting for TaskAssignment.expire_all_abandoned() to be run.
+
+        Args:
+            user (User|AnonymousUser):
+            task_queryset (QuerySet): Optional QuerySet of candidate Tasks,
+                which must be a subset of self.available_tasks_for(user).
+                Defaults to all Tasks available for the user.
+
+        Returns:
+            TaskAssignment for the claimed Task, or None if no Tasks are available
+        """
+        if task_queryset is None:
+            task_queryset = self.available_tasks_for(user)
+
+        with transaction.atomic():
+            locked_task = self._lock_next_task(user, task_queryset)
+            if locked_task is None:
+                return None
+
+            task_id, has_expired_assignment = locked_task
+            if has_expired_assignment:
+                TaskAssignment.reclaim_expired_for(task_id)
+            task_assignment = TaskAssignment(
+                expires_at=timezone.now() + datetime.timedelta(
+                    hours=self.allotted_assignment_time),
+                task_id=task_id,
+            )
+            if user.is_authenticated:
+                task_assignment.assigned_to = user
+            task_assignment.save()
+            return task_assignment
+
     def clean(self):
         if not self.login_required and self.assignments_per_task != 1:
             raise ValidationError('When login is not required to access a Batch, ' +
@@ -376,27 +1003,53 @@ class Batch(TaskAssignmentStatistics, models.Model):
         # We are following Mechanical Turk's naming conventions for results files
         return "{}-Batch_{}_results{}".format(batch_filename, self.id, extension)
 
-    def create_tasks_from_csv(self, csv_fh):
-        """
+    def create_tasks_from_csv(self, csv_fh, chunk_size=None, progress_callback=None,
+                              atomic=True):
+        """Create Tasks for this Batch from the rows of a CSV file
+
+        Tasks are inserted in chunks using bulk_create(), in the order of
+        the CSV rows, so Task IDs increase with row order.  By default,
+        all Tasks are created in a single transaction - if any row fails,
+        no Tasks are created.
+
         Args:
             csv_fh (file-like object): File handle for CSV input
+            chunk_size (int): Number of Tasks inserted per query.  Defaults
+                to the TURKLE_TASK_CREATION_CHUNK_SIZE setting.
+            progress_callback (callable): Optional function called with the
+                number of Tasks created so far after each chunk is inserted
+            atomic (bool): If False, each chunk is committed separately, and
+                the caller is responsible for cleaning up after a failure
 
         Returns:
             Number of Tasks created from CSV file
         """
+        if atomic:
+            with transaction.atomic():
+                return self.create_tasks_from_csv(csv_fh, chunk_size, progress_callback,
+                                                  atomic=False)
+
+        if chunk_size is None:
+            chunk_size = get_turkle_task_creation_chunk_size()
         header, data_rows = self._parse_csv(csv_fh)
 
         logger.info('Creating tasks for Batch(%i) %s', self.id, self.name)
+        self.add_input_csv_fieldnames(header)
         num_created_tasks = 0
-        for row in data_rows:
-            if not row:
-                continue
-            task = Task(
-                batch=self,
-                input_csv_fields=dict(zip(header, row)),
-            )
-            task.save()
-            num_created_tasks += 1
+        non_empty_rows = (row for row in data_rows if row)
+        while True:
+            tasks = [Task(batch=self, input_csv_fields=dict(zip(header, row)))
+                     for row in itertools.islice(non_empty_rows, chunk_size)]
+            if not tasks:
+                break
+            with transaction.atomic():
+                Task.objects.bulk_create(tasks)
+                BatchTaskCounts.objects.filter(batch=self).\
+                    update(available_tasks=F('available_tasks') + len(tasks))
+            num_created_tasks += len(tasks)
+            logger.debug('Created %i tasks for Batch(%i)', num_created_tasks, self.id)
+            if progress_callback:
+                progress_callback(num_created_tasks)
         logger.info('Created %i tasks for Batch(%i) %s', num_created_tasks, self.id, self.name)
 
         return num_created_tasks
@@ -434,6 +1087,15 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         return self.available_tasks_for(user).first()
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                BatchTaskCounts.objects.create(batch=self)
+                BatchAnswerField.forget_names(self.id)
+        Batch.invalidate_access_permitted_cache()
+
     def total_assignments_completed_by(self, user):
         """
         Returns:
@@ -482,12 +1144,31 @@ class Batch(TaskAssignmentStatistics, models.Model):
         Args:
             csv_fh (file-like object): File handle for CSV output
         """
-        fieldnames, rows = self._results_data(self.task_set.all())
-        writer = csv.DictWriter(csv_fh, fieldnames, lineterminator=lineterminator,
+        for line in self.to_csv_lines(lineterminator=lineterminator):
+            csv_fh.write(line)
+
+    def to_csv_lines(self, lineterminator='\r\n', chunk_size=RESULTS_CHUNK_SIZE):
+        """Generate CSV output for every Task in batch, one line at a time
+
+        The results are read from the database in chunks, each with its
+        own query, so memory use does not grow with the size of the
+        Batch - even with database drivers (such as mysqlclient) that
+        read the entire result of a query into memory.
+
+        Args:
+            lineterminator (str):
+            chunk_size (int): Number of TaskAssignments read per query
+
+        Returns:
+            Generator of strings, starting with the CSV header line
+        """
+        fieldnames, rows = self._results_data(self.task_set.all(), chunk_size)
+        writer = csv.DictWriter(_EchoBuffer(), fieldnames, lineterminator=lineterminator,
                                 quoting=csv.QUOTE_ALL)
-        writer.writeheader()
+        # DictWriter.writeheader() does not return the written value before Python 3.8
+        yield writer.writerow(dict(zip(fieldnames, fieldnames)))
         for row in rows:
-            writer.writerow(row)
+            yield writer.writerow(row)
 
     def to_input_csv(self, csv_fh, lineterminator='\r\n'):
         """Write (reconstructed) CSV input to file handle for every Task in Batch
@@ -529,6 +1210,62 @@ class Batch(TaskAssignmentStatistics, models.Model):
             filter(taskassignment__completed=True).\
             distinct()
 
+    def _lock_next_task(self, user, task_queryset):
+        """Lock the row of the first Task in task_queryset that is still available
+
+        Must be called inside a transaction.
+
+        Returns:
+            Tuple with the Task ID (int) of the locked Task and a boolean
+            that is True if the Task has an expired TaskAssignment that must
+            be reclaimed, or None if no Tasks are available
+        """
+        if connection.features.has_select_for_update_skip_locked:
+            task_id = task_queryset.\
+                order_by('id').\
+                select_for_update(skip_locked=True).\
+                values_list('id', flat=True).\
+                first()
+            if task_id is None:
+                return None
+            # The subqueries of the candidate query read a snapshot taken
+            # before the Task row was locked, so another worker may have
+            # claimed the Task - or reclaimed its expired TaskAssignment -
+            # in between.  Re-check the Task now that its row is locked.
+            has_expired_assignment = self.available_tasks_for(user).\
+                filter(id=task_id).\
+                values_list('has_expired_assignment', flat=True).\
+                first()
+            if has_expired_assignment is None:
+                return self._lock_next_task(user, task_queryset.exclude(id=task_id))
+            return task_id, has_expired_assignment
+
+        next_task = task_queryset.values_list('id', 'has_expired_assignment').first()
+        if next_task is None:
+            return None
+        task_id, has_expired_assignment = next_task
+        # The UPDATE locks the Task row (or, on SQLite, the database) until
+        # the end of the transaction.  It re-checks the availability of the
+        # Task, and matches no rows if the Task has been completed or fully
+        # assigned - or its expired TaskAssignment reclaimed - since it was
+        # selected.
+        task = Task.objects.filter(id=task_id, completed=False)
+        if has_expired_assignment:
+            task = task.filter(id__in=TaskAssignment.objects.
+                               filter(task_id=task_id, completed=False,
+                                      expires_at__lt=timezone.now()).
+                               values('task_id'))
+        else:
+            task = task.filter(assignments_in_progress__lt=(
+                self.assignments_per_task - F('assignments_completed')))
+        if self.assignments_per_task > 1 and user.is_authenticated:
+            task = task.exclude(id__in=TaskAssignment.held_by(user).
+                                filter(task_id=task_id).
+                                values('task_id'))
+        if task.update(completed=False):
+            return next_task
+        return self._lock_next_task(user, task_queryset.exclude(id=task_id))
+
     def _parse_csv(self, csv_fh):
         """
         Args:
@@ -544,114 +1281,782 @@ class Batch(TaskAssignmentStatistics, models.Model):
         header = next(rows)
         return header, rows
 
-    def _get_csv_fieldnames(self, task_queryset):
+    def _get_csv_fieldnames(self):
         """
-        Args:
-            task_queryset (QuerySet):
-
         Returns:
             A tuple of strings specifying the fieldnames to be used in
             in the header of a CSV file.
         """
-        input_field_set = set()
-        answer_field_set = set()
-        task_assignments = TaskAssignment.objects.\
-            filter(task__in=task_queryset).\
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            input_field_set.update(task_assignment.task.input_csv_fields.keys())
-
-            # If the answers JSONField is empty, it evaluates as a string instead of a dict
-            if task_assignment.answers != '':
-                answer_field_set.update(task_assignment.answers.keys())
+        answer_field_set = set(
+            BatchAnswerField.objects.filter(batch=self).values_list('name', flat=True))
         return tuple(
             ['HITId', 'HITTypeId', 'Title', 'CreationTime', 'MaxAssignments',
              'AssignmentDurationInSeconds', 'AssignmentId', 'WorkerId',
              'AcceptTime', 'SubmitTime', 'WorkTimeInSeconds'] +
-            ['Input.' + k for k in sorted(input_field_set)] +
+            ['Input.' + k for k in sorted(self.input_csv_fieldnames)] +
             ['Answer.' + k for k in sorted(answer_field_set)] +
             ['Turkle.Username']
         )
 
-    def _results_data(self, task_queryset):
+    def _results_data(self, task_queryset, chunk_size=RESULTS_CHUNK_SIZE):
         """
         All completed Tasks must come from the same project so that they have the
         same field names.
 
         Args:
             task_queryset (QuerySet):
+            chunk_size (int): Number of TaskAssignments read per query
 
         Returns:
             A tuple where the first value is a list of fieldname strings, and
-            the second value is a list of dicts, where the keys to these
+            the second value is a generator of dicts, where the keys to these
             dicts are the values of the fieldname strings.
         """
-        rows = []
-        time_format = '%a %b %d %H:%M:%S %Z %Y'
+        return self._get_csv_fieldnames(), self._results_rows(task_queryset, chunk_size)
+
+    def _results_rows(self, task_queryset, chunk_size=RESULTS_CHUNK_SIZE):
+        """
+        Args:
+            task_queryset (QuerySet):
+            chunk_size (int): Number of TaskAssignments read per query
+
+        Returns:
+            A generator of dicts, one for each completed TaskAssignment
+        """
         task_assignments = TaskAssignment.objects.\
             filter(task__in=task_queryset).\
             filter(completed=True).\
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            task = task_assignment.task
-            batch = task.batch
-            project = task.batch.project
-
-            if task_assignment.assigned_to:
-                username = task_assignment.assigned_to.username
-            else:
-                username = ''
-
-            row = {
-                'HITId': task.id,
-                'HITTypeId': project.id,
-                'Title': project.name,
-                'CreationTime': batch.created_at.strftime(time_format),
-                'MaxAssignments': batch.assignments_per_task,
-                'AssignmentDurationInSeconds': batch.allotted_assignment_time * 3600,
-                'AssignmentId': task_assignment.id,
-                'WorkerId': task_assignment.assigned_to_id,
-                'AcceptTime': task_assignment.created_at.strftime(time_format),
-                'SubmitTime': task_assignment.updated_at.strftime(time_format),
-                'WorkTimeInSeconds': task_assignment.work_time_in_seconds(),
-                'Turkle.Username': username,
-            }
-            row.update({'Input.' + k: v for k, v in task.input_csv_fields.items()})
-            row.update({'Answer.' + k: v for k, v in task_assignment.answers.items()})
-            rows.append(row)
-
-        return self._get_csv_fieldnames(task_queryset), rows
+            select_related('assigned_to', 'task__batch__project').\
+            order_by('id')
+        # Each chunk starts after the last TaskAssignment of the previous
+        # chunk, instead of using QuerySet.iterator(), which does not
+        # stream results with drivers that buffer the entire result
+        last_id = 0
+        while True:
+            chunk = list(task_assignments.filter(id__gt=last_id)[:chunk_size])
+            for task_assignment in chunk:
+                yield self._results_row(task_assignment)
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1].id
+
+    def _results_row(self, task_assignment):
+        """
+        Args:
+            task_assignment (TaskAssignment): A completed TaskAssignment
+
+        Returns:
+            Dict with the values of a row of the results CSV file
+        """
+        time_format = '%a %b %d %H:%M:%S %Z %Y'
+        task = task_assignment.task
+        batch = task.batch
+        project = task.batch.project
+
+        if task_assignment.assigned_to:
+            username = task_assignment.assigned_to.username
+        else:
+            username = ''
+
+        row = {
+            'HITId': task.id,
+            'HITTypeId': project.id,
+            'Title': project.name,
+            'CreationTime': batch.created_at.strftime(time_format),
+            'MaxAssignments': batch.assignments_per_task,
+            'AssignmentDurationInSeconds': batch.allotted_assignment_time * 3600,
+            'AssignmentId': task_assignment.id,
+            'WorkerId': task_assignment.assigned_to_id,
+            'AcceptTime': task_assignment.created_at.strftime(time_format),
+            'SubmitTime': task_assignment.updated_at.strftime(time_format),
+            'WorkTimeInSeconds': task_assignment.work_time_in_seconds(),
+            'Turkle.Username': username,
+        }
+        row.update({'Input.' + k: v for k, v in task.input_csv_fields.items()})
+        row.update({'Answer.' + k: v for k, v in task_assignment.answers.items()})
+        return row
 
     def __str__(self):
         return 'Batch: {}'.format(self.name)
 
 
-class TurklePermissionChecker(ObjectPermissionChecker):
+class BatchTaskCounts(models.Model):
+    """Summary of the number of Tasks in a Batch that are available to Workers
+
+    The counts are updated when Tasks are created and when TaskAssignments
+    are accepted, returned or expired, so that pages listing Batches do not
+    need to count Tasks.
     """
-    Wrapper for django-guardian's permissions checker.
+    class Meta:
+        verbose_name = "Batch Task Counts"
+        verbose_name_plural = "Batch Task Counts"
+
+    # Number of uncompleted Tasks with fewer than assignments_per_task TaskAssignments
+    available_tasks = models.IntegerField(default=0)
+    batch = models.OneToOneField(Batch, on_delete=models.CASCADE, primary_key=True,
+                                 related_name='task_counts')
+    # All uncompleted Tasks in the Batch with IDs below the low-water mark
+    # have assignments_per_task TaskAssignments, so Batch.available_tasks_for()
+    # does not need to read them.  The mark is advanced when the Task at
+    # the mark becomes unavailable, and lowered when an earlier Task
+    # becomes available again.
+    low_water_mark = models.IntegerField(default=0)
+
+    @classmethod
+    def recount(cls, batch_queryset):
+        """Recompute the counts for the specified Batches from the Task table
+
+        Args:
+            batch_queryset (QuerySet): Batches whose counts should be recomputed
+
+        Returns:
+            Number of Batches updated
+        """
+        cls.objects.bulk_create(
+            [cls(batch_id=batch_id) for batch_id in
+             batch_queryset.filter(task_counts=None).values_list('id', flat=True)])
+        # When no Tasks are available, the low-water mark is set past the last Task
+        last_task_id = Subquery(
+            Task.objects.filter(batch=OuterRef('batch_id')).order_by('-id').values('id')[:1])
+        return cls.objects.filter(batch__in=batch_queryset).update(
+            available_tasks=cls._available_task_count_subquery(),
+            low_water_mark=Coalesce(cls._first_available_task_id_subquery(),
+                                    last_task_id + 1, 0))
+
+    @classmethod
+    def update_for_task(cls, task_id, assignments_delta):
+        """Update the counts after the number of TaskAssignments for a Task has changed
+
+        The counts are only changed if the Task has become available or
+        unavailable.  Must be called in the transaction that updated the
+        Task's assignment counters, after they have been updated.
+
+        Args:
+            task_id (int): ID of the Task
+            assignments_delta (int): Change in the Task's total number of
+                completed and uncompleted TaskAssignments
+        """
+        task = Task.objects.\
+            filter(id=task_id, completed=False).\
+            annotate(total_assignments=F('assignments_completed') + F('assignments_in_progress'))
+        assignments_per_task = F('batch__assignments_per_task')
+        if assignments_delta > 0:
+            changed_task = task.filter(
+                total_assignments__gte=assignments_per_task,
+                total_assignments__lt=assignments_per_task + assignments_delta)
+        else:
+            changed_task = task.filter(
+                total_assignments__lt=assignments_per_task,
+                total_assignments__gte=assignments_per_task + assignments_delta)
+        # Matches no rows unless the Task has become available or unavailable
+        counts = cls.objects.filter(batch_id__in=changed_task.values('batch_id'))
+
+        if assignments_delta < 0:
+            counts.update(available_tasks=F('available_tasks') + 1,
+                          low_water_mark=Least(F('low_water_mark'),
+                                               Value(task_id, output_field=IntegerField())))
+            return
+
+        # The UPDATE locks the BatchTaskCounts row until the end of the
+        # transaction.  A Task that becomes available again after the next
+        # available Task is read below lowers the mark after this transaction.
+        if not counts.update(available_tasks=F('available_tasks') - 1):
+            return
+        batch_id = Task.objects.filter(id=task_id).values('batch_id')
+        counts = cls.objects.filter(batch_id__in=batch_id)
+        next_task_id = Task.objects.\
+            filter(batch_id__in=batch_id, completed=False).\
+            filter(id__gte=Subquery(counts.values('low_water_mark'))).\
+            filter(assignments_in_progress__lt=(
+                F('batch__assignments_per_task') - F('assignments_completed'))).\
+            order_by('id').\
+            values_list('id', flat=True).\
+            first()
+        if next_task_id is None:
+            # All of the Batch's Tasks are fully assigned
+            counts.update(low_water_mark=Greatest(
+                F('low_water_mark'), Value(task_id + 1, output_field=IntegerField())))
+        else:
+            counts.update(low_water_mark=next_task_id)
 
-    Handles projects that don't have custom permissions.
+    @classmethod
+    def with_incorrect_counts(cls):
+        """
+        Returns:
+            QuerySet of all BatchTaskCounts that do not match the contents
+            of the Task table, including those whose low-water mark is
+            past an available Task
+        """
+        return cls.objects.\
+            annotate(actual_available_tasks=cls._available_task_count_subquery()).\
+            annotate(first_available_task_id=cls._first_available_task_id_subquery()).\
+            filter(~Q(available_tasks=F('actual_available_tasks')) |
+                   Q(low_water_mark__gt=F('first_available_task_id')))
+
+    @staticmethod
+    def _available_task_count_subquery():
+        # See Task._assignment_count_subquery() for an explanation of this subquery syntax
+        return Coalesce(Subquery(
+            Task.objects
+            .filter(batch=OuterRef('batch_id'), completed=False)
+            .filter(assignments_in_progress__lt=(
+                F('batch__assignments_per_task') - F('assignments_completed')))
+            .order_by().values('batch').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()), 0)
+
+    @staticmethod
+    def _first_available_task_id_subquery():
+        return Subquery(
+            Task.objects
+            .filter(batch=OuterRef('batch_id'), completed=False)
+            .filter(assignments_in_progress__lt=(
+                F('batch__assignments_per_task') - F('assignments_completed')))
+            .order_by('id').values('id')[:1])
+
+    def __str__(self):
+        return 'Task counts for Batch id:{}'.format(self.batch_id)
+
+
+class BatchAnswerField(models.Model):
+    """Name of a field in the answers of a Batch's TaskAssignments
+
+    Names are added when TaskAssignments are saved, so that the header
+    of the results CSV file can be generated without reading every
+    TaskAssignment.  Names are not removed when TaskAssignments are
+    deleted, so the header may include fields that no remaining
+    TaskAssignment uses.
     """
+    class Meta:
+        unique_together = (('batch', 'name_hash'),)
+        verbose_name = "Batch Answer Field"
 
-    def has_perm(self, perm, obj):
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE, related_name='answer_fields')
+    name = models.TextField()
+    # SHA-1 hex digest of name, since MySQL cannot enforce the uniqueness of a TEXT column
+    name_hash = models.CharField(max_length=40)
+
+    @classmethod
+    def add_names(cls, batch_id, names):
+        """Record the names of answer fields used by a TaskAssignment
+
+        The names already recorded for each Batch are cached, so that
+        the database is only written when a TaskAssignment uses a new
+        answer field name.
+
+        Args:
+            batch_id (int): ID of the TaskAssignment's Batch
+            names (iterable): Names of answer fields
         """
-        Checks if user/group has given permission for object.
-        :param perm: permission as string, may or may not contain app_label
-          prefix (if not prefixed, we grab app_label from ``obj``)
-        :param obj: Django model instance for which permission should be checked
+        cache_key = cls._names_cache_key(batch_id)
+        known_names = cache.get(cache_key, frozenset())
+        new_names = set(names).difference(known_names)
+        if new_names:
+            # Names recorded by other processes are ignored
+            cls.objects.bulk_create(
+                [cls(batch_id=batch_id, name=name, name_hash=cls.hash_name(name))
+                 for name in new_names],
+                ignore_conflicts=True)
+            cache.set(cache_key, known_names.union(new_names), ANSWER_FIELD_NAMES_CACHE_TIMEOUT)
+
+    @classmethod
+    def forget_names(cls, batch_id):
+        """Discard the cached answer field names of a Batch
+
+        Must be called when a Batch is created, since the ID of a
+        deleted Batch may be reused.
         """
-        if self.user and not self.user.is_active:
-            return False
-        elif self.user and self.user.is_superuser:
-            return True
-        elif not self.user.is_authenticated and obj.login_required:
-            return False
-        elif obj.custom_permissions:
-            if '.' in perm:
-                _, perm = perm.split('.', 1)
-            return perm in self.get_perms(obj)
+        cache.delete(cls._names_cache_key(batch_id))
+
+    @staticmethod
+    def hash_name(name):
+        """
+        Returns:
+            SHA-1 hex digest (str) of an answer field name
+        """
+        return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.name_hash = self.hash_name(self.name)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def _names_cache_key(batch_id):
+        return 'turkle.answer_field_names.{}'.format(batch_id)
+
+    def __str__(self):
+        return 'Answer field {} for Batch id:{}'.format(self.name, self.batch_id)
+
+
+class SkippedTask(models.Model):
+    """Task that a Worker has skipped
+
+    Tasks skipped by a Worker are offered to the Worker after the Batch's
+    other available Tasks.  The Tasks skipped by anonymous users are
+    stored in their sessions instead.
+    """
+    class Meta:
+        unique_together = (('user', 'batch', 'task'),)
+        verbose_name = "Skipped Task"
+
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    @classmethod
+    def skip(cls, user, task):
+        """Record that the User has skipped a Task
+
+        Skipping a Task that the User has already skipped forgets the
+        User's other skipped Tasks in the Batch, so that they are offered
+        to the User before this Task.
+
+        Args:
+            user (User):
+            task (Task):
+        """
+        skipped_tasks = cls.objects.filter(batch_id=task.batch_id, user=user)
+        if skipped_tasks.filter(task=task).exists():
+            skipped_tasks.exclude(task=task).delete()
         else:
-            return True
+            cls.objects.get_or_create(batch_id=task.batch_id, task=task, user=user)
+
+    @classmethod
+    def task_ids_for(cls, user, batch_id):
+        """
+        Returns:
+            QuerySet of the IDs of the Tasks in the Batch skipped by the User,
+            for use as a subquery
+        """
+        return cls.objects.filter(batch_id=batch_id, user=user).values('task_id')
+
+    def __str__(self):
+        return 'Task id:{} skipped by User id:{}'.format(self.task_id, self.user_id)
+
+
+class TaskAssignmentRollup(models.Model):
+    """Summary of the TaskAssignments completed by a Worker for a Batch on one day
+
+    Each row covers the completed TaskAssignments whose work times fall
+    into one bucket of a logarithmic histogram.  TaskAssignments are
+    added to the rows when they are submitted, so that the Batch and
+    Project statistics pages do not need to read every TaskAssignment.
+    Medians computed from the histogram buckets are approximate.
+    """
+    class Meta:
+        unique_together = (('batch', 'user', 'day', 'work_time_bucket'),)
+        verbose_name = "Task Assignment Rollup"
+
+    # Number of histogram buckets for each doubling of the work time
+    BUCKETS_PER_DOUBLING = 8
+
+    assignments_completed = models.IntegerField(default=0)
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE, related_name='rollups')
+    day = models.DateField()
+    first_finished_at = models.DateTimeField()
+    last_finished_at = models.DateTimeField()
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE)
+    work_time_bucket = models.IntegerField()
+    work_time_sum = models.BigIntegerField(default=0)
+
+    @classmethod
+    def add_task_assignment(cls, task_assignment):
+        """Add a TaskAssignment that has just been completed to the rollups
+
+        Called by TaskAssignment.save(), in the transaction that completes
+        the TaskAssignment.  The TaskAssignment is added to the row for
+        its rollup_day and rollup_work_time_bucket.
+
+        Args:
+            task_assignment (TaskAssignment): A completed TaskAssignment
+        """
+        cls._add(cls._key_for(task_assignment), 1, task_assignment.work_time_seconds or 0,
+                 task_assignment.updated_at, task_assignment.updated_at)
+
+    @classmethod
+    def remove_task_assignment(cls, task_assignment):
+        """Remove a TaskAssignment that is deleted or no longer completed from the rollups
+
+        The TaskAssignment is removed from the row that add_task_assignment()
+        added it to, even if its updated_at field has changed since then.
+        Must be called inside a transaction.
+
+        Args:
+            task_assignment (TaskAssignment): A TaskAssignment, with the
+                values of the fields in TaskAssignment.COMPLETION_FIELDS
+                that were saved when it was completed
+        """
+        cls.objects.\
+            filter(**cls._key_for(task_assignment)).\
+            update(assignments_completed=F('assignments_completed') - 1,
+                   work_time_sum=F('work_time_sum') - (task_assignment.work_time_seconds or 0))
+
+    @classmethod
+    def _key_for(cls, task_assignment):
+        return {
+            'batch_id': task_assignment.task_batch_id(),
+            'day': task_assignment.rollup_day,
+            'user_id': task_assignment.assigned_to_id,
+            'work_time_bucket': task_assignment.rollup_work_time_bucket,
+        }
+
+    @classmethod
+    def _add(cls, key, assignments_completed, work_time_sum, first_finished_at,
+             last_finished_at):
+        """Add completed TaskAssignments to the rollup row with the given key
+
+        The row is created if it does not exist.  Must be called inside
+        a transaction.
+        """
+        updates = {
+            'assignments_completed': F('assignments_completed') + assignments_completed,
+            'work_time_sum': F('work_time_sum') + work_time_sum,
+            'first_finished_at': Least('first_finished_at', Value(
+                first_finished_at, output_field=models.DateTimeField())),
+            'last_finished_at': Greatest('last_finished_at', Value(
+                last_finished_at, output_field=models.DateTimeField())),
+        }
+        if cls.objects.filter(**key).update(**updates):
+            return
+        # Create an empty row unless a concurrent call created it first,
+        # then add the TaskAssignments to it.  Unlike catching an
+        # IntegrityError, this does not need a savepoint.
+        cls.objects.bulk_create(
+            [cls(first_finished_at=first_finished_at, last_finished_at=last_finished_at,
+                 **key)],
+            ignore_conflicts=True)
+        cls.objects.filter(**key).update(**updates)
+
+    @classmethod
+    def summarize(cls, rollup_queryset, group_by=None):
+        """Combine rollup rows into WorkTimeSummary objects
+
+        Args:
+            rollup_queryset (QuerySet): TaskAssignmentRollups to combine
+            group_by (str): Optional field name ('batch_id' or 'user_id')
+
+        Returns:
+            If group_by is None, a single WorkTimeSummary.  Otherwise a
+            dict mapping values of the group_by field to WorkTimeSummary objects.
+        """
+        group_fields = ['work_time_bucket'] if group_by is None else [group_by, 'work_time_bucket']
+        rows = rollup_queryset.\
+            order_by().values(*group_fields).\
+            annotate(assignments_completed_sum=Sum('assignments_completed'),
+                     first_finished_at_min=Min('first_finished_at'),
+                     last_finished_at_max=Max('last_finished_at'),
+                     work_time_sum_sum=Sum('work_time_sum'))
+        summaries = defaultdict(WorkTimeSummary)
+        for row in rows:
+            summaries[row[group_by] if group_by else None].add(
+                row['work_time_bucket'], row['assignments_completed_sum'],
+                row['work_time_sum_sum'], row['first_finished_at_min'],
+                row['last_finished_at_max'])
+        if group_by is None:
+            return summaries[None]
+        return dict(summaries)
+
+    @classmethod
+    def bucket_for_work_time(cls, work_time_seconds):
+        """
+        Returns:
+            Index (int) of the histogram bucket for a work time
+        """
+        if work_time_seconds < 1:
+            return 0
+        return 1 + int(math.log2(work_time_seconds) * cls.BUCKETS_PER_DOUBLING)
+
+    def __str__(self):
+        return 'Rollup for Batch id:{} User id:{} on {}'.format(
+            self.batch_id, self.user_id, self.day)
+
+
+class WorkTimeSummary(object):
+    """Work time statistics for a group of completed TaskAssignments
+
+    Built from TaskAssignmentRollup rows by TaskAssignmentRollup.summarize().
+    """
+    def __init__(self):
+        self.assignments_completed = 0
+        self.first_finished_at = None
+        self.last_finished_at = None
+        self.total_work_time = 0
+        # Maps histogram bucket to [assignments_completed, work_time_sum]
+        self._buckets = defaultdict(lambda: [0, 0])
+
+    def add(self, bucket, assignments_completed, work_time_sum, first_finished_at,
+            last_finished_at):
+        if assignments_completed <= 0:
+            return
+        self.assignments_completed += assignments_completed
+        self.total_work_time += work_time_sum
+        self._buckets[bucket][0] += assignments_completed
+        self._buckets[bucket][1] += work_time_sum
+        if self.first_finished_at is None or first_finished_at < self.first_finished_at:
+            self.first_finished_at = first_finished_at
+        if self.last_finished_at is None or last_finished_at > self.last_finished_at:
+            self.last_finished_at = last_finished_at
+
+    def mean_work_time(self):
+        """
+        Returns:
+            Float for mean work time (in seconds), or 0 if no TaskAssignments
+        """
+        if not self.assignments_completed:
+            return 0
+        return self.total_work_time / self.assignments_completed
+
+    def median_work_time(self):
+        """Approximate median work time
+
+        The median is estimated as the mean work time of the histogram
+        bucket that contains the middle TaskAssignment.
+
+        Returns:
+            Float for approximate median work time (in seconds), or 0 if
+            no TaskAssignments
+        """
+        middle = (self.assignments_completed - 1) // 2
+        seen = 0
+        for bucket in sorted(self._buckets):
+            count, work_time_sum = self._buckets[bucket]
+            seen += count
+            if seen > middle:
+                return work_time_sum / count
+        return 0
+
+
+class Job(models.Model):
+    """Long-running Batch operation, run by the `run_jobs` management command
+
+    Jobs are only used when the TURKLE_BACKGROUND_JOBS setting is True.
+    Input and output files are stored in the TURKLE_JOB_FILES_DIR directory.
+    """
+    class Meta:
+        verbose_name = "Job"
+
+    CREATE_TASKS = 'create_tasks'
+    DELETE_BATCH = 'delete_batch'
+    EXPORT_RESULTS = 'export_results'
+    JOB_TYPE_CHOICES = (
+        (CREATE_TASKS, 'Create Tasks from CSV file'),
+        (DELETE_BATCH, 'Delete Batch'),
+        (EXPORT_RESULTS, 'Export results CSV file'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    # Number of rows processed between updates of the progress field
+    PROGRESS_INTERVAL = 1000
+
+    # Prefix of the names of the files of CSV files uploaded in chunks,
+    # which are stored in the same directory as the Job files
+    UPLOAD_FILE_PREFIX = 'upload-'
+
+    batch = models.ForeignKey(Batch, null=True, on_delete=models.SET_NULL)
+    # Preserved after the Batch is deleted
+    batch_name = models.CharField(max_length=1024, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(User, null=True, related_name='created_jobs',
+                                   on_delete=models.SET_NULL, verbose_name='creator')
+    finished_at = models.DateTimeField(null=True, blank=True)
+    input_file = models.CharField(max_length=1024, blank=True)
+    job_type = models.CharField(max_length=32, choices=JOB_TYPE_CHOICES)
+    message = models.TextField(blank=True)
+    output_file = models.CharField(max_length=1024, blank=True)
+    parameters = JSONField(blank=True, default=dict)
+    # Number of rows (Tasks, CSV lines, deleted objects) processed so far
+    progress = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, db_index=True,
+                              default=PENDING)
+
+    @classmethod
+    def claim_next(cls):
+        """Mark the oldest pending Job as running and return it
+
+        Safe to call from multiple worker processes - each pending Job
+        is claimed by exactly one worker.
+
+        Returns:
+            Job|None
+        """
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                job = cls.objects.filter(status=cls.PENDING).order_by('id').\
+                    select_for_update(skip_locked=True).first()
+                if job is None:
+                    return None
+            else:
+                while True:
+                    job = cls.objects.filter(status=cls.PENDING).order_by('id').first()
+                    if job is None:
+                        return None
+                    # Matches no rows if another worker claimed the Job first
+                    if cls.objects.filter(id=job.id, status=cls.PENDING).\
+                            update(status=cls.RUNNING):
+                        break
+            job.status = cls.RUNNING
+            job.started_at = timezone.now()
+            job.save(update_fields=['status', 'started_at'])
+        return job
+
+    @classmethod
+    def enqueue(cls, job_type, batch, user, **parameters):
+        """Create a pending Job
+
+        Args:
+            job_type (str): One of the Job.JOB_TYPE_CHOICES values
+            batch (Batch):
+            user (User|AnonymousUser): User requesting the Job
+            parameters: Job-specific parameters, stored as JSON
+
+        Returns:
+            Job
+        """
+        return cls.objects.create(
+            batch=batch,
+            batch_name=batch.name,
+            created_by=user if user.is_authenticated else None,
+            job_type=job_type,
+            parameters=parameters,
+        )
+
+    @classmethod
+    def delete_expired_uploads(cls, expiration_hours):
+        """Delete the files of CSV uploads that have been abandoned
+
+        Files that are being written to are not deleted.
+
+        Args:
+            expiration_hours (float): Number of hours since the last chunk
+                of an upload was received after which it is deleted
+
+        Returns:
+            Number (int) of upload files deleted
+        """
+        expires_before = time.time() - expiration_hours * 3600
+        num_deleted = 0
+        for filename in os.listdir(os.path.dirname(cls.file_path(cls.UPLOAD_FILE_PREFIX))):
+            if not filename.startswith(cls.UPLOAD_FILE_PREFIX):
+                continue
+            path = cls.file_path(filename)
+            try:
+                with open(path, 'rb') as f, exclusive_file_lock(f, blocking=False):
+                    # A chunk may have been added since the directory was listed
+                    expired = os.fstat(f.fileno()).st_mtime < expires_before
+            except OSError:
+                # Deleted or being written to
+                continue
+            if expired:
+                os.remove(path)
+                num_deleted += 1
+        return num_deleted
+
+    @staticmethod
+    def file_path(filename):
+        """
+        Returns:
+            Absolute path of a file in the TURKLE_JOB_FILES_DIR directory
+        """
+        job_files_dir = os.path.abspath(get_turkle_job_files_dir())
+        os.makedirs(job_files_dir, exist_ok=True)
+        return os.path.join(job_files_dir, filename)
+
+    def delete(self, *args, **kwargs):
+        for filename in (self.input_file, self.output_file):
+            if filename and os.path.exists(self.file_path(filename)):
+                os.remove(self.file_path(filename))
+        return super().delete(*args, **kwargs)
+
+    def run(self):
+        """Run a Job that has been claimed using claim_next()
+        """
+        logger.info('Starting Job(%i) %s for Batch(%s)', self.id, self.job_type, self.batch_id)
+        try:
+            if self.batch is None:
+                raise ValueError('The Batch for this Job no longer exists')
+            if self.job_type == self.CREATE_TASKS:
+                self._create_tasks()
+            elif self.job_type == self.DELETE_BATCH:
+                self._delete_batch()
+            elif self.job_type == self.EXPORT_RESULTS:
+                self._export_results()
+            else:
+                raise ValueError('Unknown Job type {}'.format(self.job_type))
+            self.status = self.SUCCEEDED
+            logger.info('Finished Job(%i) %s', self.id, self.job_type)
+        except Exception as e:
+            logger.exception('Job(%i) %s failed', self.id, self.job_type)
+            self.status = self.FAILED
+            self.message = str(e)
+        self.finished_at = timezone.now()
+        self.save()
+
+    def _create_tasks(self):
+        self.message = 'Creating Tasks'
+        self.save(update_fields=['message'])
+        try:
+            # Each chunk of Tasks is committed separately so that progress is visible
+            with open(self.file_path(self.input_file), 'r', encoding='utf-8', newline='') as f:
+                num_created = self.batch.create_tasks_from_csv(
+                    f, progress_callback=self._update_progress, atomic=False)
+        except Exception:
+            with transaction.atomic():
+                self.batch.task_set.all().delete()
+                BatchTaskCounts.recount(Batch.objects.filter(id=self.batch_id))
+            raise
+        os.remove(self.file_path(self.input_file))
+        self.input_file = ''
+        self.message = 'Created {} Tasks'.format(num_created)
+
+    def _delete_batch(self):
+        self.message = 'Deleting Batch'
+        self.save(update_fields=['message'])
+        num_deleted = 0
+        for model, batch_filter in ((TaskAssignment, 'task__batch'), (Task, 'batch')):
+            while True:
+                ids = list(model.objects.filter(**{batch_filter: self.batch_id}).
+                           values_list('id', flat=True)[:self.PROGRESS_INTERVAL])
+                if not ids:
+                    break
+                # TaskAssignment.delete() is bypassed, so the Task counters
+                # are not updated - but the Tasks are deleted next
+                model.objects.filter(id__in=ids).delete()
+                num_deleted += len(ids)
+                self._update_progress(num_deleted)
+        self.batch.delete()
+        self.batch = None
+        self.message = 'Deleted Batch'
+
+    def _export_results(self):
+        self.message = 'Exporting results'
+        self.save(update_fields=['message'])
+        self.output_file = 'job-{}-{}'.format(self.id, self.batch.csv_results_filename())
+        lineterminator = self.parameters.get('lineterminator', '\r\n')
+        with open(self.file_path(self.output_file), 'w', encoding='utf-8', newline='') as f:
+            for num_lines, line in enumerate(
+                    self.batch.to_csv_lines(lineterminator=lineterminator)):
+                f.write(line)
+                if num_lines and num_lines % self.PROGRESS_INTERVAL == 0:
+                    self._update_progress(num_lines)
+        self.progress = num_lines
+        self.message = 'Exported {} results'.format(num_lines)
+
+    def _update_progress(self, progress):
+        self.progress = progress
+        Job.objects.filter(id=self.id).update(progress=progress)
+
+    def __str__(self):
+        return 'Job id:{} {}'.format(self.id, self.get_job_type_display())
 
 
 class Project(TaskAssignmentStatistics, models.Model):
@@ -714,6 +2119,40 @@ class Project(TaskAssignmentStatistics, models.Model):
                                   'the number of Assignments per Task must be 1')
         self.process_template()
 
+    @classmethod
+    def compiled_html_template_for(cls, project_id, updated_at, html_template=None):
+        """Retrieve the compiled html_template for a Project
+
+        Compiled templates are cached in-process for each Project, and are
+        recompiled when the Project's updated_at time changes.
+
+        Args:
+            project_id (int):
+            updated_at (datetime): Project.updated_at of the Project
+            html_template (str): Project.html_template of the Project.  If
+                not specified, the template is read from the database when
+                it needs to be compiled.
+
+        Returns:
+            A tuple where the first value is a tuple of strings - items at
+            even indices are literal HTML, items at odd indices are template
+            variable names - and the second value is a boolean that is False
+            if the template has nested template variables, and must be
+            populated by repeated replacement.
+        """
+        cached = _compiled_html_templates.get(project_id)
+        if cached is not None and updated_at is not None and cached[0] == updated_at:
+            return cached[1]
+
+        if html_template is None:
+            html_template = cls.objects.filter(id=project_id).\
+                values_list('html_template', flat=True).get()
+        compiled_template = (tuple(TEMPLATE_VARIABLE_RE.split(html_template)),
+                             not NESTED_TEMPLATE_VARIABLE_RE.search(html_template))
+        if project_id is not None and updated_at is not None:
+            _compiled_html_templates[project_id] = (updated_at, compiled_template)
+        return compiled_template
+
     def copy_permissions_to_batches(self):
         """Copy permissions from this Project to all associated Batches
 
@@ -732,6 +2171,7 @@ class Project(TaskAssignmentStatistics, models.Model):
                     batches = self.batch_set.all()
                     GroupObjectPermission.objects.bulk_assign_perm(
                         'can_work_on_batch', group, batches)
+        Batch.invalidate_access_permitted_cache()
 
     def finished_task_assignments(self):
         """
@@ -759,6 +2199,10 @@ class Project(TaskAssignmentStatistics, models.Model):
                   "If so, add an unused hidden input."
             raise ValidationError({'html_template': msg}, code='invalid')
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        Batch.invalidate_access_permitted_cache()
+
     def total_assignments_completed_by(self, user):
         """
         Returns:
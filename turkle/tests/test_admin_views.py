@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 import datetime
 import os.path
+import tempfile
+import time
 
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from guardian.shortcuts import assign_perm
 from .utility import save_model
 
-from turkle.models import Batch, Project, Task, TaskAssignment
+from turkle.admin import BatchAdmin
+from turkle.models import Batch, Job, Project, Task, TaskAssignment, TaskAssignmentRollup
+from turkle.utils import exclusive_file_lock
 
 
 class TestCancelOrPublishBatch(django.test.TestCase):
@@ -170,6 +180,65 @@ class TestBatchAdmin(django.test.TestCase):
         self.assertEqual(tasks[2].input_csv_fields['emoji'], '🤔')
         self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
 
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_batch_add_csv_spooled_to_disk(self):
+        project = Project(name='foo', html_template='<p>${emoji}: ${more_emoji}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with open(os.path.abspath('turkle/tests/resources/emoji.csv')) as fp:
+            response = client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': fp
+                })
+        self.assertEqual(response.status_code, 302)
+        matching_batch = Batch.objects.get(name='batch_save')
+        self.assertEqual(matching_batch.total_tasks(), 3)
+        self.assertEqual(matching_batch.task_set.order_by('id').last().input_csv_fields,
+                         {'emoji': '🤔', 'more_emoji': '🤭'})
+
+    def test_batch_add_validation_not_utf8(self):
+        project = Project(name='foo', html_template='<p>${foo}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        csv_file = SimpleUploadedFile('latin1.csv', 'foo\ncafé\n'.encode('latin-1'))
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'csv_file': csv_file,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'The CSV file is not UTF-8 encoded')
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
+    def test_batch_add_validation_empty_file(self):
+        project = Project(name='foo', html_template='<p>${foo}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'csv_file': SimpleUploadedFile('empty.csv', b'\n'),
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'The CSV file is empty')
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
     def test_batch_add_empty_allotted_assignment_time(self):
         project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
         project.save()
@@ -363,6 +432,306 @@ class TestBatchAdmin(django.test.TestCase):
         response = client.get(reverse('turkle_admin:batch_stats', kwargs={'batch_id': batch.id}))
         self.assertEqual(response.status_code, 200)
 
+    def test_batch_changelist__query_count(self):
+        project = Project.objects.create(name='foo', html_template='<textarea>')
+
+        def add_batch(i):
+            batch = Batch.objects.create(assignments_per_task=2, name='batch_%d' % i,
+                                         project=project)
+            task = Task.objects.create(batch=batch)
+            Task.objects.create(batch=batch)
+            TaskAssignment.objects.create(completed=True, task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        add_batch(0)
+        with CaptureQueriesContext(connection) as one_batch_queries:
+            response = client.get(reverse('turkle_admin:turkle_batch_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, ' 1 / 4')
+
+        for i in range(1, 6):
+            add_batch(i)
+        with CaptureQueriesContext(connection) as six_batch_queries:
+            response = client.get(reverse('turkle_admin:turkle_batch_changelist'))
+        self.assertEqual(len(one_batch_queries), len(six_batch_queries))
+
+        # The progress column can be sorted by the number of finished assignments
+        TaskAssignment.objects.create(completed=True,
+                                      task=Task.objects.filter(batch__name='batch_3').first())
+        column = BatchAdmin.list_display.index('assignments_completed') + 1
+        response = client.get(reverse('turkle_admin:turkle_batch_changelist'),
+                              {'o': '-%d' % column})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_list[0].name, 'batch_3')
+
+    def test_batch_stats_view__completed_assignments(self):
+        user = User.objects.create_user('worker', password='secret')
+        project = Project.objects.create(name='foo', html_template='<textarea>')
+        batch = Batch.objects.create(assignments_per_task=2, project=project)
+        task = Task.objects.create(batch=batch)
+        TaskAssignment.objects.create(assigned_to=user, completed=True, task=task,
+                                      work_time_seconds=30)
+        TaskAssignment.objects.create(assigned_to=user, completed=True, task=task,
+                                      work_time_seconds=90)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('turkle_admin:batch_stats', kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'worker')
+        self.assertContains(response, '2 minutes (120s)')
+        response = client.get(reverse('turkle_admin:project_stats',
+                                      kwargs={'project_id': project.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['project_total_completed_assignments'], 2)
+        self.assertEqual(response.context['project_total_completed_assignments_1_day'], 2)
+        self.assertEqual(response.context['project_mean_work_time'], '1 minute (60s)')
+
+    def test_project_stats_view__recent_periods(self):
+        project = Project.objects.create(name='foo', html_template='<textarea>')
+        batch = Batch.objects.create(assignments_per_task=10, project=project)
+        task = Task.objects.create(batch=batch)
+        now = timezone.now()
+        for hours_ago in [1, 23, 25, 24 * 7 - 1, 24 * 7 + 1]:
+            finished_at = now - datetime.timedelta(hours=hours_ago)
+            ta = TaskAssignment.objects.create(completed=True, task=task, work_time_seconds=10)
+            TaskAssignment.objects.filter(id=ta.id).update(
+                rollup_day=timezone.localdate(finished_at), updated_at=finished_at)
+        TaskAssignmentRollup.objects.all().delete()
+        for ta in TaskAssignment.objects.all():
+            TaskAssignmentRollup.add_task_assignment(ta)
+
+        # Recent periods end now, and do not start at midnight
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('turkle_admin:project_stats',
+                                      kwargs={'project_id': project.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['project_total_completed_assignments_1_day'], 2)
+        self.assertEqual(response.context['project_total_completed_assignments_7_day'], 4)
+        self.assertEqual(response.context['project_total_completed_assignments_30_day'], 5)
+
+
+class TestBackgroundJobs(django.test.TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        self.project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        self.client = django.test.Client()
+        self.client.login(username='admin', password='secret')
+        job_files_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(job_files_dir.cleanup)
+        settings_override = override_settings(TURKLE_BACKGROUND_JOBS=True,
+                                              TURKLE_JOB_FILES_DIR=job_files_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_batch_add_and_export(self):
+        with open(os.path.abspath('turkle/tests/resources/form_1_vals.csv')) as fp:
+            response = self.client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': self.project.id,
+                    'name': 'batch_save',
+                    'csv_file': fp
+                })
+        self.assertEqual(response.status_code, 302)
+        batch = Batch.objects.get(name='batch_save')
+        self.assertEqual(response['Location'],
+                         '/admin/turkle/job/?batch__id__exact={}'.format(batch.id))
+        self.assertEqual(batch.total_tasks(), 0)
+        job = Job.objects.get(batch=batch)
+        self.assertEqual(job.job_type, Job.CREATE_TASKS)
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.created_by, self.user)
+
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b'Pending' in response.content)
+
+        call_command('run_jobs', '--once')
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.input_file, '')
+        self.assertEqual(batch.total_tasks(), 1)
+
+        response = self.client.get(reverse('turkle_admin:download_batch',
+                                           kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 302)
+        job = Job.objects.get(batch=batch, job_type=Job.EXPORT_RESULTS)
+        call_command('run_jobs', '--once')
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+
+        response = self.client.get(reverse('turkle_admin:download_job_output',
+                                           kwargs={'job_id': job.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get('Content-Disposition'),
+                         'attachment; filename="%s"' % batch.csv_results_filename())
+        csv_text = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(csv_text.startswith('"HITId"'))
+        response.close()
+
+    def test_batch_cancel(self):
+        batch = Batch.objects.create(name='MY_BATCH_NAME', project=self.project)
+        task = Task.objects.create(batch=batch)
+        TaskAssignment.objects.create(task=task)
+
+        response = self.client.post(reverse('turkle_admin:cancel_batch',
+                                            kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 302)
+        batch.refresh_from_db()
+        self.assertFalse(batch.active)
+
+        call_command('run_jobs', '--once')
+        job = Job.objects.get(job_type=Job.DELETE_BATCH)
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.progress, 2)
+        self.assertIsNone(job.batch)
+        self.assertEqual(job.batch_name, 'MY_BATCH_NAME')
+        self.assertFalse(Batch.objects.filter(id=batch.id).exists())
+        self.assertFalse(Task.objects.filter(id=task.id).exists())
+
+    def test_failed_create_tasks_job(self):
+        batch = Batch.objects.create(name='MY_BATCH_NAME', project=self.project)
+        job = Job.enqueue(Job.CREATE_TASKS, batch, self.user)
+        job.input_file = 'missing.csv'
+        job.save()
+
+        self.assertEqual(Job.claim_next(), job)
+        self.assertIsNone(Job.claim_next())
+        job.run()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertTrue('missing.csv' in job.message)
+        self.assertEqual(batch.total_tasks(), 0)
+
+
+class TestCsvUpload(django.test.TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        self.project = Project.objects.create(
+            name='foo', html_template='<p>${emoji}: ${more_emoji}</p><textarea>')
+        self.client = django.test.Client()
+        self.client.login(username='admin', password='secret')
+        job_files_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(job_files_dir.cleanup)
+        settings_override = override_settings(TURKLE_JOB_FILES_DIR=job_files_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def start_upload(self):
+        response = self.client.post(reverse('turkle_admin:start_csv_upload'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['offset'], 0)
+        return reverse('turkle_admin:csv_upload',
+                       kwargs={'upload_id': response.json()['upload_id']})
+
+    def upload_chunk(self, upload_url, offset, data):
+        return self.client.post('{}?offset={}'.format(upload_url, offset), data,
+                                content_type='application/octet-stream')
+
+    def test_upload_and_create_batch(self):
+        with open(os.path.abspath('turkle/tests/resources/emoji.csv'), 'rb') as fp:
+            csv_data = fp.read()
+        upload_url = self.start_upload()
+
+        response = self.upload_chunk(upload_url, 0, csv_data[:20])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['offset'], 20)
+
+        # Resending a chunk that has already been received is rejected
+        response = self.upload_chunk(upload_url, 0, csv_data[:20])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 20)
+
+        response = self.client.get(upload_url)
+        self.assertEqual(response.json()['offset'], 20)
+        response = self.upload_chunk(upload_url, 20, csv_data[20:])
+        self.assertEqual(response.json()['offset'], len(csv_data))
+
+        response = self.client.post(upload_url + 'create/', {
+            'assignments_per_task': 1,
+            'project': self.project.id,
+            'name': 'batch_save',
+            'filename': 'emoji.csv',
+        })
+        self.assertEqual(response.status_code, 200)
+        batch = Batch.objects.get(name='batch_save')
+        self.assertEqual(response.json(), {
+            'batch_id': batch.id,
+            'url': reverse('turkle_admin:review_batch', kwargs={'batch_id': batch.id}),
+        })
+        self.assertEqual(batch.filename, 'emoji.csv')
+        self.assertFalse(batch.published)
+        self.assertEqual(batch.total_tasks(), 3)
+        self.assertEqual(batch.task_set.order_by('id').last().input_csv_fields,
+                         {'emoji': '🤔', 'more_emoji': '🤭'})
+
+        # The uploaded file is removed once the Batch has been created
+        self.assertEqual(self.client.get(upload_url).status_code, 404)
+
+    def test_create_batch_invalid_csv(self):
+        upload_url = self.start_upload()
+        self.upload_chunk(upload_url, 0, b'foo,bar\n1,2,3\n')
+
+        response = self.client.post(upload_url + 'create/', {
+            'assignments_per_task': 1,
+            'project': self.project.id,
+            'name': 'batch_save',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors']['__all__'][0]['message'],
+                         'The CSV file header has 2 fields, but line 2 has 3 fields')
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
+        # The upload is kept so that the Batch can be created with corrected fields
+        self.assertEqual(self.client.get(upload_url).status_code, 200)
+        response = self.client.delete(upload_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(upload_url).status_code, 404)
+
+    def test_upload_invalid_offset(self):
+        upload_url = self.start_upload()
+        response = self.upload_chunk(upload_url, 'abc', b'foo\n')
+        self.assertEqual(response.status_code, 400)
+        response = self.upload_chunk(upload_url, 5, b'foo\n')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 0)
+
+    def test_upload_of_other_user(self):
+        upload_url = self.start_upload()
+        User.objects.create_superuser('other', 'other@bar.foo', 'secret')
+        self.client.login(username='other', password='secret')
+        self.assertEqual(self.client.get(upload_url).status_code, 404)
+        self.assertEqual(self.upload_chunk(upload_url, 0, b'foo\n').status_code, 404)
+
+    def test_expire_uploads(self):
+        def upload_path(upload_url):
+            return Job.file_path('upload-{}-{}.csv'.format(
+                User.objects.get(username='admin').id, upload_url.rstrip('/').split('/')[-1]))
+
+        expired_url = self.start_upload()
+        locked_url = self.start_upload()
+        recent_url = self.start_upload()
+        self.upload_chunk(recent_url, 0, b'foo\n')
+        a_day_ago = time.time() - 25 * 3600
+        for upload_url in (expired_url, locked_url):
+            os.utime(upload_path(upload_url), (a_day_ago, a_day_ago))
+
+        # An upload that is receiving a chunk is not deleted
+        with open(upload_path(locked_url), 'rb') as f, exclusive_file_lock(f):
+            call_command('expire_uploads')
+        self.assertEqual(self.client.get(expired_url).status_code, 404)
+        self.assertEqual(self.client.get(locked_url).status_code, 200)
+        self.assertEqual(self.client.get(recent_url).json()['offset'], 4)
+
+        self.assertEqual(Job.delete_expired_uploads(24), 1)
+        self.assertEqual(self.client.get(locked_url).status_code, 404)
+
 
 class TestGroupAdmin(django.test.TestCase):
     def setUp(self):
@@ -440,6 +809,22 @@ class TestGroupAdmin(django.test.TestCase):
         self.assertEqual(1, group.user_set.filter(username='user_to_add').count())
         self.assertEqual(0, group.user_set.filter(username='user_to_remove').count())
 
+    def test_post_group_change_updates_batch_access(self):
+        user_to_add = User.objects.create_user('user_to_add', password='secret')
+        group = Group.objects.create(name='testgroup')
+        project = Project.objects.create()
+        batch = Batch.objects.create(custom_permissions=True, project=project)
+        assign_perm('can_work_on_batch', group, batch)
+        self.assertEqual(Batch.access_permitted_ids_for(user_to_add), set())
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        client.post(reverse('turkle_admin:auth_group_change', args=(group.id,)), {
+            'name': 'testgroup',
+            'users': [user_to_add.id],
+        })
+        self.assertEqual(Batch.access_permitted_ids_for(user_to_add), {batch.id})
+
     def test_get_group_changelist(self):
         Group.objects.create(name='testgroup')
         client = django.test.Client()
@@ -599,3 +984,42 @@ class TestReviewBatch(django.test.TestCase):
         messages = list(get_messages(response.wsgi_request))
         self.assertEqual(len(messages), 1)
         self.assertEqual(str(messages[0]), 'Cannot find Batch with ID 666')
+
+    def test_batch_review(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        project = Project.objects.create(name='foo', html_template='<textarea>')
+        batch = Batch.objects.create(project=project, published=False)
+        tasks = [Task.objects.create(batch=batch) for _ in range(3)]
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('turkle_admin:review_batch', kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['first_task_id'], tasks[0].id)
+        self.assertEqual(response.context['last_task_id'], tasks[2].id)
+        self.assertEqual(response.context['total_tasks'], 3)
+
+    def test_batch_review_task_ids(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        project = Project.objects.create(name='foo', html_template='<textarea>')
+        batch = Batch.objects.create(project=project)
+        other_batch = Batch.objects.create(project=project)
+        task_ids = []
+        for _ in range(5):
+            task_ids.append(Task.objects.create(batch=batch).id)
+            Task.objects.create(batch=other_batch)
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        url = reverse('turkle_admin:review_batch_task_ids', kwargs={'batch_id': batch.id})
+
+        response = client.get(url, {'limit': 2})
+        self.assertEqual(response.json(), {'task_ids': task_ids[:2]})
+        response = client.get(url, {'after': task_ids[1], 'limit': 2})
+        self.assertEqual(response.json(), {'task_ids': task_ids[2:4]})
+        response = client.get(url, {'after': task_ids[4]})
+        self.assertEqual(response.json(), {'task_ids': []})
+        response = client.get(url, {'before': task_ids[4], 'limit': 2})
+        self.assertEqual(response.json(), {'task_ids': task_ids[2:4]})
+        response = client.get(url, {'before': task_ids[0]})
+        self.assertEqual(response.json(), {'task_ids': []})
+        response = client.get(url, {'after': 'foo'})
+        self.assertEqual(response.status_code, 400)
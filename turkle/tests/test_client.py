@@ -1,10 +1,12 @@
 import argparse
+from django.conf import settings
 import django.test
 import os
 import requests
 import tempfile
 
 from scripts.client import TurkleClient
+from turkle.models import Batch, Task
 
 # Integration tests for the command line scripts
 
@@ -14,6 +16,11 @@ class TestClient(django.test.LiveServerTestCase):
 
     def setUp(self):
         self.client = TurkleClient(self.live_server_url, "admin", "password")
+        job_files_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(job_files_dir.cleanup)
+        settings_override = django.test.override_settings(TURKLE_JOB_FILES_DIR=job_files_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
 
     def test_login_failure(self):
         client = TurkleClient(self.live_server_url, "admin", "chicken")
@@ -25,6 +32,18 @@ class TestClient(django.test.LiveServerTestCase):
     def test_add_user_invalid_username(self):
         self.assertFalse(self.client.add_user("tony#", "password"))
 
+    def test_benchmark(self):
+        batch = Batch.objects.create(name='Benchmark', project_id=1, published=True)
+        Task.objects.create(batch=batch, input_csv_fields={'content': 'one'})
+        Task.objects.create(batch=batch, input_csv_fields={'content': 'two'})
+        Batch.invalidate_access_permitted_cache()
+
+        latencies = self.client.benchmark(batch.id, 5)
+        # stops when there are no more tasks to accept
+        self.assertEqual(len(latencies['accept']), 2)
+        self.assertEqual(len(latencies['submit']), 2)
+        self.assertEqual(batch.task_set.filter(completed=True).count(), 2)
+
     def test_download(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             self.client.download(tmpdir)
@@ -55,3 +74,5 @@ class TestClient(django.test.LiveServerTestCase):
         options.csv = os.path.join(resources_dir, 'sentiment_bad.csv')
 
         self.assertFalse(self.client.upload(options))
+        # the rejected upload is discarded
+        self.assertEqual(os.listdir(settings.TURKLE_JOB_FILES_DIR), [])
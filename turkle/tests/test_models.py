@@ -3,15 +3,22 @@
 import datetime
 from io import StringIO
 import os.path
+import threading
+import time
+import unittest
 
 from django.contrib.auth.models import AnonymousUser, Group, User
 from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.utils import OperationalError
 import django.test
 from django.utils import timezone
 from guardian.shortcuts import assign_perm, get_group_perms
 
 from .utility import save_model
-from turkle.models import Task, TaskAssignment, Batch, Project
+from turkle.models import (Task, TaskAssignment, TaskAssignmentRollup, Batch, BatchAnswerField,
+                           BatchTaskCounts, Project)
 from turkle.utils import get_turkle_template_limit
 
 
@@ -148,6 +155,43 @@ class TestTaskAssignment(django.test.TestCase):
         TaskAssignment.expire_all_abandoned()
         self.assertEqual(TaskAssignment.objects.count(), 1)
 
+    def test_expire_all_abandoned__chunked(self):
+        past = timezone.now() - datetime.timedelta(hours=2)
+
+        project = Project.objects.create(login_required=False)
+        batch = Batch.objects.create(
+            allotted_assignment_time=1,
+            assignments_per_task=5,
+            project=project
+        )
+        task = Task.objects.create(batch=batch)
+        for i in range(5):
+            TaskAssignment.objects.create(expires_at=past, task=task)
+        task.refresh_from_db()
+        self.assertEqual(task.assignments_in_progress, 5)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 0)
+
+        (total_deleted, _) = TaskAssignment.expire_all_abandoned(chunk_size=2)
+        self.assertEqual(total_deleted, 5)
+        self.assertEqual(TaskAssignment.objects.count(), 0)
+        task.refresh_from_db()
+        self.assertEqual(task.assignments_in_progress, 0)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 1)
+
+    def test_next_expiration(self):
+        self.assertIsNone(TaskAssignment.next_expiration())
+
+        project = Project.objects.create()
+        batch = Batch.objects.create(assignments_per_task=3, project=project)
+        task = Task.objects.create(batch=batch)
+        soon = timezone.now() + datetime.timedelta(minutes=5)
+        later = timezone.now() + datetime.timedelta(minutes=10)
+        TaskAssignment.objects.create(completed=True, expires_at=soon - datetime.timedelta(
+            minutes=1), task=task)
+        TaskAssignment.objects.create(expires_at=later, task=task)
+        TaskAssignment.objects.create(expires_at=soon, task=task)
+        self.assertEqual(TaskAssignment.next_expiration(), soon)
+
     def test_work_time_in_seconds(self):
         project = Project.objects.create()
         batch = Batch.objects.create(project=project)
@@ -161,6 +205,300 @@ class TestTaskAssignment(django.test.TestCase):
         ta.completed = True
         ta.save()
         self.assertEqual(float(ta.work_time_in_seconds()).is_integer(), True)
+        self.assertEqual(ta.work_time_seconds, ta.work_time_in_seconds())
+
+
+class TestTaskAssignmentCounters(django.test.TestCase):
+    def setUp(self):
+        project = Project.objects.create(name='test', html_template='<textarea>')
+        self.batch = Batch.objects.create(assignments_per_task=2, project=project)
+        self.task = Task.objects.create(batch=self.batch)
+        self.user = User.objects.create_user('testuser', password='secret')
+
+    def assertCounters(self, completed, in_progress):
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.assignments_completed, completed)
+        self.assertEqual(self.task.assignments_in_progress, in_progress)
+
+    def test_accept_submit_and_return(self):
+        ta_1 = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        self.assertCounters(0, 1)
+        ta_2 = TaskAssignment.objects.create(task=self.task)
+        self.assertCounters(0, 2)
+
+        ta_1.completed = True
+        ta_1.save()
+        self.assertCounters(1, 1)
+
+        # Saving a submitted assignment again does not change the counters
+        TaskAssignment.objects.get(id=ta_1.id).save()
+        self.assertCounters(1, 1)
+
+        ta_2.delete()
+        self.assertCounters(1, 0)
+
+    def test_submit_stale_copies(self):
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        copy_1 = TaskAssignment.objects.get(id=ta.id)
+        copy_2 = TaskAssignment.objects.get(id=ta.id)
+
+        # Only the first copy to be submitted updates the counters
+        copy_1.answers = {'answer': 'a'}
+        copy_1.completed = True
+        copy_1.save()
+        copy_2.answers = {'answer': 'b'}
+        copy_2.completed = True
+        copy_2.save()
+        self.assertCounters(1, 0)
+        self.assertFalse(self.task.completed)
+        self.assertEqual(TaskAssignment.objects.get(id=ta.id).answers, {'answer': 'b'})
+
+        # A stale copy that was not submitted does not overwrite completed
+        ta.expires_at = timezone.now()
+        ta.save()
+        self.assertTrue(TaskAssignment.objects.get(id=ta.id).completed)
+        self.assertCounters(1, 0)
+        self.assertFalse(Task.with_incorrect_assignment_counts().exists())
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+        other_user = User.objects.create_user('otheruser', password='secret')
+        self.assertEqual(self.batch.claim_next_task_for(other_user).task_id, self.task.id)
+
+    def test_delete_stale_copies(self):
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        stale_copy = TaskAssignment.objects.get(id=ta.id)
+        ta.completed = True
+        ta.save()
+
+        # The stale copy was loaded before the TaskAssignment was submitted
+        stale_copy.delete()
+        self.assertCounters(0, 0)
+        self.assertEqual(ta.delete()[0], 0)
+        self.assertCounters(0, 0)
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+    def test_delete_user(self):
+        other_user = User.objects.create_user('otheruser', password='secret')
+        TaskAssignment.objects.create(assigned_to=other_user, completed=True, task=self.task)
+        TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        self.assertCounters(1, 1)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).available_tasks, 0)
+
+        # Deleting the User deletes the User's TaskAssignments without calling delete()
+        self.user.delete()
+        self.assertCounters(1, 0)
+        self.assertFalse(Task.with_incorrect_assignment_counts().exists())
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+        counts = BatchTaskCounts.objects.get(batch=self.batch)
+        self.assertEqual(counts.available_tasks, 1)
+        self.assertEqual(counts.low_water_mark, self.task.id)
+        third_user = User.objects.create_user('thirduser', password='secret')
+        self.assertEqual(self.batch.claim_next_task_for(third_user).task_id, self.task.id)
+
+    def test_submit_completes_task(self):
+        ta_1 = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        ta_2 = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+
+        ta_1 = TaskAssignment.objects.get(id=ta_1.id)
+        ta_1.answers = {'answer': 'a'}
+        ta_1.completed = True
+        # UPDATE TaskAssignment, UPDATE Task, SELECT Batch ID, UPDATE rollup,
+        # INSERT rollup, UPDATE rollup, INSERT answer names
+        with self.assertNumQueries(7):
+            ta_1.save()
+        self.task.refresh_from_db()
+        self.assertFalse(self.task.completed)
+
+        ta_2 = TaskAssignment.objects.get(id=ta_2.id)
+        ta_2.answers = {'answer': 'b'}
+        ta_2.completed = True
+        ta_2.task = self.task
+        # UPDATE TaskAssignment, UPDATE Task, UPDATE rollup
+        with self.assertNumQueries(3):
+            ta_2.save()
+        self.task.refresh_from_db()
+        self.assertTrue(self.task.completed)
+        self.assertCounters(2, 0)
+        self.assertEqual(
+            list(BatchAnswerField.objects.filter(batch=self.batch).values_list('name', flat=True)),
+            ['answer'])
+
+    def test_save_incomplete_assignment(self):
+        ta = TaskAssignment.objects.create(task=self.task)
+        ta = TaskAssignment.objects.get(id=ta.id)
+        expires_at = ta.expires_at
+
+        # Saving an Assignment that is not being completed does not check the Task
+        with self.assertNumQueries(1):
+            ta.save()
+        self.assertEqual(TaskAssignment.objects.get(id=ta.id).expires_at, expires_at)
+
+    def test_task_save_does_not_overwrite_counters(self):
+        stale_task = Task.objects.get(id=self.task.id)
+        TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        stale_task.input_csv_fields = {'foo': 'bar'}
+        stale_task.save()
+        self.assertCounters(0, 1)
+        self.assertEqual(self.task.input_csv_fields, {'foo': 'bar'})
+
+    def test_expire_all_abandoned(self):
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+        ta = TaskAssignment.objects.create(task=self.task)
+        TaskAssignment.objects.filter(id=ta.id).update(
+            expires_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertCounters(1, 1)
+
+        TaskAssignment.expire_all_abandoned()
+        self.assertCounters(1, 0)
+        other_user = User.objects.create_user('other_user', password='secret')
+        self.assertEqual(self.batch.total_available_tasks_for(other_user), 1)
+
+    def test_expire_all_abandoned_in_chunks(self):
+        batch = Batch.objects.create(assignments_per_task=2, project=self.batch.project)
+        task_1 = Task.objects.create(batch=batch)
+        task_2 = Task.objects.create(batch=batch)
+        expired_ids = [TaskAssignment.objects.create(task=task).id
+                       for task in (task_1, task_1, task_2)]
+        TaskAssignment.objects.create(task=task_2)
+        TaskAssignment.objects.filter(id__in=expired_ids).update(
+            expires_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 0)
+
+        self.assertEqual(TaskAssignment.expire_all_abandoned(chunk_size=2)[0], 3)
+        task_1.refresh_from_db()
+        task_2.refresh_from_db()
+        self.assertEqual(task_1.assignments_in_progress, 0)
+        self.assertEqual(task_2.assignments_in_progress, 1)
+        self.assertFalse(Task.with_incorrect_assignment_counts().exists())
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+        counts = BatchTaskCounts.objects.get(batch=batch)
+        self.assertEqual(counts.available_tasks, 2)
+        self.assertEqual(counts.low_water_mark, task_1.id)
+
+    def test_rebuild_assignment_counters(self):
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+        TaskAssignment.objects.create(task=self.task)
+        Task.objects.filter(id=self.task.id).update(assignments_completed=5,
+                                                    assignments_in_progress=5)
+        self.assertEqual(list(Task.with_incorrect_assignment_counts()), [self.task])
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_assignment_counters', '--check')
+        self.assertCounters(5, 5)
+
+        call_command('rebuild_assignment_counters')
+        self.assertCounters(1, 1)
+        self.assertFalse(Task.with_incorrect_assignment_counts().exists())
+        call_command('rebuild_assignment_counters', '--check')
+
+    def test_rebuild_completed_status(self):
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+        Task.objects.filter(id=self.task.id).update(completed=True)
+        task_2 = Task.objects.create(batch=self.batch)
+        for _ in range(2):
+            TaskAssignment.objects.create(completed=True, task=task_2)
+        Task.objects.filter(id=task_2.id).update(completed=False)
+        self.assertEqual(set(Task.with_incorrect_completed_status()), {self.task, task_2})
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_assignment_counters', '--check')
+        call_command('rebuild_assignment_counters')
+        self.task.refresh_from_db()
+        task_2.refresh_from_db()
+        self.assertFalse(self.task.completed)
+        self.assertTrue(task_2.completed)
+        self.assertFalse(Task.with_incorrect_completed_status().exists())
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).available_tasks, 1)
+
+    def test_batch_available_tasks(self):
+        def available_tasks():
+            return BatchTaskCounts.objects.get(batch=self.batch).available_tasks
+
+        self.assertEqual(available_tasks(), 1)
+        Task.objects.create(batch=self.batch)
+        self.assertEqual(available_tasks(), 2)
+
+        ta_1 = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        self.assertEqual(available_tasks(), 2)
+        ta_2 = TaskAssignment.objects.create(task=self.task)
+        self.assertEqual(available_tasks(), 1)
+
+        ta_1.completed = True
+        ta_1.save()
+        self.assertEqual(available_tasks(), 1)
+
+        ta_2.delete()
+        self.assertEqual(available_tasks(), 2)
+
+        ta_3 = TaskAssignment.objects.create(task=self.task)
+        ta_3.completed = True
+        ta_3.save()
+        self.assertEqual(available_tasks(), 1)
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+    def test_batch_available_tasks_after_expiry(self):
+        TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        ta = TaskAssignment.objects.create(task=self.task)
+        TaskAssignment.objects.filter(id=ta.id).update(
+            expires_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).available_tasks, 0)
+
+        TaskAssignment.expire_all_abandoned()
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).available_tasks, 1)
+
+    def test_batch_low_water_mark(self):
+        batch = Batch.objects.create(assignments_per_task=1, project=self.batch.project)
+        tasks = [Task.objects.create(batch=batch) for _ in range(3)]
+
+        def low_water_mark():
+            return BatchTaskCounts.objects.get(batch=batch).low_water_mark
+
+        ta_1 = batch.claim_next_task_for(self.user)
+        self.assertEqual(ta_1.task, tasks[0])
+        self.assertEqual(low_water_mark(), tasks[1].id)
+        ta_2 = batch.claim_next_task_for(self.user)
+        self.assertEqual(ta_2.task, tasks[1])
+        self.assertEqual(low_water_mark(), tasks[2].id)
+
+        # Returning a Task lowers the mark
+        ta_1.delete()
+        self.assertEqual(low_water_mark(), tasks[0].id)
+        self.assertEqual(batch.claim_next_task_for(self.user).task, tasks[0])
+        self.assertEqual(batch.claim_next_task_for(self.user).task, tasks[2])
+        # No Tasks are available
+        self.assertEqual(low_water_mark(), tasks[2].id + 1)
+        self.assertIsNone(batch.claim_next_task_for(self.user))
+
+        # Tasks with expired assignments before the mark are available
+        TaskAssignment.objects.filter(id=ta_2.id).update(
+            expires_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(list(batch.available_tasks_for(self.user)), [tasks[1]])
+        self.assertEqual(batch.claim_next_task_for(self.user).task, tasks[1])
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+    def test_rebuild_batch_low_water_mark(self):
+        task_2 = Task.objects.create(batch=self.batch)
+        TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        TaskAssignment.objects.create(task=self.task)
+
+        # A mark past an available Task is incorrect, an earlier mark is not
+        BatchTaskCounts.objects.filter(batch=self.batch).update(low_water_mark=task_2.id + 1)
+        self.assertTrue(BatchTaskCounts.with_incorrect_counts().exists())
+        BatchTaskCounts.objects.filter(batch=self.batch).update(low_water_mark=0)
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+        call_command('rebuild_assignment_counters')
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).low_water_mark, task_2.id)
+
+    def test_rebuild_batch_available_tasks(self):
+        BatchTaskCounts.objects.filter(batch=self.batch).delete()
+        call_command('rebuild_assignment_counters')
+        self.assertEqual(BatchTaskCounts.objects.get(batch=self.batch).available_tasks, 1)
+
+        BatchTaskCounts.objects.filter(batch=self.batch).update(available_tasks=7)
+        self.assertTrue(BatchTaskCounts.with_incorrect_counts().exists())
+        call_command('rebuild_assignment_counters')
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
 
 
 class TestBatch(django.test.TestCase):
@@ -229,6 +567,53 @@ class TestBatch(django.test.TestCase):
         # add superusers should have access to it
         self.assertEqual(len(batch.access_permitted_for(self.admin)), 1)
 
+    def test_access_permitted_ids_for(self):
+        user = User.objects.create_user('testuser', password='secret')
+        project = Project.objects.create()
+        batch = Batch.objects.create(custom_permissions=True, project=project)
+        self.assertEqual(Batch.access_permitted_ids_for(user), set())
+
+        # Cached until the permissions cache is invalidated
+        assign_perm('can_work_on_batch', user, batch)
+        self.assertEqual(Batch.access_permitted_ids_for(user), set())
+        Batch.invalidate_access_permitted_cache()
+        self.assertEqual(Batch.access_permitted_ids_for(user), {batch.id})
+
+        batch.active = False
+        batch.save()
+        self.assertEqual(Batch.access_permitted_ids_for(user), set())
+
+        project.copy_permissions_to_batches()
+        project.active = False
+        project.save()
+        self.assertEqual(Batch.access_permitted_ids_for(self.admin), set())
+
+    def test_access_permitted_for_mixed_permissions(self):
+        user = User.objects.create_user('testuser', password='secret')
+        inactive_user = User.objects.create_user('inactive', password='secret', is_active=False)
+        group = Group.objects.create(name='testgroup')
+        user.groups.add(group)
+        project = Project.objects.create()
+        public_batch = Batch.objects.create(login_required=False, project=project)
+        login_batch = Batch.objects.create(project=project)
+        group_batch = Batch.objects.create(custom_permissions=True, project=project)
+        user_batch = Batch.objects.create(custom_permissions=True, project=project)
+        Batch.objects.create(custom_permissions=True, project=project)
+        assign_perm('can_work_on_batch', group, group_batch)
+        assign_perm('can_work_on_batch', user, user_batch)
+
+        self.assertEqual(
+            set(Batch.access_permitted_for(user)),
+            {public_batch, login_batch, group_batch, user_batch})
+        self.assertEqual(set(Batch.access_permitted_for(AnonymousUser())), {public_batch})
+        self.assertEqual(len(Batch.access_permitted_for(inactive_user)), 0)
+        self.assertEqual(len(Batch.access_permitted_for(self.admin)), 5)
+
+        # The result is a QuerySet that can be filtered further
+        self.assertEqual(
+            list(Batch.access_permitted_for(user).filter(custom_permissions=True).order_by('id')),
+            [group_batch, user_batch])
+
     def test_batch_to_csv(self):
         template = '<p>${number} - ${letter}</p><textarea>'
         project = Project.objects.create(name='test', html_template=template)
@@ -403,6 +788,78 @@ class TestBatch(django.test.TestCase):
         rows = csv_output.getvalue().splitlines()
         self.assertEqual(len(rows), 3)
 
+    def test_batch_to_csv_header_from_metadata(self):
+        project = Project.objects.create(
+            name='test', html_template='<p>${number} - ${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        batch.create_tasks_from_csv(StringIO('number,letter\n1,a\n2,b\n'))
+        self.assertEqual(batch.input_csv_fieldnames, ['letter', 'number'])
+        self.assertEqual(Batch.objects.get(id=batch.id).input_csv_fieldnames,
+                         ['letter', 'number'])
+
+        header = next(batch.to_csv_lines())
+        self.assertEqual(header.split(',')[-3:],
+                         ['"Input.letter"', '"Input.number"', '"Turkle.Username"\r\n'])
+
+        task = batch.task_set.first()
+        TaskAssignment.objects.create(answers={'combined': '1a'}, completed=True, task=task)
+        TaskAssignment.objects.create(answers={'combined': '1a', 'notes': ''}, task=task)
+        self.assertEqual(BatchAnswerField.objects.filter(batch=batch).count(), 2)
+        # Names can only be recorded once per Batch
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            BatchAnswerField.objects.create(batch=batch, name='notes')
+        BatchAnswerField.add_names(batch.id, ['combined', 'notes'])
+        self.assertEqual(BatchAnswerField.objects.filter(batch=batch).count(), 2)
+        header = next(batch.to_csv_lines())
+        self.assertEqual(header.split(',')[-4:],
+                         ['"Input.number"', '"Answer.combined"', '"Answer.notes"',
+                          '"Turkle.Username"\r\n'])
+
+    def test_batch_to_csv_lines_in_chunks(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        batch.create_tasks_from_csv(StringIO('letter\na\nb\nc\nd\ne\n'))
+        for task in batch.task_set.order_by('-id'):
+            TaskAssignment.objects.create(answers={'letter': task.input_csv_fields['letter']},
+                                          completed=True, task=task)
+        TaskAssignment.objects.create(task=batch.task_set.first())
+
+        # One query for the header, and one per chunk of two TaskAssignments
+        with self.assertNumQueries(4):
+            lines = list(batch.to_csv_lines(chunk_size=2))
+        self.assertEqual(lines, list(batch.to_csv_lines()))
+        rows = [line.split(',')[-2] for line in lines[1:]]
+        self.assertEqual(rows, ['"e"', '"d"', '"c"', '"b"', '"a"'])
+
+    def test_batch_create_tasks_from_csv_in_chunks(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        progress = []
+
+        num_created = batch.create_tasks_from_csv(
+            StringIO('letter\na\nb\n\nc\nd\ne\n'), chunk_size=2,
+            progress_callback=progress.append)
+
+        self.assertEqual(num_created, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(
+            [t.input_csv_fields['letter'] for t in batch.task_set.order_by('id')],
+            ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 5)
+
+    def test_batch_create_tasks_from_csv_rolls_back_on_failure(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        def fail_after_first_chunk(num_created):
+            raise RuntimeError('Upload interrupted')
+
+        with self.assertRaises(RuntimeError):
+            batch.create_tasks_from_csv(StringIO('letter\na\nb\nc\n'), chunk_size=2,
+                                        progress_callback=fail_after_first_chunk)
+        self.assertEqual(batch.task_set.count(), 0)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 0)
+
     def test_batch_from_emoji_csv(self):
         template = '<p>${emoji} - ${more_emoji}</p><textarea>'
         project = Project(name='test', html_template=template)
@@ -507,6 +964,174 @@ class TestBatch(django.test.TestCase):
             ).clean()
 
 
+class TestBatchClaimNextTask(django.test.TransactionTestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name='test', html_template='<textarea>')
+
+    def _claim_concurrently(self, batch, users, claims_per_user):
+        """Each user claims Tasks from the batch in their own thread
+
+        Returns:
+            List of TaskAssignment IDs claimed by the threads
+        """
+        claimed_ids = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(len(users))
+
+        def worker(user):
+            try:
+                start.wait()
+                for _ in range(claims_per_user):
+                    while True:
+                        try:
+                            task_assignment = batch.claim_next_task_for(user)
+                            break
+                        except OperationalError:
+                            # SQLite reports lock contention between threads
+                            # as an error instead of waiting
+                            time.sleep(0.001)
+                    if task_assignment is None:
+                        break
+                    with lock:
+                        claimed_ids.append(task_assignment.id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return claimed_ids
+
+    def test_claim_next_task_for(self):
+        user = User.objects.create_user('testuser', password='secret')
+        batch = Batch.objects.create(project=self.project)
+        task_1 = Task.objects.create(batch=batch)
+        task_2 = Task.objects.create(batch=batch)
+
+        task_assignment = batch.claim_next_task_for(user)
+        self.assertEqual(task_assignment.task, task_1)
+        self.assertEqual(task_assignment.assigned_to, user)
+        task_assignment = batch.claim_next_task_for(user)
+        self.assertEqual(task_assignment.task, task_2)
+        self.assertIsNone(batch.claim_next_task_for(user))
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Query count is specific to SQLite')
+    def test_claim_next_task_for__number_of_queries(self):
+        user = User.objects.create_user('testuser', password='secret')
+        batch = Batch.objects.create(project=self.project)
+        Task.objects.create(batch=batch)
+        task_2 = Task.objects.create(batch=batch)
+
+        # BEGIN, SELECT next Task, UPDATE to lock the Task, INSERT TaskAssignment,
+        # UPDATE Task counters, UPDATE BatchTaskCounts, SELECT next available
+        # Task and UPDATE the low-water mark
+        with self.assertNumQueries(8):
+            batch.claim_next_task_for(user)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).low_water_mark, task_2.id)
+
+    def test_claim_next_task_for__task_queryset(self):
+        user = User.objects.create_user('testuser', password='secret')
+        batch = Batch.objects.create(project=self.project)
+        Task.objects.create(batch=batch)
+        task_2 = Task.objects.create(batch=batch)
+
+        task_assignment = batch.claim_next_task_for(
+            user, batch.available_tasks_for(user).filter(id=task_2.id))
+        self.assertEqual(task_assignment.task, task_2)
+        self.assertIsNone(batch.claim_next_task_for(
+            user, batch.available_tasks_for(user).filter(id=task_2.id)))
+
+    def test_claim_next_task_for__anonymous_user(self):
+        batch = Batch.objects.create(login_required=False, project=self.project)
+        task = Task.objects.create(batch=batch)
+
+        task_assignment = batch.claim_next_task_for(AnonymousUser())
+        self.assertEqual(task_assignment.task, task)
+        self.assertIsNone(task_assignment.assigned_to)
+
+    def test_claim_next_task_for__reclaims_expired_assignment(self):
+        user = User.objects.create_user('testuser', password='secret')
+        other_user = User.objects.create_user('otheruser', password='secret')
+        batch = Batch.objects.create(project=self.project)
+        task = Task.objects.create(batch=batch)
+        expired = TaskAssignment.objects.create(
+            assigned_to=other_user, expires_at=timezone.now() - datetime.timedelta(hours=2),
+            task=task)
+
+        task_assignment = batch.claim_next_task_for(user)
+        self.assertEqual(task_assignment.task, task)
+        self.assertFalse(TaskAssignment.objects.filter(id=expired.id).exists())
+        task.refresh_from_db()
+        self.assertEqual(task.assignments_in_progress, 1)
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 0)
+        self.assertIsNone(batch.claim_next_task_for(other_user))
+
+    def test_claim_next_task_for__reclaims_own_expired_assignment__apt_is_2(self):
+        user = User.objects.create_user('testuser', password='secret')
+        other_user = User.objects.create_user('otheruser', password='secret')
+        batch = Batch.objects.create(assignments_per_task=2, project=self.project)
+        task = Task.objects.create(batch=batch)
+        past = timezone.now() - datetime.timedelta(hours=2)
+        expired = TaskAssignment.objects.create(assigned_to=user, expires_at=past, task=task)
+        TaskAssignment.objects.create(assigned_to=other_user, expires_at=past, task=task)
+
+        # The user's own expired assignment does not keep the Task from the user
+        batch_query = Batch.objects.filter(id=batch.id)
+        self.assertEqual(batch.total_available_tasks_for(user), 1)
+        self.assertEqual(Batch.available_task_counts_for(batch_query, user)[batch.id], 1)
+        task_assignment = batch.claim_next_task_for(user)
+        self.assertEqual(task_assignment.task, task)
+        self.assertFalse(TaskAssignment.objects.filter(id=expired.id).exists())
+        task.refresh_from_db()
+        self.assertEqual(task.assignments_in_progress, 1)
+
+        # Once the user holds an assignment for the Task, the Task is not
+        # available to the user, and the other user reclaims their own
+        self.assertEqual(batch.total_available_tasks_for(user), 0)
+        self.assertEqual(Batch.available_task_counts_for(batch_query, user)[batch.id], 0)
+        self.assertIsNone(batch.claim_next_task_for(user))
+        self.assertEqual(Batch.available_task_counts_for(batch_query, other_user)[batch.id], 1)
+        self.assertEqual(batch.claim_next_task_for(other_user).task, task)
+        task.refresh_from_db()
+        self.assertEqual(task.assignments_in_progress, 2)
+        self.assertFalse(Task.with_incorrect_assignment_counts().exists())
+        self.assertFalse(BatchTaskCounts.with_incorrect_counts().exists())
+
+    def test_concurrent_claims__apt_is_1(self):
+        batch = Batch.objects.create(project=self.project)
+        tasks = [Task.objects.create(batch=batch) for _ in range(40)]
+        users = [User.objects.create_user('user_%d' % i, password='secret') for i in range(8)]
+
+        claimed_ids = self._claim_concurrently(batch, users, 10)
+
+        # Every Task was claimed exactly once
+        self.assertEqual(len(claimed_ids), len(tasks))
+        self.assertEqual(TaskAssignment.objects.count(), len(tasks))
+        self.assertEqual(
+            sorted(TaskAssignment.objects.values_list('task_id', flat=True)),
+            sorted(t.id for t in tasks))
+
+    def test_concurrent_claims__apt_is_3(self):
+        batch = Batch.objects.create(assignments_per_task=3, project=self.project)
+        tasks = [Task.objects.create(batch=batch) for _ in range(10)]
+        users = [User.objects.create_user('user_%d' % i, password='secret') for i in range(6)]
+
+        claimed_ids = self._claim_concurrently(batch, users, 10)
+
+        # Each Task was claimed by 3 different Users
+        self.assertEqual(len(claimed_ids), 3 * len(tasks))
+        for task in tasks:
+            assigned_to = list(task.taskassignment_set.values_list('assigned_to_id', flat=True))
+            self.assertEqual(len(assigned_to), 3)
+            self.assertEqual(len(set(assigned_to)), 3)
+
+
 class TestBatchAvailableTasks(django.test.TestCase):
     def setUp(self):
         self.batch_query = Batch.objects.all()
@@ -543,6 +1168,22 @@ class TestBatchAvailableTasks(django.test.TestCase):
         self.assertEqual(Batch.available_task_counts_for(self.batch_query, self.user)[batch.id], 0)
         self.assertEqual(batch.next_available_task_for(self.user), None)
 
+    def test_available_tasks_for__expired_assignment(self):
+        batch = Batch.objects.create(assignments_per_task=2, project=self.project)
+        task = Task.objects.create(batch=batch)
+        other_user = User.objects.create_user('otheruser', password='secret')
+        past = timezone.now() - datetime.timedelta(hours=2)
+        TaskAssignment.objects.create(assigned_to=other_user, completed=True, task=task)
+        TaskAssignment.objects.create(assigned_to=other_user, expires_at=past, task=task)
+
+        # The Task is full, but the expired assignment can be reclaimed
+        self.assertEqual(BatchTaskCounts.objects.get(batch=batch).available_tasks, 0)
+        self.assertEqual(batch.total_available_tasks_for(self.user), 1)
+        self.assertEqual(Batch.available_task_counts_for(self.batch_query, self.user)[batch.id], 1)
+        self.assertEqual(batch.total_available_tasks_for(other_user), 0)
+        self.assertEqual(Batch.available_task_counts_for(self.batch_query, other_user)[batch.id],
+                         0)
+
     def test_available_tasks_for__apt_is_2(self):
         batch = Batch(
             assignments_per_task=2,
@@ -682,10 +1323,130 @@ class TestBatchReportFunctions(django.test.TestCase):
         self.batch.mean_work_time_in_seconds()
         self.batch.total_work_time_in_seconds()
 
+    def test_work_time_in_seconds_stats_values(self):
+        for work_time in [10, 40, 20, 90]:
+            TaskAssignment.objects.create(
+                assigned_to=self.user_1,
+                completed=True,
+                task=self.task_1,
+                work_time_seconds=work_time,
+            )
+        # Incomplete assignments are not included
+        TaskAssignment.objects.create(assigned_to=self.user_2, task=self.task_1)
+        self.assertEqual(self.batch.median_work_time_in_seconds(), 30)
+        self.assertEqual(self.batch.mean_work_time_in_seconds(), 40)
+        self.assertEqual(self.batch.total_work_time_in_seconds(), 160)
+
+        TaskAssignment.objects.create(
+            assigned_to=self.user_2,
+            completed=True,
+            task=self.task_1,
+            work_time_seconds=35,
+        )
+        self.assertEqual(self.batch.median_work_time_in_seconds(), 35)
+
     def test_work_time_in_seconds_stats_with_no_completed_assignments(self):
-        self.batch.median_work_time_in_seconds()
-        self.batch.mean_work_time_in_seconds()
-        self.batch.total_work_time_in_seconds()
+        self.assertEqual(self.batch.median_work_time_in_seconds(), 0)
+        self.assertEqual(self.batch.mean_work_time_in_seconds(), 0)
+        self.assertEqual(self.batch.total_work_time_in_seconds(), 0)
+
+
+class TestTaskAssignmentRollup(django.test.TestCase):
+    def setUp(self):
+        project = Project.objects.create(name='test')
+        self.batch = Batch.objects.create(assignments_per_task=10, project=project)
+        self.task = Task.objects.create(batch=self.batch)
+        self.user_1 = User.objects.create_user('user_1', password='secret')
+        self.user_2 = User.objects.create_user('user_2', password='secret')
+
+    def _submit(self, user, work_time):
+        ta = TaskAssignment.objects.create(assigned_to=user, task=self.task)
+        ta.completed = True
+        ta.work_time_seconds = work_time
+        ta.save()
+        return ta
+
+    def test_submit_adds_to_rollups(self):
+        self._submit(self.user_1, 10)
+        self._submit(self.user_1, 10)
+        self._submit(self.user_2, 100)
+        # Incomplete assignments are not counted
+        TaskAssignment.objects.create(assigned_to=self.user_2, task=self.task)
+
+        self.assertEqual(TaskAssignmentRollup.objects.count(), 2)
+        summary = TaskAssignmentRollup.summarize(self.batch.rollups.all())
+        self.assertEqual(summary.assignments_completed, 3)
+        self.assertEqual(summary.total_work_time, 120)
+        self.assertEqual(summary.mean_work_time(), 40)
+        self.assertEqual(summary.median_work_time(), 10)
+        first_ta = TaskAssignment.objects.filter(completed=True).order_by('id').first()
+        self.assertEqual(summary.first_finished_at, first_ta.updated_at)
+        self.assertEqual(first_ta.rollup_day, timezone.localdate())
+        self.assertEqual(first_ta.rollup_work_time_bucket,
+                         TaskAssignmentRollup.bucket_for_work_time(10))
+
+        user_summaries = TaskAssignmentRollup.summarize(self.batch.rollups.all(),
+                                                        group_by='user_id')
+        self.assertEqual(user_summaries[self.user_1.id].assignments_completed, 2)
+        self.assertEqual(user_summaries[self.user_2.id].total_work_time, 100)
+
+    def test_approximate_median(self):
+        for work_time in [90, 100, 110, 1000, 5000]:
+            self._submit(self.user_1, work_time)
+        median = TaskAssignmentRollup.summarize(self.batch.rollups.all()).median_work_time()
+        self.assertLess(abs(median - 110) / 110, 0.1)
+
+    def test_delete_completed_assignment(self):
+        ta = self._submit(self.user_1, 10)
+        self._submit(self.user_1, 20)
+        # An edit after the assignment was submitted does not change the
+        # rollup row that it is removed from
+        ta.answers = {'corrected': 'yes'}
+        ta.save()
+        TaskAssignment.objects.filter(id=ta.id).update(
+            updated_at=timezone.now() - datetime.timedelta(days=3))
+        TaskAssignment.objects.get(id=ta.id).delete()
+        summary = TaskAssignmentRollup.summarize(self.batch.rollups.all())
+        self.assertEqual(summary.assignments_completed, 1)
+        self.assertEqual(summary.total_work_time, 20)
+
+        # Assignments that were not completed are not removed from the rollups
+        TaskAssignment.objects.create(assigned_to=self.user_1, task=self.task).delete()
+        self.assertEqual(
+            TaskAssignmentRollup.summarize(self.batch.rollups.all()).assignments_completed, 1)
+
+    def test_submit_stale_copies(self):
+        ta = TaskAssignment.objects.create(assigned_to=self.user_1, task=self.task)
+        stale_copy = TaskAssignment.objects.get(id=ta.id)
+        ta.completed = True
+        ta.save()
+        stale_copy.completed = True
+        stale_copy.work_time_seconds = 500
+        stale_copy.save()
+        self.assertEqual(stale_copy.work_time_seconds, ta.work_time_seconds)
+        summary = TaskAssignmentRollup.summarize(self.batch.rollups.all())
+        self.assertEqual(summary.assignments_completed, 1)
+        self.assertEqual(summary.total_work_time, ta.work_time_seconds)
+
+    def test_uncomplete_assignment(self):
+        ta = self._submit(self.user_1, 10)
+        ta.completed = False
+        ta.save()
+        self.assertEqual(
+            TaskAssignmentRollup.summarize(self.batch.rollups.all()).assignments_completed, 0)
+        ta.completed = True
+        ta.save()
+        summary = TaskAssignmentRollup.summarize(self.batch.rollups.all())
+        self.assertEqual(summary.assignments_completed, 1)
+        self.assertEqual(summary.total_work_time, 10)
+
+    def test_summarize_no_rollups(self):
+        summary = TaskAssignmentRollup.summarize(self.batch.rollups.all())
+        self.assertEqual(summary.assignments_completed, 0)
+        self.assertEqual(summary.mean_work_time(), 0)
+        self.assertEqual(summary.median_work_time(), 0)
+        self.assertEqual(
+            TaskAssignmentRollup.summarize(self.batch.rollups.all(), group_by='user_id'), {})
 
 
 class TestProject(django.test.TestCase):
@@ -992,8 +1753,51 @@ class TestGenerateForm(django.test.TestCase):
         actual = task.populate_html_template()
         self.assertEqual(expect, actual)
 
+    def test_populate_html_template_missing_and_unused_fields(self):
+        project = Project.objects.create(
+            name='test',
+            html_template='<p>${foo} ${missing} ${foo}${bar}</p> $ {} ${}<textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(
+            batch=batch,
+            input_csv_fields={'foo': 'fufu', 'bar': '${foo}', 'unused': 'xyz'})
+        self.assertEqual(
+            task.populate_html_template(),
+            '<p>fufu ${missing} fufu${foo}</p> $ {} ${}<textarea>')
+
+    def test_populate_html_template_repeated_replacement(self):
+        # Values and field names that can form new template variables are
+        # replaced in the order of the CSV fields, one field at a time
+        project = Project.objects.create(name='test', html_template='<p>${a}${b}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'a': 'x${b}y', 'b': 'Z'})
+        self.assertEqual(task.populate_html_template(), '<p>xZyZ</p><textarea>')
+
+        project = Project.objects.create(name='test', html_template='<p>${a}b}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'a}b': 'Q'})
+        self.assertEqual(task.populate_html_template(), '<p>Q</p><textarea>')
+
+        project = Project.objects.create(name='test', html_template='<p>${x${a}}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'a': 'y', 'xy': 'Z'})
+        self.assertEqual(task.populate_html_template(), '<p>Z</p><textarea>')
+
+    def test_populate_html_template_after_template_change(self):
+        project = Project.objects.create(name='test', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'fufu'})
+        self.assertEqual(Task.objects.get(id=task.id).populate_html_template(),
+                         '<p>fufu</p><textarea>')
+
+        project.html_template = '<b>${foo}</b><textarea>'
+        project.save()
+        self.assertEqual(Task.objects.get(id=task.id).populate_html_template(),
+                         '<b>fufu</b><textarea>')
+
 
 __all__ = (
+    'TestBatchClaimNextTask',
     'TestGenerateForm',
     'TestModels',
 )
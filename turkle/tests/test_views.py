@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import threading
+import time
+import unittest
+
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.urls import reverse
 from guardian.shortcuts import assign_perm
 from .utility import save_model
 
-from turkle.models import Task, TaskAssignment, Batch, Project
+from turkle.models import Task, TaskAssignment, Batch, Project, SkippedTask
+from turkle.utils import configure_sqlite_connection
+from turkle.views import _sqlite_write_lock
 
 
 class TestAcceptTask(TestCase):
@@ -127,6 +135,23 @@ class TestAcceptNextTask(TestCase):
         self.assertEqual(str(messages[0]),
                          'Cannot find Task Batch with ID {}'.format(666))
 
+    def test_accept_next_task__no_permission(self):
+        User.objects.create_user('testuser', password='secret')
+        self.batch.custom_permissions = True
+        self.batch.save()
+
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+        response = client.get(reverse('accept_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], reverse('index'))
+        self.assertEqual(self.task.taskassignment_set.count(), 0)
+        messages = list(get_messages(response.wsgi_request))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(str(messages[0]),
+                         'You do not have permission to access Batch foo')
+
     def test_accept_next_task__no_more_tasks(self):
         User.objects.create_user('testuser', password='secret')
         task_assignment = TaskAssignment(completed=True, task=self.task)
@@ -153,15 +178,7 @@ class TestAcceptNextTask(TestCase):
         client = django.test.Client()
         client.login(username='testuser', password='secret')
 
-        # Per the Django docs:
-        #   To modify the session and then save it, it must be stored in a variable first
-        #   (because a new SessionStore is created every time this property is accessed
-        #     https://docs.djangoproject.com/en/1.11/topics/testing/tools/#persistent-state
-        s = client.session
-        s.update({
-            'skipped_tasks_in_batch': {str(self.batch.id): [str(self.task.id)]}
-        })
-        s.save()
+        SkippedTask.skip(User.objects.get(username='testuser'), self.task)
 
         response = client.get(reverse('accept_next_task',
                                       kwargs={'batch_id': self.batch.id}))
@@ -199,6 +216,11 @@ class TestDownloadBatchCSV(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-Disposition'),
                          'attachment; filename="%s"' % self.batch.csv_results_filename())
+        csv_text = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(
+            csv_text.split('\r\n')[0].split(',')[-4:],
+            ['"Input.bar"', '"Input.foo"', '"Answer.a1"', '"Turkle.Username"'])
+        self.assertTrue('"fufu","sauce",""\r\n' in csv_text)
 
     def test_get_as_rando(self):
         client = django.test.Client()
@@ -427,6 +449,31 @@ class TestTaskAssignment(TestCase):
         messages = list(get_messages(response.wsgi_request))
         self.assertEqual(len(messages), 0)
 
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Writes are only serialized for SQLite')
+    def test_get_task_assignment_does_not_wait_for_writes(self):
+        locked = threading.Event()
+        release = threading.Event()
+
+        def write():
+            with _sqlite_write_lock:
+                locked.set()
+                release.wait(5)
+
+        # Another request is writing, e.g. submitting a Task
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.addCleanup(writer.join)
+        self.addCleanup(release.set)
+        locked.wait()
+
+        client = django.test.Client()
+        started_at = time.monotonic()
+        response = client.get(reverse('task_assignment',
+                                      kwargs={'task_id': self.task.id,
+                                              'task_assignment_id': self.task_assignment.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(time.monotonic() - started_at, 4)
+
     def test_get_task_assignment_with_bad_task_id(self):
         client = django.test.Client()
         response = client.get(reverse('task_assignment',
@@ -514,6 +561,34 @@ class TestTaskAssignment(TestCase):
         self.assertEqual(response['Location'], reverse('accept_next_task',
                                                        kwargs={'batch_id': self.task.batch_id}))
 
+    def test_submit_assignment_with_auto_accept__claims_next_task(self):
+        self.task.batch.login_required = False
+        self.task.batch.save()
+        task_two = Task.objects.create(batch=self.task.batch)
+        task_three = Task.objects.create(batch=self.task.batch)
+        client = django.test.Client()
+
+        s = client.session
+        s.update({
+            'auto_accept_status': True,
+            'skipped_tasks_in_batch': {str(self.task.batch_id): [str(task_two.id)]},
+        })
+        s.save()
+
+        response = client.post(reverse('task_assignment',
+                                       kwargs={'task_id': self.task.id,
+                                               'task_assignment_id': self.task_assignment.id}),
+                               {'foo': 'bar'})
+        self.assertEqual(response.status_code, 302)
+        self.task_assignment.refresh_from_db()
+        self.assertTrue(self.task_assignment.completed)
+        next_ha = task_three.taskassignment_set.get()
+        self.assertEqual(response['Location'],
+                         reverse('task_assignment',
+                                 kwargs={'task_id': task_three.id,
+                                         'task_assignment_id': next_ha.id}))
+        self.assertFalse(task_two.taskassignment_set.exists())
+
 
 class TestTaskAssignmentIFrame(TestCase):
     def setUp(self):
@@ -846,6 +921,14 @@ class TestSkipTask(TestCase):
         self.assertEqual(len(messages), 1)
         self.assertEqual(str(messages[0]), 'Only previously skipped Tasks are available')
 
+        # Skip task_one for a second time
+        client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                 'task_id': self.task_one.id}))
+        response = client.get(reverse('preview_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response['Location'], reverse('preview',
+                                                       kwargs={'task_id': self.task_two.id}))
+
     def test_skip_and_accept_next_task(self):
         client = django.test.Client()
 
@@ -918,3 +1001,134 @@ class TestSkipTask(TestCase):
                                       kwargs={'batch_id': self.batch.id}))
         self.assertEqual(response.status_code, 302)
         self.assertTrue('{}/assignment/'.format(self.task_two.id) in response['Location'])
+
+    def test_skip_task__authenticated_user(self):
+        user = User.objects.create_user('testuser', password='secret')
+        other_user = User.objects.create_user('otheruser', password='secret')
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+
+        # Skip task_one
+        response = client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                            'task_id': self.task_one.id}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(SkippedTask.objects.filter(user=user).count(), 1)
+        self.assertFalse(SkippedTask.objects.filter(user=other_user).exists())
+        self.assertNotIn('skipped_tasks_in_batch', client.session)
+
+        # Skipping the same Task twice does not create a second record
+        client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                 'task_id': self.task_one.id}))
+        self.assertEqual(SkippedTask.objects.filter(user=user).count(), 1)
+
+        # Verify that task_one has been skipped for this user, and only this user
+        response = client.get(reverse('preview_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response['Location'], reverse('preview',
+                                                       kwargs={'task_id': self.task_two.id}))
+        other_client = django.test.Client()
+        other_client.login(username='otheruser', password='secret')
+        response = other_client.get(reverse('preview_next_task',
+                                            kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response['Location'], reverse('preview',
+                                                       kwargs={'task_id': self.task_one.id}))
+
+        # Skipped Tasks are remembered across sessions
+        client.logout()
+        client.login(username='testuser', password='secret')
+        response = client.get(reverse('accept_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertTrue('{}/assignment/'.format(self.task_two.id) in response['Location'])
+
+        # With all available Tasks skipped, the skipped Tasks are offered
+        # again, without being cleared by the GET request
+        client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                 'task_id': self.task_three.id}))
+        response = client.get(reverse('preview_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response['Location'], reverse('preview',
+                                                       kwargs={'task_id': self.task_one.id}))
+        messages = list(get_messages(response.wsgi_request))
+        self.assertEqual(str(messages[-1]), 'Only previously skipped Tasks are available')
+        self.assertEqual(SkippedTask.objects.filter(user=user).count(), 2)
+
+        # Skipping task_one a second time clears the other skipped Tasks
+        client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                 'task_id': self.task_one.id}))
+        self.assertEqual(
+            list(SkippedTask.objects.filter(user=user).values_list('task_id', flat=True)),
+            [self.task_one.id])
+        response = client.get(reverse('preview_next_task',
+                                      kwargs={'batch_id': self.batch.id}))
+        self.assertEqual(response['Location'], reverse('preview',
+                                                       kwargs={'task_id': self.task_three.id}))
+
+    def test_skip_task__unknown_task(self):
+        User.objects.create_user('testuser', password='secret')
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+
+        response = client.post(reverse('skip_task', kwargs={'batch_id': self.batch.id,
+                                                            'task_id': 666}))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(SkippedTask.objects.exists())
+
+
+class TestStats(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        other_user = User.objects.create_user('otheruser', password='secret')
+        project_1 = Project.objects.create(name='project_1')
+        project_2 = Project.objects.create(name='project_2')
+        batch_1a = Batch.objects.create(name='batch_1a', project=project_1)
+        batch_1b = Batch.objects.create(name='batch_1b', project=project_1)
+        batch_2 = Batch.objects.create(name='batch_2', project=project_2)
+        for (batch, work_times) in [(batch_1a, [60, 120]), (batch_1b, [3600]), (batch_2, [])]:
+            for work_time in work_times:
+                TaskAssignment.objects.create(
+                    assigned_to=self.user, completed=True,
+                    task=Task.objects.create(batch=batch), work_time_seconds=work_time)
+        TaskAssignment.objects.create(assigned_to=self.user,
+                                      task=Task.objects.create(batch=batch_2))
+        TaskAssignment.objects.create(assigned_to=other_user, completed=True,
+                                      task=Task.objects.create(batch=batch_2),
+                                      work_time_seconds=60)
+
+    def test_stats(self):
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+        with self.assertNumQueries(3):
+            response = client.get(reverse('stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_completed'], 3)
+        self.assertEqual(response.context['total_elapsed_time'], '1h 3m')
+        project_stats = response.context['project_stats']
+        self.assertEqual(len(project_stats), 1)
+        self.assertEqual(project_stats[0]['project_name'], 'project_1')
+        self.assertEqual(project_stats[0]['total_completed_project'], 3)
+        self.assertEqual(
+            [(b['batch_name'], b['total_completed_batch'], b['elapsed_time_batch'])
+             for b in project_stats[0]['batch_stats']],
+            [('batch_1a', 2, '0h 3m'), ('batch_1b', 1, '1h 0m')])
+
+    def test_stats__date_window(self):
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+        response = client.get(reverse('stats'), {'start_date': '2000-01-01',
+                                                 'end_date': '2000-01-02'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_completed'], 0)
+        self.assertEqual(response.context['project_stats'], [])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite connection settings')
+class TestSqliteConnection(django.test.TransactionTestCase):
+    @override_settings(TURKLE_SQLITE_BUSY_TIMEOUT=1234)
+    def test_configure_sqlite_connection(self):
+        configure_sqlite_connection(connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
+            # NORMAL
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
@@ -1,4 +1,14 @@
+from contextlib import contextmanager
+
 from django.conf import settings
+from django.db import connections
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 
 def get_site_name():
@@ -9,6 +19,20 @@ def get_site_name():
     return 'Turkle'
 
 
+def get_turkle_sqlite_busy_timeout():
+    try:
+        return settings.TURKLE_SQLITE_BUSY_TIMEOUT
+    except AttributeError:
+        return 20000
+
+
+def get_turkle_task_creation_chunk_size():
+    try:
+        return settings.TURKLE_TASK_CREATION_CHUNK_SIZE
+    except AttributeError:
+        return 1000
+
+
 def get_turkle_template_limit(in_bytes=False):
     try:
         template_size_limit = settings.TURKLE_TEMPLATE_LIMIT
@@ -19,6 +43,108 @@ def get_turkle_template_limit(in_bytes=False):
     return template_size_limit
 
 
+def get_turkle_background_jobs():
+    try:
+        return settings.TURKLE_BACKGROUND_JOBS
+    except AttributeError:
+        return False
+
+
+def get_turkle_db_health_checks():
+    try:
+        return settings.TURKLE_DB_HEALTH_CHECKS
+    except AttributeError:
+        return False
+
+
+def get_turkle_job_files_dir():
+    try:
+        return settings.TURKLE_JOB_FILES_DIR
+    except AttributeError:
+        return 'job_files'
+
+
+def get_turkle_permission_cache_timeout():
+    try:
+        return settings.TURKLE_PERMISSION_CACHE_TIMEOUT
+    except AttributeError:
+        return 60
+
+
+def get_turkle_upload_expiration():
+    try:
+        return settings.TURKLE_UPLOAD_EXPIRATION
+    except AttributeError:
+        return 24
+
+
+def close_unusable_db_connections(**kwargs):
+    """Close persistent database connections that the server has dropped
+
+    Receiver for the request_started signal.  When TURKLE_DB_HEALTH_CHECKS
+    is True, each database connection kept open between requests by
+    CONN_MAX_AGE is checked (e.g. with a MySQL ping) before the request
+    uses it.  A connection closed by the database server - after MySQL's
+    wait_timeout expires, or a server restart - is replaced by a new
+    connection instead of causing the request to fail.
+    """
+    if not get_turkle_db_health_checks():
+        return
+    for conn in connections.all():
+        if conn.connection is not None and not conn.in_atomic_block and not conn.is_usable():
+            conn.close()
+
+
+@contextmanager
+def exclusive_file_lock(f, blocking=True):
+    """Hold an exclusive lock on an open file, shared by all server processes
+
+    The lock only excludes other code that locks the same file.
+
+    Args:
+        f (file): Open file
+        blocking (bool): If False, raise an OSError instead of waiting
+            when another process holds the lock
+
+    Returns:
+        Context manager that holds the lock until it exits
+    """
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        # Locks the first byte of the file.  Writes to a file opened for
+        # appending still go to the end of the file.
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def configure_sqlite_connection(connection, **kwargs):
+    """Configure a new SQLite database connection for concurrent requests
+
+    Receiver for the connection_created signal.  With write-ahead logging,
+    requests can read from the database while another request is writing
+    to it, and synchronous=NORMAL only flushes the log to disk at
+    checkpoints.  A request that needs to write waits for up to
+    TURKLE_SQLITE_BUSY_TIMEOUT milliseconds for another request's write
+    to finish, instead of failing with a 'database is locked' error.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(get_turkle_sqlite_busy_timeout()))
+
+
 def turkle_vars(request):
     """add variables to the template context"""
     return {
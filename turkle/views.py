@@ -1,36 +1,58 @@
+from contextlib import contextmanager
 from functools import wraps
+import itertools
 import logging
+import threading
 import urllib
 
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction
-from django.db.utils import OperationalError
+from django.db import connection, transaction
+from django.db.models import Count, Sum
 from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils.datastructures import MultiValueDictKeyError
 from django.utils.dateparse import parse_date
 
-from turkle.models import Task, TaskAssignment, Batch, Project
+from turkle.models import Task, TaskAssignment, Batch, SkippedTask
 
 logger = logging.getLogger(__name__)
 
+# Held by serialized_db_writes().  Reentrant, so that serialized
+# code can call other serialized code.
+_sqlite_write_lock = threading.RLock()
 
-def handle_db_lock(func):
-    """Decorator that catches database lock errors from sqlite"""
+
+@contextmanager
+def serialized_db_writes():
+    """Context manager that runs database writes one request at a time
+
+    SQLite allows only one write transaction at a time.  A transaction
+    that reads and then writes can fail with a 'database is locked'
+    error - without waiting for the busy timeout - if another request
+    wrote to the database after the transaction started reading.  When
+    using SQLite, the code in this context is run by one request at a
+    time in each server process, so requests wait for each other instead
+    of failing.  Other databases lock the rows being updated, and are
+    not affected.  Keep the context short, since it blocks other requests.
+    """
+    if connection.vendor != 'sqlite':
+        yield
+        return
+    with _sqlite_write_lock:
+        yield
+
+
+def serialize_db_writes(func):
+    """Decorator that runs a view in serialized_db_writes()
+
+    Only for views that do not render a template.
+    """
     @wraps(func)
     def wrapper(request, *args, **kwargs):
-        try:
+        with serialized_db_writes():
             return func(request, *args, **kwargs)
-        except OperationalError as ex:
-            # sqlite3 cannot handle concurrent transactions.
-            # This should be very rare with just a few users.
-            # If it happens often, switch to mysql or postgres.
-            if str(ex) == 'database is locked':
-                messages.error(request, u'The database is busy. Please try again.')
-                return redirect(index)
-            raise ex
     return wrapper
 
 
@@ -48,8 +70,7 @@ def index(request):
                 'task_assignment_id': ha.id
             })
 
-    batch_list = Batch.access_permitted_for(request.user)
-    batch_query = Batch.objects.filter(id__in=[b.id for b in batch_list])
+    batch_query = Batch.objects.filter(id__in=Batch.access_permitted_ids_for(request.user))
 
     available_task_counts = Batch.available_task_counts_for(batch_query, request.user)
 
@@ -74,7 +95,7 @@ def index(request):
     })
 
 
-@handle_db_lock
+@serialize_db_writes
 def accept_task(request, batch_id, task_id):
     """
     Accept task from preview
@@ -94,33 +115,21 @@ def accept_task(request, batch_id, task_id):
         messages.error(request, u'Cannot find Task with ID {}'.format(task_id))
         return redirect(index)
 
-    try:
-        with transaction.atomic():
-            # Lock access to the specified Task
-            Task.objects.filter(id=task_id).select_for_update()
-
-            # Will throw ObjectDoesNotExist exception if Task no longer available
-            batch.available_tasks_for(request.user).get(id=task_id)
-
-            ha = TaskAssignment()
-            if request.user.is_authenticated:
-                ha.assigned_to = request.user
-            else:
-                ha.assigned_to = None
-            ha.task = task
-            ha.save()
-            if request.user.is_authenticated:
-                logger.info('User(%i) accepted Task(%i)', request.user.id, task.id)
-            else:
-                logger.info('Anonymous user accepted Task(%i)', task.id)
-    except ObjectDoesNotExist:
+    # Returns None if the Task is no longer available
+    ha = batch.claim_next_task_for(
+        request.user, batch.available_tasks_for(request.user).filter(id=task_id))
+    if ha is None:
         messages.error(request, u'The Task with ID {} is no longer available'.format(task_id))
         return redirect(index)
+    if request.user.is_authenticated:
+        logger.info('User(%i) accepted Task(%i)', request.user.id, task.id)
+    else:
+        logger.info('Anonymous user accepted Task(%i)', task.id)
 
     return redirect(task_assignment, task.id, ha.id)
 
 
-@handle_db_lock
+@serialize_db_writes
 def accept_next_task(request, batch_id):
     """
     Accept task from index or auto accept next task
@@ -130,32 +139,24 @@ def accept_next_task(request, batch_id):
       are redirected to the index page with an error message.
     """
     try:
-        with transaction.atomic():
-            batch = Batch.objects.get(id=batch_id)
-
-            # Lock access to all Tasks available to current user in the batch
-            batch.available_task_ids_for(request.user).select_for_update()
-
-            task_id = _skip_aware_next_available_task_id(request, batch)
-
-            if task_id:
-                ha = TaskAssignment()
-                if request.user.is_authenticated:
-                    ha.assigned_to = request.user
-                else:
-                    ha.assigned_to = None
-                ha.task_id = task_id
-                ha.save()
-                if request.user.is_authenticated:
-                    logger.info('User(%i) accepted Task(%i)', request.user.id, task_id)
-                else:
-                    logger.info('Anonymous user accepted Task(%i)', task_id)
+        batch = Batch.objects.get(id=batch_id)
     except ObjectDoesNotExist:
         messages.error(request, u'Cannot find Task Batch with ID {}'.format(batch_id))
         return redirect(index)
 
-    if task_id:
-        return redirect(task_assignment, task_id, ha.id)
+    if batch.id not in Batch.access_permitted_ids_for(request.user):
+        messages.error(request, u'You do not have permission to access Batch {}'.format(
+            batch.name))
+        return redirect(index)
+
+    ha = _skip_aware_claim_next_task(request, batch)
+
+    if ha:
+        if request.user.is_authenticated:
+            logger.info('User(%i) accepted Task(%i)', request.user.id, ha.task_id)
+        else:
+            logger.info('Anonymous user accepted Task(%i)', ha.task_id)
+        return redirect(task_assignment, ha.task_id, ha.id)
     else:
         messages.error(request, u'No more Tasks available for Batch {}'.format(batch.name))
         return redirect(index)
@@ -224,14 +225,33 @@ def task_assignment(request, task_id, task_assignment_id):
     else:
         task_assignment.answers = dict(request.POST.items())
         task_assignment.completed = True
-        task_assignment.save()
+        task_assignment.task = task
+
+        # With auto-accept, the next Task is claimed in the same transaction
+        # as the submission, and the user is redirected straight to it
+        # instead of going through accept_next_task.
+        next_ha = None
+        with serialized_db_writes(), transaction.atomic():
+            task_assignment.save()
+            if auto_accept_status and \
+               task.batch_id in Batch.access_permitted_ids_for(request.user):
+                next_ha = _skip_aware_claim_next_task(request, task.batch)
+
         if request.user.is_authenticated:
             logger.info('User(%i) submitted Task(%i)', request.user.id, task.id)
+            if next_ha:
+                logger.info('User(%i) accepted Task(%i)', request.user.id, next_ha.task_id)
         else:
             logger.info('Anonymous user submitted Task(%i)', task.id)
-
-        if request.session.get('auto_accept_status'):
-            return redirect(accept_next_task, task.batch.id)
+            if next_ha:
+                logger.info('Anonymous user accepted Task(%i)', next_ha.task_id)
+
+        if next_ha:
+            # The local variable task_assignment shadows the view function
+            return redirect('task_assignment', next_ha.task_id, next_ha.id)
+        elif auto_accept_status:
+            # Lets accept_next_task report why no Task could be claimed
+            return redirect(accept_next_task, task.batch_id)
         else:
             return redirect(index)
 
@@ -339,6 +359,7 @@ def preview_next_task(request, batch_id):
         return redirect(index)
 
 
+@serialize_db_writes
 def return_task_assignment(request, task_id, task_assignment_id):
     """
     Security behavior:
@@ -355,6 +376,7 @@ def return_task_assignment(request, task_id, task_assignment_id):
     return redirect(index)
 
 
+@serialize_db_writes
 def skip_and_accept_next_task(request, batch_id, task_id, task_assignment_id):
     """
     Security behavior:
@@ -365,7 +387,7 @@ def skip_and_accept_next_task(request, batch_id, task_id, task_assignment_id):
     if redirect_due_to_error:
         return redirect_due_to_error
 
-    _add_task_id_to_skip_session(request.session, batch_id, task_id)
+    _skip_task(request, batch_id, task_id)
     if request.user.is_authenticated:
         logger.info('User(%i) skipped Task(%i)', request.user.id, int(task_id))
     else:
@@ -373,16 +395,17 @@ def skip_and_accept_next_task(request, batch_id, task_id, task_assignment_id):
     return redirect(accept_next_task, batch_id)
 
 
+@serialize_db_writes
 def skip_task(request, batch_id, task_id):
     """
     Skip to next task when previewing a task
 
     Security behavior:
-    - This view updates a session variable that controls the order
-      that Tasks are presented to a user.  Users cannot modify other
-      users session variables.
+    - This view records skipped Tasks that control the order that
+      Tasks are presented to a user.  Users cannot modify the skipped
+      Tasks of other users.
     """
-    _add_task_id_to_skip_session(request.session, batch_id, task_id)
+    _skip_task(request, batch_id, task_id)
     return redirect(preview_next_task, batch_id)
 
 
@@ -412,38 +435,39 @@ def stats(request):
     if end_date:
         tas = tas.filter(updated_at__lte=end_date)
 
-    projects = Project.objects.filter(batch__task__taskassignment__assigned_to=request.user).\
-        distinct()
-    batches = Batch.objects.filter(task__taskassignment__assigned_to=request.user).distinct()
+    # Counts and work times for each Batch, in a single grouped query
+    batch_rows = tas.\
+        order_by('task__batch__project_id', 'task__batch_id').\
+        values('task__batch_id', 'task__batch__name', 'task__batch__project_id',
+               'task__batch__project__name').\
+        annotate(total_completed=Count('id'), elapsed_seconds=Sum('work_time_seconds'))
 
+    total_completed_overall = 0
     elapsed_seconds_overall = 0
     project_stats = []
-    for project in projects:
-        project_batches = [b for b in batches if b.project_id == project.id]
-
+    for _, project_rows in itertools.groupby(
+            batch_rows, key=lambda row: row['task__batch__project_id']):
+        project_rows = list(project_rows)
         batch_stats = []
         elapsed_seconds_project = 0
         total_completed_project = 0
-        for batch in project_batches:
-            batch_tas = tas.filter(task__batch=batch)
-            total_completed_batch = batch_tas.count()
-            total_completed_project += total_completed_batch
-            elapsed_seconds_batch = sum([ta.work_time_in_seconds() for ta in batch_tas])
+        for row in project_rows:
+            elapsed_seconds_batch = row['elapsed_seconds'] or 0
+            total_completed_project += row['total_completed']
             elapsed_seconds_project += elapsed_seconds_batch
-            elapsed_seconds_overall += elapsed_seconds_batch
-            if total_completed_batch > 0:
-                batch_stats.append({
-                    'batch_name': batch.name,
-                    'elapsed_time_batch': format_seconds(elapsed_seconds_batch),
-                    'total_completed_batch': total_completed_batch,
-                })
-        if total_completed_project > 0:
-            project_stats.append({
-                'project_name': project.name,
-                'batch_stats': batch_stats,
-                'elapsed_time_project': format_seconds(elapsed_seconds_project),
-                'total_completed_project': total_completed_project,
+            batch_stats.append({
+                'batch_name': row['task__batch__name'],
+                'elapsed_time_batch': format_seconds(elapsed_seconds_batch),
+                'total_completed_batch': row['total_completed'],
             })
+        total_completed_overall += total_completed_project
+        elapsed_seconds_overall += elapsed_seconds_project
+        project_stats.append({
+            'project_name': project_rows[0]['task__batch__project__name'],
+            'batch_stats': batch_stats,
+            'elapsed_time_project': format_seconds(elapsed_seconds_project),
+            'total_completed_project': total_completed_project,
+        })
 
     if start_date:
         start_date = start_date.strftime('%Y-%m-%d')
@@ -461,7 +485,7 @@ def stats(request):
             'project_stats': project_stats,
             'end_date': end_date,
             'start_date': start_date,
-            'total_completed': tas.count(),
+            'total_completed': total_completed_overall,
             'total_elapsed_time': format_seconds(elapsed_seconds_overall),
             'full_name': name,
         }
@@ -480,24 +504,6 @@ def update_auto_accept(request):
     return JsonResponse({})
 
 
-def _add_task_id_to_skip_session(session, batch_id, task_id):
-    """Add Task ID to session variable tracking Tasks the user has skipped
-    """
-    # The Django session store converts dictionary keys from ints to strings
-    batch_id = str(batch_id)
-    task_id = str(task_id)
-
-    if 'skipped_tasks_in_batch' not in session:
-        session['skipped_tasks_in_batch'] = {}
-    if batch_id not in session['skipped_tasks_in_batch']:
-        session['skipped_tasks_in_batch'][batch_id] = []
-        session.modified = True
-    if task_id not in session['skipped_tasks_in_batch'][batch_id]:
-        session['skipped_tasks_in_batch'][batch_id].append(task_id)
-        session.modified = True
-
-
-@handle_db_lock
 def _delete_task_assignment(request, task_id, task_assignment_id):
     """Delete a TaskAssignment, if possible
 
@@ -544,6 +550,89 @@ def _delete_task_assignment(request, task_id, task_assignment_id):
         task_assignment.delete()
 
 
+def _get_skipped_task_ids_for_batch(request, batch_id):
+    """Get IDs of the Tasks in the Batch that the user has skipped
+
+    Returns:
+        QuerySet (authenticated users) or list (anonymous users) of Task IDs,
+        or None if the user has not skipped any Tasks in the Batch
+    """
+    if request.user.is_authenticated:
+        skipped_ids = SkippedTask.task_ids_for(request.user, batch_id)
+        return skipped_ids if skipped_ids.exists() else None
+
+    batch_id = str(batch_id)
+    session = request.session
+    if 'skipped_tasks_in_batch' in session and \
+       batch_id in session['skipped_tasks_in_batch']:
+        return session['skipped_tasks_in_batch'][batch_id]
+    else:
+        return None
+
+
+def _only_skipped_tasks_available(request):
+    # The skipped Tasks are not cleared here, since this is called when
+    # handling GET requests.  Skipping one of them again clears the others
+    # (see _skip_task()), so that a Task can be skipped a second time.
+    messages.info(request, 'Only previously skipped Tasks are available')
+
+
+def _skip_task(request, batch_id, task_id):
+    """Record that the user has skipped a Task
+
+    Skipped Tasks are stored in the database for authenticated users, and
+    in a session variable for anonymous users.  Skipping a Task that has
+    already been skipped - once only skipped Tasks are available - clears
+    the user's other skipped Tasks in the Batch, so that they are offered
+    before this Task again.
+    """
+    if request.user.is_authenticated:
+        task = Task.objects.filter(id=task_id, batch_id=batch_id).first()
+        if task:
+            SkippedTask.skip(request.user, task)
+        return
+
+    # The Django session store converts dictionary keys from ints to strings
+    batch_id = str(batch_id)
+    task_id = str(task_id)
+    session = request.session
+
+    if 'skipped_tasks_in_batch' not in session:
+        session['skipped_tasks_in_batch'] = {}
+    if batch_id not in session['skipped_tasks_in_batch']:
+        session['skipped_tasks_in_batch'][batch_id] = []
+        session.modified = True
+    if task_id in session['skipped_tasks_in_batch'][batch_id]:
+        session['skipped_tasks_in_batch'][batch_id] = [task_id]
+    else:
+        session['skipped_tasks_in_batch'][batch_id].append(task_id)
+    session.modified = True
+
+
+def _skip_aware_claim_next_task(request, batch):
+    """Claim next available Task for user, taking into account previously skipped Tasks
+
+    Tasks are claimed in the same order used by _skip_aware_next_available_task_id().
+
+    Returns:
+        TaskAssignment, or None if no more Tasks are available
+    """
+    skipped_ids = _get_skipped_task_ids_for_batch(request, batch.id)
+
+    if skipped_ids:
+        available_tasks = batch.available_tasks_for(request.user)
+        ha = batch.claim_next_task_for(request.user, available_tasks.exclude(id__in=skipped_ids))
+        if not ha:
+            ha = batch.claim_next_task_for(request.user,
+                                           available_tasks.filter(id__in=skipped_ids))
+            if ha:
+                _only_skipped_tasks_available(request)
+    else:
+        ha = batch.claim_next_task_for(request.user)
+
+    return ha
+
+
 def _skip_aware_next_available_task_id(request, batch):
     """Get next available Task for user, taking into account previously skipped Tasks
 
@@ -555,29 +644,15 @@ def _skip_aware_next_available_task_id(request, batch):
     Returns:
         Task ID (int), or None if no more Tasks are available
     """
-    def _get_skipped_task_ids_for_batch(session, batch_id):
-        batch_id = str(batch_id)
-        if 'skipped_tasks_in_batch' in session and \
-           batch_id in session['skipped_tasks_in_batch']:
-            return session['skipped_tasks_in_batch'][batch_id]
-        else:
-            return None
-
     available_task_ids = batch.available_task_ids_for(request.user)
-    skipped_ids = _get_skipped_task_ids_for_batch(request.session, batch.id)
+    skipped_ids = _get_skipped_task_ids_for_batch(request, batch.id)
 
     if skipped_ids:
         task_id = available_task_ids.exclude(id__in=skipped_ids).first()
         if not task_id:
             task_id = available_task_ids.filter(id__in=skipped_ids).first()
             if task_id:
-                messages.info(request, 'Only previously skipped Tasks are available')
-
-                # Once all remaining Tasks have been marked as skipped, we clear
-                # their skipped status.  If we don't take this step, then a Task
-                # cannot be skipped a second time.
-                request.session['skipped_tasks_in_batch'][str(batch.id)] = []
-                request.session.modified = True
+                _only_skipped_tasks_available(request)
     else:
         task_id = available_task_ids.first()
 
@@ -17,7 +17,10 @@
 #         'NAME': 'turkle',
 #         'USER': 'turkleuser',
 #         'PASSWORD': 'password',
-#         'HOST': 'localhost'
+#         'HOST': 'localhost',
+#         'OPTIONS': {
+#             'isolation_level': 'read committed',
+#         },
 #     }
 # }
 
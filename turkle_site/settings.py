@@ -115,13 +115,52 @@ AUTHENTICATION_BACKENDS = (
 )
 
 
-# Set max size for file uploads and POST requests to 100MB
+# Set max size for POST requests (not including uploaded files) to 100MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600
+
+# Uploaded files are always written to a temporary file on disk
+# (in FILE_UPLOAD_TEMP_DIR, default the system temporary directory)
+# instead of being held in memory, so there is no limit on the size
+# of uploaded CSV files.  Very large CSV files can also be uploaded in
+# chunks - see the "Uploading Large CSV Files" section of
+# docs/ADMINISTRATION.rst.
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
 
 # max size of template in KB
 TURKLE_TEMPLATE_LIMIT = 64
 
+# Number of seconds that the list of Batches a Worker has permission to
+# access is cached for.  Permission changes made through Turkle clear
+# the cache, but when running multiple server processes, CACHES must be
+# configured with a backend shared by all processes (e.g. memcached)
+# for the changes to be seen immediately.
+TURKLE_PERMISSION_CACHE_TIMEOUT = 60
+
+# Number of Tasks inserted into the database per query when creating a Batch
+TURKLE_TASK_CREATION_CHUNK_SIZE = 1000
+
+# If True, creating Tasks for new Batches, exporting Batch results and
+# cancelling Batches are run as background Jobs by the 'run_jobs'
+# management command instead of during the admin HTTP request.
+TURKLE_BACKGROUND_JOBS = False
+
+# Directory for the input and output files of background Jobs
+TURKLE_JOB_FILES_DIR = 'job_files'
+
+# Number of hours after the last chunk of a CSV file uploaded in chunks
+# was received until the 'expire_uploads' management command deletes
+# the file, if no Batch has been created from it
+TURKLE_UPLOAD_EXPIRATION = 24
+
+# Number of milliseconds a request waits for another request's write to
+# an SQLite database to finish, before failing with a 'database is locked' error
+TURKLE_SQLITE_BUSY_TIMEOUT = 20000
+
+# If True, database connections that are kept open between requests
+# (see CONN_MAX_AGE in the DATABASES setting) are checked at the start
+# of each request, and replaced if the database server has closed them.
+TURKLE_DB_HEALTH_CHECKS = False
+
 LOGIN_REDIRECT_URL = 'index'
 
 # If True, the "Password Reset" link will be added to the login form.
@@ -156,8 +195,35 @@ if 'TURKLE_DB_ENGINE' in os.environ and os.environ['TURKLE_DB_ENGINE'].lower() =
             'USER': os.environ['TURKLE_DB_USER'],
             'PASSWORD': os.environ['TURKLE_DB_PASSWORD'],
             'HOST': os.environ['TURKLE_DB_HOST'],
+            # Number of seconds a connection is kept open and reused by later
+            # requests, instead of opening a new connection for every request
+            'CONN_MAX_AGE': int(os.environ.get('TURKLE_DB_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                # Task claims re-check availability after locking a Task row,
+                # which requires queries to see the most recently committed data
+                'isolation_level': 'read committed',
+            },
         }
     }
+    # Check that a reused connection is still open before each request
+    TURKLE_DB_HEALTH_CHECKS = \
+        os.environ.get('TURKLE_DB_HEALTH_CHECKS', 'true').lower() not in ('0', 'false')
+
+    # Optional connection pool shared by the threads of each server process
+    # (gunicorn --threads), from the django-db-connection-pool package
+    if 'TURKLE_DB_POOL_SIZE' in os.environ:
+        DATABASES['default']['ENGINE'] = 'dj_db_conn_pool.backends.mysql'
+        # Connections are returned to the pool at the end of each request
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['POOL_OPTIONS'] = {
+            'POOL_SIZE': int(os.environ['TURKLE_DB_POOL_SIZE']),
+            'MAX_OVERFLOW': int(os.environ.get('TURKLE_DB_POOL_MAX_OVERFLOW', 10)),
+            # Number of seconds before a pooled connection is replaced
+            'RECYCLE': int(os.environ.get('TURKLE_DB_POOL_RECYCLE', 3600)),
+            # The pool pings each connection before handing it out
+            'PRE_PING': True,
+        }
+        TURKLE_DB_HEALTH_CHECKS = False
 
 if 'TURKLE_DOCKER' in os.environ:
     MIDDLEWARE = ('whitenoise.middleware.WhiteNoiseMiddleware', *MIDDLEWARE)